@@ -0,0 +1,149 @@
+# bench_broadcast.py
+# 广播合并发送基准测试：在不同合并窗口下启动聊天服务器，用 load_test_chat 的模拟客户端发送聊天室消息，
+# 比较服务器调用 sendall 的次数（约等于 send 系统调用次数）、送达延迟和服务器进程的 CPU 时间
+import argparse
+import asyncio
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+try:
+    import resource  # 仅 Unix，用于统计服务器进程的 CPU 时间
+except ImportError:
+    resource = None
+
+from load_test_chat import LoadClient, LoadStats, percentile, format_ms
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server_tcp.py')
+METRIC_RE = re.compile(r'^(\w+)(?:\{([^}]*)\})? (\S+)$')
+
+
+def read_metrics(admin_port):
+    """读取服务器管理端口上的指标，返回 {(名称, 标签): 值}"""
+    with urllib.request.urlopen(f'http://127.0.0.1:{admin_port}/metrics', timeout=10) as response:
+        text = response.read().decode()
+    values = {}
+    for line in text.splitlines():
+        match = METRIC_RE.match(line)
+        if match:
+            values[(match.group(1), match.group(2) or '')] = float(match.group(3))
+    return values
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'服务器没有在 {timeout}s 内启动')
+
+
+async def run_clients(args):
+    stats = LoadStats()
+    registry = []
+    clients = [LoadClient(i, args, stats, registry) for i in range(args.clients)]
+    results = []
+    # 分批建立连接，避免瞬间打满监听队列
+    for start in range(0, len(clients), 100):
+        results += await asyncio.gather(*(client.connect() for client in clients[start:start + 100]))
+    stats.started = time.monotonic()
+    deadline = stats.started + args.duration
+    await asyncio.gather(*(client.run(deadline) for client, ok in zip(clients, results) if ok))
+    return stats
+
+
+def children_cpu():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_once(args, window):
+    """以给定合并窗口启动服务器并压测一轮，返回结果"""
+    with tempfile.TemporaryDirectory() as workdir:
+        command = [sys.executable, SERVER_SCRIPT, '127.0.0.1', str(args.port), str(args.voice_port),
+                   str(args.admin_port), '0', str(window)]
+        cpu_before = children_cpu()
+        server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            wait_for_port(args.admin_port)
+            before = read_metrics(args.admin_port)
+            stats = asyncio.run(run_clients(args))
+            after = read_metrics(args.admin_port)
+        finally:
+            server.terminate()
+            server.wait()
+        cpu_after = children_cpu()
+
+    def delta(name, labels=''):
+        return after.get((name, labels), 0) - before.get((name, labels), 0)
+
+    calls = delta('chat_send_calls_total', 'mode="direct"') + delta('chat_send_calls_total', 'mode="batched"')
+    latencies = sorted(stats.latencies['message'])
+    return {
+        'window': window,
+        'connected': stats.connected,
+        'sent': stats.sent['message'],
+        'delivered': stats.delivered['message'],
+        'calls': calls,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'cpu': cpu_after - cpu_before if cpu_before is not None else None,
+        'final_window': after.get(('chat_batch_window_seconds', ''))
+    }
+
+
+def report(results, output=None):
+    lines = [f"{'窗口 ms':>8}{'在线':>8}{'发送':>8}{'送达':>10}{'sendall':>10}{'每次送达':>10}"
+             f"{'p50 ms':>9}{'p99 ms':>9}{'CPU s':>8}{'结束窗口 ms':>12}"]
+    for r in results:
+        per_delivery = r['calls'] / r['delivered'] if r['delivered'] else 0
+        cpu = '-' if r['cpu'] is None else f"{r['cpu']:.1f}"
+        final_window = '-' if r['final_window'] is None else f"{r['final_window'] * 1000:.2f}"
+        lines.append(f"{r['window'] * 1000:>8.1f}{r['connected']:>8}{r['sent']:>8}{r['delivered']:>10}{r['calls']:>10.0f}"
+                     f"{per_delivery:>10.3f}{format_ms(r['p50']):>9}{format_ms(r['p99']):>9}{cpu:>8}{final_window:>12}")
+    text = '\n'.join(lines)
+    print(text)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='广播合并发送基准测试')
+    parser.add_argument('--clients', type=int, default=1000, help='并发连接数')
+    parser.add_argument('--duration', type=float, default=20, help='发送阶段持续时间（秒）')
+    parser.add_argument('--message-rate', type=float, default=0.05, help='每连接每秒聊天室消息数')
+    parser.add_argument('--windows', type=float, nargs='*', default=[0, 0.005, 0.02], help='要比较的最大合并窗口（秒），0 表示不合并')
+    parser.add_argument('--port', type=int, default=18888)
+    parser.add_argument('--voice-port', type=int, default=18889)
+    parser.add_argument('--admin-port', type=int, default=18890)
+    parser.add_argument('--output', help='同时把结果写入文件')
+    args = parser.parse_args()
+
+    # 只发聊天室消息，其余参数沿用 load_test_chat 的默认值
+    args.host = '127.0.0.1'
+    args.prefix = 'bb_'
+    args.private_rate = args.users_rate = args.heartbeat_rate = args.file_rate = 0
+    args.drain = 3
+    args.timeout = 30
+
+    results = []
+    for window in args.windows:
+        print(f"合并窗口 {window * 1000:.1f} ms：{args.clients} 个连接，{args.duration:.0f}s ...")
+        results.append(run_once(args, window))
+    report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
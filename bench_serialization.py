@@ -0,0 +1,357 @@
+# bench_serialization.py
+# 序列化格式基准测试：用本项目实际发送的消息比较各格式的编解码耗时、内存分配和线路大小
+import argparse
+import base64
+import datetime
+import json
+import marshal
+import os
+import pickle
+import struct
+import sys
+import time
+import tracemalloc
+
+try:
+    import msgpack  # 可选依赖
+except ImportError:
+    msgpack = None
+
+KB = 1024
+MB = 1024 * 1024
+
+
+# ---------------------------------------------------------------------------
+# 测试数据：与 client_tcp.py / server_tcp.py 中构造的消息保持一致
+# 二进制字段一律用 bytes 表示，由各格式自行决定如何编码（JSON 只能用 base64）
+# ---------------------------------------------------------------------------
+
+def audio_frame():
+    """VoiceClient.audio_loop 发送的房间音频帧（1024 个 16 位采样）"""
+    return {
+        'type': 'audio_data',
+        'audio_data': os.urandom(2048),
+        'seq': 123456,
+        'capture_ts': time.time(),
+        'clock_offset': 0.0123,
+        'room_id': 'public'
+    }
+
+
+def chat_message():
+    """客户端发送的聊天室消息"""
+    return {
+        'type': 'message',
+        'content': '大家好，今天的会议改到下午三点 👍',
+        'timestamp': datetime.datetime.now().isoformat()
+    }
+
+
+def private_message():
+    """客户端发送的私聊消息"""
+    return {
+        'type': 'private',
+        'target': 'alice',
+        'content': '文件我已经发到群里了，记得查收',
+        'timestamp': datetime.datetime.now().isoformat()
+    }
+
+
+def broadcast_envelope():
+    """服务器广播给每个客户端的聊天消息"""
+    return {'sender': 'bob', 'message': '大家好，今天的会议改到下午三点 👍', 'type': 'message'}
+
+
+def users_reply(count):
+    """服务器对 users 命令的应答"""
+    users = [f"user_{i:05d}" for i in range(count)]
+    return {
+        'sender': '系统',
+        'message': f'在线用户: {", ".join(users)}',
+        'type': 'users',
+        'users': users
+    }
+
+
+def file_message(size):
+    """file 消息（文件内容为随机字节）"""
+    return {
+        'type': 'file',
+        'file_name': f'report_{size}.bin',
+        'file_size': size,
+        'file_content': os.urandom(size)
+    }
+
+
+def image_message(size):
+    """image 消息"""
+    return {
+        'type': 'image',
+        'image_name': f'photo_{size}.jpg',
+        'image_content': os.urandom(size)
+    }
+
+
+BINARY_FIELDS = ('audio_data', 'file_content', 'image_content')
+
+
+# ---------------------------------------------------------------------------
+# 各序列化格式：encode(dict) -> bytes, decode(bytes) -> dict
+# ---------------------------------------------------------------------------
+
+def json_encode(message):
+    """现有做法：二进制字段 base64 后整体 JSON"""
+    out = dict(message)
+    for field in BINARY_FIELDS:
+        if field in out:
+            out[field] = base64.b64encode(out[field]).decode('utf-8')
+    return json.dumps(out).encode()
+
+
+def json_decode(data):
+    message = json.loads(data.decode())
+    for field in BINARY_FIELDS:
+        if field in message:
+            message[field] = base64.b64decode(message[field])
+    return message
+
+
+def json_binary_encode(message):
+    """JSON 头 + 原始二进制负载：4 字节头长度 + JSON 头 + 负载"""
+    header = dict(message)
+    payload = b''
+    for field in BINARY_FIELDS:
+        if field in header:
+            payload = header.pop(field)
+            header['_binary'] = field
+    header_bytes = json.dumps(header).encode()
+    return struct.pack('>I', len(header_bytes)) + header_bytes + payload
+
+
+def json_binary_decode(data):
+    view = memoryview(data)
+    header_len = struct.unpack_from('>I', view, 0)[0]
+    message = json.loads(bytes(view[4:4 + header_len]).decode())
+    field = message.pop('_binary', None)
+    if field:
+        message[field] = bytes(view[4 + header_len:])
+    return message
+
+
+def pickle_encode(message):
+    """语音通道现有做法"""
+    return pickle.dumps(message)
+
+
+def pickle_encode_highest(message):
+    return pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def marshal_encode(message):
+    return marshal.dumps(message)
+
+
+def _pack_str(value):
+    data = value.encode()
+    return struct.pack('>I', len(data)) + data
+
+
+def _unpack_str(view, offset):
+    length = struct.unpack_from('>I', view, offset)[0]
+    offset += 4
+    return bytes(view[offset:offset + length]).decode(), offset + length
+
+
+# struct 格式为每种消息手写固定布局：1 字节类型码 + 字段
+STRUCT_AUDIO = struct.Struct('>BIdd')
+
+
+def struct_encode(message):
+    msg_type = message.get('type')
+    if 'sender' in message and msg_type != 'users':
+        return bytes([7]) + _pack_str(message['sender']) + _pack_str(message['message']) + _pack_str(message['type'])
+    if msg_type == 'audio_data':
+        return (STRUCT_AUDIO.pack(1, message['seq'], message['capture_ts'], message['clock_offset'])
+                + _pack_str(message['room_id']) + message['audio_data'])
+    if msg_type in ('message', 'private'):
+        code = 2 if msg_type == 'message' else 3
+        return (bytes([code]) + _pack_str(message['content']) + _pack_str(message['timestamp'])
+                + _pack_str(message.get('target', '')))
+    if msg_type == 'users':
+        names = message['users']
+        return (bytes([4]) + _pack_str(message['sender']) + _pack_str(message['message'])
+                + struct.pack('>I', len(names)) + b''.join(_pack_str(name) for name in names))
+    if msg_type == 'file':
+        return (bytes([5]) + _pack_str(message['file_name']) + struct.pack('>Q', message['file_size'])
+                + message['file_content'])
+    if msg_type == 'image':
+        return bytes([6]) + _pack_str(message['image_name']) + message['image_content']
+    raise ValueError(f"struct 格式不支持消息类型: {msg_type}")
+
+
+def struct_decode(data):
+    view = memoryview(data)
+    code = view[0]
+    if code == 1:
+        _, seq, capture_ts, clock_offset = STRUCT_AUDIO.unpack_from(view, 0)
+        room_id, offset = _unpack_str(view, STRUCT_AUDIO.size)
+        return {'type': 'audio_data', 'seq': seq, 'capture_ts': capture_ts,
+                'clock_offset': clock_offset, 'room_id': room_id, 'audio_data': bytes(view[offset:])}
+    if code in (2, 3):
+        content, offset = _unpack_str(view, 1)
+        timestamp, offset = _unpack_str(view, offset)
+        target, offset = _unpack_str(view, offset)
+        message = {'type': 'message' if code == 2 else 'private', 'content': content, 'timestamp': timestamp}
+        if target:
+            message['target'] = target
+        return message
+    if code == 4:
+        sender, offset = _unpack_str(view, 1)
+        text, offset = _unpack_str(view, offset)
+        count = struct.unpack_from('>I', view, offset)[0]
+        offset += 4
+        users = []
+        for _ in range(count):
+            name, offset = _unpack_str(view, offset)
+            users.append(name)
+        return {'sender': sender, 'message': text, 'type': 'users', 'users': users}
+    if code == 5:
+        name, offset = _unpack_str(view, 1)
+        size = struct.unpack_from('>Q', view, offset)[0]
+        return {'type': 'file', 'file_name': name, 'file_size': size, 'file_content': bytes(view[offset + 8:])}
+    if code == 6:
+        name, offset = _unpack_str(view, 1)
+        return {'type': 'image', 'image_name': name, 'image_content': bytes(view[offset:])}
+    if code == 7:
+        sender, offset = _unpack_str(view, 1)
+        text, offset = _unpack_str(view, offset)
+        msg_type, offset = _unpack_str(view, offset)
+        return {'sender': sender, 'message': text, 'type': msg_type}
+    raise ValueError(f"未知类型码: {code}")
+
+
+FORMATS = [
+    ('json+base64', json_encode, json_decode),
+    ('json头+二进制', json_binary_encode, json_binary_decode),
+    ('pickle', pickle_encode, pickle.loads),
+    ('pickle-v5', pickle_encode_highest, pickle.loads),
+    ('marshal', marshal_encode, marshal.loads),
+    ('struct', struct_encode, struct_decode),
+]
+if msgpack is not None:
+    FORMATS.append(('msgpack', msgpack.packb, msgpack.unpackb))
+
+
+def build_payloads(sizes):
+    payloads = [
+        ('audio_data 帧', audio_frame()),
+        ('message 消息', chat_message()),
+        ('private 私聊', private_message()),
+        ('广播信封', broadcast_envelope()),
+        ('users 100人', users_reply(100)),
+        ('users 5000人', users_reply(5000)),
+    ]
+    for size in sizes:
+        label = f"{size // MB} MB" if size >= MB else f"{size // KB} KB"
+        payloads.append((f'file {label}', file_message(size)))
+        payloads.append((f'image {label}', image_message(size)))
+    return payloads
+
+
+# ---------------------------------------------------------------------------
+# 测量
+# ---------------------------------------------------------------------------
+
+def time_per_call(func, arg, min_time):
+    """重复调用直到总耗时超过 min_time，返回每次调用的最短平均耗时（秒）"""
+    best = None
+    for _ in range(3):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            func(arg)
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        per_call = elapsed / count
+        best = per_call if best is None else min(best, per_call)
+    return best
+
+
+def measure_allocations(func, arg):
+    """单次调用期间新分配内存的峰值（字节）"""
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        result = func(arg)
+        _, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak - baseline
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} µs"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds:.2f} s"
+
+
+def format_bytes(size):
+    if size < KB:
+        return f"{size} B"
+    if size < MB:
+        return f"{size / KB:.1f} KB"
+    return f"{size / MB:.1f} MB"
+
+
+def run(args):
+    sizes = [10 * KB, 1 * MB] + ([] if args.quick else [50 * MB])
+    formats = [f for f in FORMATS if not args.formats or f[0] in args.formats]
+    lines = []
+
+    def emit(text=""):
+        print(text)
+        lines.append(text)
+
+    emit(f"Python {sys.version.split()[0]}，msgpack {'已安装' if msgpack else '未安装（跳过）'}")
+    for name, message in build_payloads(sizes):
+        emit(f"\n## {name}")
+        emit(f"{'格式':<16}{'线路大小':>12}{'编码':>12}{'解码':>12}{'编码峰值内存':>14}{'解码峰值内存':>14}")
+        for fmt, encode, decode in formats:
+            try:
+                wire = encode(message)
+            except (ValueError, TypeError) as e:
+                emit(f"{fmt:<16}不支持: {e}")
+                continue
+            # 大负载单次就足够稳定
+            min_time = args.min_time if len(wire) < MB else 0
+            encode_time = time_per_call(encode, message, min_time)
+            decode_time = time_per_call(decode, wire, min_time)
+            encode_peak = measure_allocations(encode, message)
+            decode_peak = measure_allocations(decode, wire)
+            emit(f"{fmt:<16}{format_bytes(len(wire)):>12}{format_time(encode_time):>12}"
+                 f"{format_time(decode_time):>12}{format_bytes(encode_peak):>14}"
+                 f"{format_bytes(decode_peak):>14}")
+            del wire
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        print(f"\n结果已写入 {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天/语音消息序列化格式基准测试')
+    parser.add_argument('--quick', action='store_true', help='跳过 50 MB 负载')
+    parser.add_argument('--min-time', type=float, default=0.2, help='小负载每项最少计时秒数')
+    parser.add_argument('--formats', nargs='*', help='只测试指定格式')
+    parser.add_argument('--output', help='同时把结果写入文件，例如 bench_output.txt')
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
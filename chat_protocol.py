@@ -0,0 +1,214 @@
+# chat_protocol.py
+# -*- coding: utf-8 -*-
+import base64
+import json
+import re
+import time
+import zlib
+from collections import deque
+
+# 单次 recv 的大小
+RECV_SIZE = 65536
+
+# 单条消息附带的二进制数据上限（文件块最大 1MB，留出余量）
+MAX_PAYLOAD_SIZE = 8 * 1024 * 1024
+
+_WHITESPACE = b' \t\r\n'
+
+# 握手时协商的压缩方式：登录消息带 "compression": ["deflate"]，服务器同意时在应答中带 "compression": "deflate"，
+# 之后服务器发出的每条消息单独压缩成 {"type": "deflate", "payload_size": n}<raw deflate 数据>
+COMPRESSION = 'deflate'
+COMPRESS_MIN_SIZE = 64                # 更小的消息加上帧头后反而变大
+COMPRESS_MAX_SIZE = MAX_PAYLOAD_SIZE  # 压缩后的数据要能放进一个二进制帧
+COMPRESS_LEVEL = 6
+
+# 已经压缩过的内容（图片、压缩包、音视频）的文件头，base64 附件是这些格式时不再压缩
+COMPRESSED_MAGIC = (
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'RIFF', b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ',
+    b'7z\xbc\xaf', b'Rar!', b'\x28\xb5\x2f\xfd', b'ID3', b'OggS', b'fLaC'
+)
+_BASE64_CONTENT_RE = re.compile(rb'"(?:file_content|image_content|content)": "([A-Za-z0-9+/]{16})')
+
+# 压缩和解压共用的预置字典：常见消息的字段和取值，让几十字节的小消息也能压缩；越常见的放在越后面
+CHAT_DICTIONARY = ''.join(json.dumps(sample) for sample in (
+    {'type': 'attachment_data', 'hash': '', 'content': ''},
+    {'type': 'image_receive', 'sender': '', 'image_name': '', 'image_size': 0, 'image_hash': ''},
+    {'type': 'file_receive', 'sender': '', 'file_name': '', 'file_size': 0, 'file_hash': '', 'private': True},
+    {'type': 'voice_status', 'user': '', 'status': ''},
+    {'type': 'history', 'conversation': 'chat_room', 'messages': [], 'has_more': True},
+    {'type': 'users', 'users': []},
+    {'type': 'heartbeat_ack'},
+    {'sender': '系统', 'message': ' 加入了聊天室', 'type': 'broadcast'},
+    {'sender': '系统', 'message': ' 离开了聊天室', 'type': 'broadcast'},
+    {'type': 'private_sent', 'sender': '', 'target': '', 'message': '', 'id': 0, 'timestamp': ''},
+    {'type': 'private', 'sender': '', 'target': '', 'message': '', 'id': 0, 'timestamp': ''},
+    {'sender': '', 'message': '', 'type': 'message', 'id': 0, 'timestamp': '2026-01-01 12:00:00'},
+)).encode()
+
+
+class JsonStreamDecoder:
+    """把 TCP 字节流切分成连续的 JSON 消息（处理粘包和半包）
+
+    带 payload_size 字段的消息后面紧跟这么多字节的二进制数据，解析后放在消息的 'payload' 中。
+    带 stream_size 字段的消息后面紧跟这么多字节的原始数据（大附件），不放进消息里，由调用方用
+    read_stream / receive_stream 边收边处理，读完后才继续解析后面的消息。
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD_SIZE, on_inflate=None):
+        self.max_payload = max_payload
+        self.on_inflate = on_inflate  # 解压一条消息后调用 on_inflate(压缩后字节数, 原始字节数, 耗时秒)
+        self.buffer = bytearray()
+        self.messages = deque()
+        self._decoder = json.JSONDecoder()
+        self._scanned = 0     # buffer 中已确认没有 '}' 的前缀长度
+        self._header = None   # 正在等待二进制数据的消息
+        self._stream = 0      # stream_size 消息后面还没有取走的原始数据字节数
+
+    def feed(self, data):
+        """追加收到的数据，解析出其中所有完整的消息"""
+        self.buffer += data
+        while self.buffer and not self._stream:
+            if self._header is not None:
+                size = self._header['payload_size']
+                if len(self.buffer) < size:
+                    return
+                self._header['payload'] = bytes(self.buffer[:size])
+                del self.buffer[:size]
+                if self._header.get('type') == COMPRESSION:
+                    self.messages.append(self._inflate(self._header['payload']))
+                else:
+                    self.messages.append(self._header)
+                self._header = None
+                continue
+            # 消息总以 '}' 结尾，新数据里没有 '}' 时不必尝试解析（避免大消息反复解析）
+            end = self.buffer.rfind(b'}', self._scanned)
+            if end < 0:
+                self._scanned = len(self.buffer)
+                return
+            if not self._parse(end + 1):
+                self._scanned = len(self.buffer)
+                return
+
+    def _parse(self, end):
+        """解析 buffer[:end] 中的消息，遇到带二进制数据的消息时停下；返回是否有进展"""
+        # surrogateescape 保证任意字节都能解码，且字符和字节可以一一换算
+        text = self.buffer[:end].decode('utf-8', 'surrogateescape')
+        index = 0
+        consumed = 0
+        length = len(text)
+        while True:
+            start = index
+            while index < length and text[index] in ' \t\r\n':
+                index += 1
+            if index >= length:
+                consumed += len(text[start:index].encode('utf-8', 'surrogateescape'))
+                break
+            try:
+                message, index = self._decoder.raw_decode(text, index)
+            except json.JSONDecodeError:
+                # 剩余部分还不完整
+                index = start
+                break
+            consumed += len(text[start:index].encode('utf-8', 'surrogateescape'))
+            size = message.get('payload_size') if isinstance(message, dict) else None
+            if isinstance(size, int) and size > 0:
+                if size > self.max_payload:
+                    raise ValueError(f"二进制数据过大: {size} 字节")
+                self._header = message
+                break
+            stream = message.get('stream_size') if isinstance(message, dict) else None
+            if isinstance(stream, int) and stream > 0:
+                self.messages.append(message)
+                self._stream = stream
+                break
+            self.messages.append(message)
+
+        if consumed == 0:
+            return False
+        del self.buffer[:consumed]
+        self._scanned = 0
+        return True
+
+    def _inflate(self, data):
+        """解压一条压缩过的消息"""
+        started = time.perf_counter()
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=CHAT_DICTIONARY)
+        try:
+            raw = inflater.decompress(data, self.max_payload)
+        except zlib.error as e:
+            raise ValueError(f"压缩数据无效: {e}")
+        if inflater.unconsumed_tail:
+            raise ValueError("解压后的消息过大")
+        message = json.loads(raw)
+        if self.on_inflate:
+            self.on_inflate(len(data), len(raw), time.perf_counter() - started)
+        return message
+
+    @property
+    def stream_remaining(self):
+        """当前原始数据还有多少字节没有取走"""
+        return self._stream
+
+    def read_stream(self, limit):
+        """从缓冲区取出最多 limit 字节原始数据，缓冲区里没有时返回 b''；取完后继续解析后面的消息"""
+        size = min(limit, self._stream, len(self.buffer))
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self._stream -= size
+        if not self._stream and self.buffer:
+            self.feed(b'')
+        return data
+
+    def pop(self):
+        """取出一条已解析的消息，没有则返回 None"""
+        return self.messages.popleft() if self.messages else None
+
+
+def encode_message(message, payload=None):
+    """编码一条消息；payload 为二进制数据时附在 JSON 后面发送"""
+    if not payload:
+        return json.dumps(message).encode()
+    message = dict(message, payload_size=len(payload))
+    return json.dumps(message).encode() + payload
+
+
+def is_precompressed(data):
+    """消息里的 base64 附件内容是否已经是压缩格式（按文件头判断）"""
+    match = _BASE64_CONTENT_RE.search(data)
+    if not match:
+        return False
+    head = base64.b64decode(match.group(1))
+    return head.startswith(COMPRESSED_MAGIC)
+
+
+def compress_frame(data):
+    """把一条编码好的消息压缩成 deflate 帧；太小、已压缩或压缩后没有变小时返回 None"""
+    if not COMPRESS_MIN_SIZE <= len(data) <= COMPRESS_MAX_SIZE or is_precompressed(data):
+        return None
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=CHAT_DICTIONARY)
+    compressed = compressor.compress(data) + compressor.flush()
+    frame = encode_message({'type': COMPRESSION}, compressed)
+    return frame if len(frame) < len(data) else None
+
+
+def receive_message(sock, decoder):
+    """阻塞读取下一条完整消息，连接关闭时返回 None"""
+    while not decoder.messages:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        decoder.feed(data)
+    return decoder.messages.popleft()
+
+
+def receive_stream(sock, decoder):
+    """按块产出 stream_size 消息后面的原始数据，直到读完；连接中途关闭时抛出 ConnectionError"""
+    while decoder.stream_remaining:
+        data = decoder.read_stream(RECV_SIZE)
+        if not data:
+            data = sock.recv(min(RECV_SIZE, decoder.stream_remaining))
+            if not data:
+                raise ConnectionError('连接已断开')
+            decoder.feed(data)
+            continue
+        yield data
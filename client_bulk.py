@@ -0,0 +1,130 @@
+# client_bulk.py
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import socket
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from chat_protocol import JsonStreamDecoder, receive_message, receive_stream, encode_message
+from client_upload import HASH_BLOCK_SIZE
+
+
+class BulkError(Exception):
+    """服务器拒绝了附件传输请求（重试也不会成功）"""
+
+
+class BulkTransferThread(QThread):
+    """附件传输线程：单独连接服务器的附件端口上传或下载一个附件，不占用聊天连接，也不阻塞界面"""
+
+    progress = pyqtSignal(str, int, int)    # file_id, 已确认字节数, 文件大小
+    hashed = pyqtSignal(str, str)           # file_id, 文件哈希（上传前在本线程中算好）
+    upload_done = pyqtSignal(str, str)      # file_id, 文件哈希
+    download_done = pyqtSignal(str, str)    # 文件哈希, 保存路径
+    failed = pyqtSignal(str, str, bool)     # file_id 或文件哈希, 错误信息, 能否续传
+
+    def __init__(self, host, port, token, upload=None, digest=None, path=None):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.token = token
+        self.upload = upload
+        self.digest = digest
+        self.path = path
+
+    def connect_bulk(self):
+        """连接附件端口并用登录时拿到的令牌认证"""
+        sock = socket.create_connection((self.host, self.port), timeout=30)
+        decoder = JsonStreamDecoder()
+        try:
+            sock.sendall(json.dumps({'type': 'bulk_hello', 'token': self.token}).encode())
+            reply = receive_message(sock, decoder)
+            if reply is None:
+                raise ConnectionError('连接已断开')
+            if reply.get('type') != 'bulk_ready':
+                raise BulkError(reply.get('error', '认证失败'))
+        except Exception:
+            sock.close()
+            raise
+        return sock, decoder
+
+    def run(self):
+        key = self.upload.file_id if self.upload else self.digest
+        try:
+            if self.upload and self.upload.file_hash is None:
+                self.hashed.emit(key, self.upload.compute_hash())
+            sock, decoder = self.connect_bulk()
+            try:
+                if self.upload:
+                    self.run_upload(sock, decoder)
+                else:
+                    self.run_download(sock, decoder)
+            finally:
+                sock.close()
+        except BulkError as e:
+            self.failed.emit(key, str(e), False)
+        except (OSError, ValueError) as e:
+            self.failed.emit(key, str(e), True)
+
+    def run_upload(self, sock, decoder):
+        """分块上传，协议见 file_upload_protocol.md"""
+        upload = self.upload
+        sock.sendall(json.dumps(upload.request()).encode())
+        while True:
+            message = receive_message(sock, decoder)
+            if message is None:
+                raise ConnectionError('连接已断开')
+            msg_type = message.get('type')
+            if msg_type == 'file_upload_error':
+                raise BulkError(message.get('error', '上传失败'))
+            if msg_type == 'file_upload_done':
+                self.upload_done.emit(upload.file_id, message.get('file_hash', ''))
+                return
+            if msg_type == 'file_upload_ready':
+                upload.on_ready(message.get('received_bytes', 0))
+            elif msg_type == 'file_upload_ack':
+                upload.on_ack(message.get('offset', 0), message.get('error'))
+
+            for header, payload in upload.next_chunks():
+                sock.sendall(encode_message(header, payload))
+            if upload.done and not upload.completing:
+                upload.completing = True
+                sock.sendall(json.dumps({'type': 'file_upload_complete', 'file_id': upload.file_id}).encode())
+            self.progress.emit(upload.file_id, upload.acked, upload.file_size)
+
+    def run_download(self, sock, decoder):
+        """按内容哈希下载附件，边收边写入 path；中断后留下的 .part 文件下次从末尾续传"""
+        part_path = self.path + '.part'
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part_path):
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+                    offset += len(block)
+
+        sock.sendall(json.dumps({'type': 'attachment_get', 'hash': self.digest, 'offset': offset}).encode())
+        message = receive_message(sock, decoder)
+        if message is None:
+            raise ConnectionError('连接已断开')
+        if message.get('error'):
+            if offset:
+                # 本地的 .part 文件可能比服务器上的附件还长，删掉重新下载
+                os.remove(part_path)
+            raise BulkError(message['error'])
+        size = message.get('size', 0)
+        received = offset
+        with open(part_path, 'ab') as f:
+            for data in receive_stream(sock, decoder):
+                f.write(data)
+                digest.update(data)
+                received += len(data)
+                self.progress.emit(self.digest, received, size)
+        if received != size:
+            raise ConnectionError('附件数据不完整')
+        if digest.hexdigest() != self.digest:
+            os.remove(part_path)
+            raise BulkError('附件校验失败')
+        os.replace(part_path, self.path)
+        self.download_done.emit(self.digest, self.path)
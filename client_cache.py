@@ -0,0 +1,190 @@
+# client_cache.py
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import sqlite3
+from collections import OrderedDict, deque
+
+CHAT_ROOM = "chat_room"
+
+
+def private_conversation(peer):
+    """与某个用户私聊的会话键"""
+    return f"private:{peer}"
+
+
+def channel_conversation(channel):
+    """文字频道的会话键（频道名以 # 开头）"""
+    return f"channel:{channel}"
+
+
+class MessageCache:
+    """客户端本地聊天记录：按会话保存在 SQLite 中，内存里只保留每个会话最近的一段"""
+
+    def __init__(self, path=':memory:', window=200, max_windows=20):
+        self.path = path
+        self.window_size = window
+        self.max_windows = max_windows
+        self.windows = OrderedDict()  # conversation -> deque(最近的消息)
+        self.cursors = {}             # conversation -> 已显示的最早一条 (timestamp, local_id)
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        if path != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                local_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation TEXT NOT NULL,
+                server_id INTEGER,
+                ts TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_server_id ON messages (conversation, server_id);
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, ts, local_id);
+            CREATE TABLE IF NOT EXISTS files (
+                file_id TEXT PRIMARY KEY,
+                file_name TEXT,
+                file_size INTEGER,
+                sender TEXT,
+                timestamp TEXT,
+                content BLOB
+            );
+        ''')
+        self.conn.commit()
+
+    def _insert(self, conversation, message):
+        message = dict(message)
+        message.setdefault('timestamp', datetime.datetime.now().isoformat())
+        message.pop('local_id', None)
+        message.pop('_view_key', None)
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO messages (conversation, server_id, ts, data) VALUES (?, ?, ?, ?)',
+            (conversation, message.get('id'), message['timestamp'], json.dumps(message, ensure_ascii=False))
+        )
+        if cursor.rowcount == 0:
+            return None
+        message['local_id'] = cursor.lastrowid
+        return message
+
+    def _rows(self, rows):
+        messages = []
+        for local_id, data in reversed(rows):
+            message = json.loads(data)
+            message['local_id'] = local_id
+            messages.append(message)
+        return messages
+
+    def append(self, conversation, message):
+        """保存一条新消息；带服务器 id 且已保存过时返回 False"""
+        message = self._insert(conversation, message)
+        self.conn.commit()
+        if message is None:
+            return False
+        window = self.windows.get(conversation)
+        if window is not None:
+            window.append(message)
+        return True
+
+    def assign_server_id(self, conversation, attachment_hash, server_id):
+        """给本地先保存的、还没有服务器 id 的附件消息补上 id，返回是否找到这条消息"""
+        rows = self.conn.execute(
+            'SELECT local_id, data FROM messages WHERE conversation = ? AND server_id IS NULL '
+            'ORDER BY local_id DESC LIMIT 50',
+            (conversation,)
+        ).fetchall()
+        for local_id, data in rows:
+            message = json.loads(data)
+            if attachment_hash in (message.get('file_id'), message.get('image_hash')):
+                message['id'] = server_id
+                self.conn.execute(
+                    'UPDATE OR IGNORE messages SET server_id = ?, data = ? WHERE local_id = ?',
+                    (server_id, json.dumps(message, ensure_ascii=False), local_id)
+                )
+                self.conn.commit()
+                return True
+        return False
+
+    def add_history(self, conversation, messages):
+        """保存从服务器拉取的记录（按服务器 id 去重），返回新增条数"""
+        inserted = sum(1 for message in messages if self._insert(conversation, message) is not None)
+        self.conn.commit()
+        if inserted:
+            # 补进来的是更早的消息，下次从数据库重新加载以保证顺序
+            self.windows.pop(conversation, None)
+        return inserted
+
+    def window(self, conversation):
+        """会话最近的消息（从旧到新），首次访问时从数据库加载"""
+        window = self.windows.get(conversation)
+        if window is None:
+            rows = self.conn.execute(
+                'SELECT local_id, data FROM messages WHERE conversation = ? '
+                'ORDER BY ts DESC, local_id DESC LIMIT ?',
+                (conversation, self.window_size)
+            ).fetchall()
+            window = deque(self._rows(rows), maxlen=self.window_size)
+            self.windows[conversation] = window
+            if len(self.windows) > self.max_windows:
+                self.windows.popitem(last=False)
+        else:
+            self.windows.move_to_end(conversation)
+        return list(window)
+
+    def start_view(self, conversation):
+        """切换到某个会话：返回要显示的最近消息，并把向上翻页的位置设为其中最早一条"""
+        messages = self.window(conversation)
+        self.cursors[conversation] = (messages[0]['timestamp'], messages[0]['local_id']) if messages else None
+        return messages
+
+    def older(self, conversation, limit=50):
+        """向上翻页：返回已显示部分之前的 limit 条消息（从旧到新）"""
+        cursor = self.cursors.get(conversation)
+        if cursor is None:
+            rows = self.conn.execute(
+                'SELECT local_id, data FROM messages WHERE conversation = ? '
+                'ORDER BY ts DESC, local_id DESC LIMIT ?',
+                (conversation, limit)
+            ).fetchall()
+        else:
+            ts, local_id = cursor
+            rows = self.conn.execute(
+                'SELECT local_id, data FROM messages WHERE conversation = ? '
+                'AND (ts < ? OR (ts = ? AND local_id < ?)) '
+                'ORDER BY ts DESC, local_id DESC LIMIT ?',
+                (conversation, ts, ts, local_id, limit)
+            ).fetchall()
+        messages = self._rows(rows)
+        if messages:
+            self.cursors[conversation] = (messages[0]['timestamp'], messages[0]['local_id'])
+        return messages
+
+    def oldest_server_id(self, conversation):
+        """本地已有的最早一条服务器消息 id，用于向服务器请求更早的记录"""
+        return self.conn.execute(
+            'SELECT MIN(server_id) FROM messages WHERE conversation = ?', (conversation,)
+        ).fetchone()[0]
+
+    def save_file(self, file_id, file_name, file_size, sender, timestamp, content):
+        """保存收到（或发出）的文件内容，供之后下载"""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files (file_id, file_name, file_size, sender, timestamp, content) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (file_id, file_name, file_size, sender, timestamp, content)
+        )
+        self.conn.commit()
+
+    def load_file(self, file_id):
+        """读取文件记录，不存在时返回 None"""
+        row = self.conn.execute(
+            'SELECT file_name, file_size, sender, timestamp, content FROM files WHERE file_id = ?', (file_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('file_name', 'file_size', 'sender', 'timestamp', 'file_content'), row))
+
+    def close(self):
+        self.conn.close()
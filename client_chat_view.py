@@ -0,0 +1,231 @@
+# client_chat_view.py
+# -*- coding: utf-8 -*-
+import itertools
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QAbstractItemView, QApplication, QMenu
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QPoint, QPointF, QRectF, QSize, QUrl, pyqtSignal
+from PyQt5.QtGui import QTextDocument
+
+# 给每条显示的消息一个稳定的键，用于缓存排版结果
+_view_keys = itertools.count(1)
+
+
+def view_key(message):
+    """消息在视图中的键（同一个消息字典在多次切换会话之间保持不变）"""
+    key = message.get('_view_key')
+    if key is None:
+        key = message['_view_key'] = next(_view_keys)
+    return key
+
+
+class MessageListModel(QAbstractListModel):
+    """聊天消息列表模型，每行是一个消息字典"""
+
+    MessageRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{message.get('sender', '')}: {message.get('message', '')}"
+        if role == self.MessageRole:
+            return message
+        return None
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self.messages = list(messages)
+        self.endResetModel()
+
+    def append_message(self, message):
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(message)
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[:0] = messages
+        self.endInsertRows()
+
+
+class MessageDocument(QTextDocument):
+    """消息文档：自定义协议的资源（如缩略图）交给 resource_loader 提供"""
+
+    def __init__(self, resource_loader=None, parent=None):
+        super().__init__(parent)
+        self.resource_loader = resource_loader
+
+    def loadResource(self, resource_type, url):
+        if self.resource_loader and url.scheme() not in ('', 'file'):
+            resource = self.resource_loader(url.toString(QUrl.FullyEncoded))
+            if resource is not None:
+                return resource
+        return super().loadResource(resource_type, url)
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """用 QTextDocument 绘制消息 HTML，排版结果按 (消息, 宽度) 缓存"""
+
+    def __init__(self, formatter, view, max_cached=2000, stylesheet='', resource_loader=None):
+        super().__init__(view)
+        self.formatter = formatter
+        self.view = view
+        self.max_cached = max_cached
+        self.stylesheet = stylesheet
+        self.resource_loader = resource_loader
+        self.documents = OrderedDict()  # (view_key, width) -> (消息, QTextDocument)
+
+    def clear_cache(self):
+        self.documents.clear()
+
+    def invalidate(self, predicate):
+        """丢弃满足条件的消息的排版结果，返回丢弃的数量"""
+        keys = [key for key, (message, _) in self.documents.items() if predicate(message)]
+        for key in keys:
+            del self.documents[key]
+        return len(keys)
+
+    def document(self, message, width):
+        key = (view_key(message), width)
+        cached = self.documents.get(key)
+        if cached is not None:
+            self.documents.move_to_end(key)
+            return cached[1]
+        document = MessageDocument(self.resource_loader)
+        document.setDefaultFont(self.view.font())
+        document.setDefaultStyleSheet(self.stylesheet)
+        document.setHtml(self.formatter(message))
+        document.setTextWidth(width)
+        self.documents[key] = (message, document)
+        if len(self.documents) > self.max_cached:
+            self.documents.popitem(last=False)
+        return document
+
+    def width(self):
+        return max(100, self.view.viewport().width())
+
+    def sizeHint(self, option, index):
+        message = index.data(MessageListModel.MessageRole)
+        document = self.document(message, self.width())
+        return QSize(self.width(), int(document.size().height()))
+
+    def paint(self, painter, option, index):
+        message = index.data(MessageListModel.MessageRole)
+        document = self.document(message, self.width())
+        painter.save()
+        painter.translate(option.rect.topLeft())
+        document.drawContents(painter, QRectF(0, 0, option.rect.width(), option.rect.height()))
+        painter.restore()
+
+
+class MessageListView(QListView):
+    """虚拟化的聊天消息视图：只绘制可见的消息，切换会话时不重新生成全部 HTML"""
+
+    anchorClicked = pyqtSignal(QUrl)
+
+    def __init__(self, formatter, stylesheet='', resource_loader=None, parent=None):
+        super().__init__(parent)
+        self.message_model = MessageListModel(self)
+        self.message_delegate = MessageDelegate(formatter, self, stylesheet=stylesheet,
+                                                resource_loader=resource_loader)
+        self.setModel(self.message_model)
+        self.setItemDelegate(self.message_delegate)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(False)
+        self.setMouseTracking(True)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.show_context_menu)
+
+    def set_messages(self, messages):
+        """整体替换显示的消息并滚动到底部"""
+        self.message_model.set_messages(messages)
+        self.scrollToBottom()
+
+    def append_message(self, message):
+        self.message_model.append_message(message)
+        self.scrollToBottom()
+
+    def prepend_messages(self, messages):
+        """在顶部插入更早的消息，保持当前看到的内容位置不变"""
+        first = self.indexAt(QPoint(0, 0))
+        offset = self.visualRect(first).top() if first.isValid() else 0
+        self.message_model.prepend_messages(messages)
+        if first.isValid():
+            anchor = self.message_model.index(first.row() + len(messages))
+            self.scrollTo(anchor, QAbstractItemView.PositionAtTop)
+            self.verticalScrollBar().setValue(self.verticalScrollBar().value() - offset)
+
+    def clear(self):
+        self.message_model.set_messages([])
+
+    def refresh(self):
+        """字体等排版参数变化后重新排版"""
+        self.message_delegate.clear_cache()
+        self.doItemsLayout()
+        self.viewport().update()
+
+    def invalidate(self, predicate):
+        """某些消息的资源（如缩略图）就绪后重新排版，停在底部时保持在底部"""
+        if not self.message_delegate.invalidate(predicate):
+            return
+        scroll_bar = self.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        self.doItemsLayout()
+        if at_bottom:
+            self.scrollToBottom()
+        self.viewport().update()
+
+    def set_stylesheet(self, stylesheet):
+        """切换消息的文档样式表（主题），消息 HTML 本身不变"""
+        self.message_delegate.stylesheet = stylesheet
+        self.refresh()
+
+    def anchor_at(self, pos):
+        """返回鼠标位置下的链接地址"""
+        index = self.indexAt(pos)
+        if not index.isValid():
+            return ''
+        rect = self.visualRect(index)
+        message = index.data(MessageListModel.MessageRole)
+        document = self.message_delegate.document(message, self.message_delegate.width())
+        return document.documentLayout().anchorAt(QPointF(pos - rect.topLeft()))
+
+    def mouseMoveEvent(self, event):
+        cursor = Qt.PointingHandCursor if self.anchor_at(event.pos()) else Qt.ArrowCursor
+        self.viewport().setCursor(cursor)
+        super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            anchor = self.anchor_at(event.pos())
+            if anchor:
+                self.anchorClicked.emit(QUrl(anchor))
+                return
+        super().mouseReleaseEvent(event)
+
+    def show_context_menu(self, position):
+        """右键复制消息文本"""
+        index = self.indexAt(position)
+        if not index.isValid():
+            return
+        menu = QMenu(self)
+        copy_action = menu.addAction("复制消息")
+        if menu.exec_(self.viewport().mapToGlobal(position)) == copy_action:
+            message = index.data(MessageListModel.MessageRole)
+            document = self.message_delegate.document(message, self.message_delegate.width())
+            QApplication.clipboard().setText(document.toPlainText().strip())
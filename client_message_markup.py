@@ -0,0 +1,159 @@
+# client_message_markup.py
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import urllib.parse
+from collections import OrderedDict
+from string import Template
+
+# 消息 HTML 只带 class，颜色全部放在文档样式表里，切换主题时不需要重新生成 HTML
+LIGHT_STYLESHEET = """
+    .msg { background-color: #f8f9fa; border-left: 4px solid #6c757d; padding: 8px; margin: 5px 0; }
+    .msg .head { color: #212529; font-size: 0.9em; }
+    .msg .body { color: #212529; margin-top: 3px; }
+    .msg.mine { background-color: #d4edda; border-left-color: #28a745; }
+    .msg.mine .head, .msg.mine .body { color: #155724; }
+    .system { background-color: #fff3cd; border-left: 4px solid #ffc107; padding: 8px; margin: 5px 0; }
+    .system .head, .system .body { color: #856404; }
+    .private { background-color: #e7f3ff; border-left: 4px solid #2196F3; padding: 8px; margin: 5px 0; }
+    .private .head, .private .body { color: #0d47a1; }
+    .head { font-size: 0.9em; }
+    .attachment { margin-top: 5px; }
+    .attachment img { border: 1px solid #ddd; padding: 2px; }
+    a.download { background-color: #3498db; color: white; text-decoration: none; padding: 5px 10px; font-size: 0.9em; }
+"""
+
+DARK_STYLESHEET = """
+    .msg { background-color: #3c3c3c; border-left: 4px solid #777; padding: 8px; margin: 5px 0; }
+    .msg .head { color: #ddd; font-size: 0.9em; }
+    .msg .body { color: #ddd; margin-top: 3px; }
+    .msg.mine { background-color: #2c5f2d; border-left-color: #4CAF50; }
+    .msg.mine .head, .msg.mine .body { color: #4CAF50; }
+    .system { background-color: #4a4031; border-left: 4px solid #ffc107; padding: 8px; margin: 5px 0; }
+    .system .head, .system .body { color: #ffd700; }
+    .private { background-color: #2c3e50; border-left: 4px solid #3498db; padding: 8px; margin: 5px 0; }
+    .private .head, .private .body { color: #3498db; }
+    .head { font-size: 0.9em; }
+    .attachment { margin-top: 5px; }
+    .attachment img { border: 1px solid #555; padding: 2px; }
+    a.download { background-color: #3498db; color: white; text-decoration: none; padding: 5px 10px; font-size: 0.9em; }
+"""
+
+# 每种消息一个预编译的模板
+TEMPLATES = {
+    'system': Template(
+        "<div class='system'><span class='head'>$time</span><br>"
+        "<span class='body'><b>📢 $sender:</b> $message</span>$attachments</div>"
+    ),
+    'private': Template(
+        "<div class='private'><span class='head'>$time</span><br>"
+        "<span class='body'><b>🔒 $sender:</b> $message</span>$attachments</div>"
+    ),
+    'mine': Template(
+        "<div class='msg mine'><div class='head'>$time | 🗨️ <b>我</b></div>"
+        "<div class='body'>$message</div>$attachments</div>"
+    ),
+    'other': Template(
+        "<div class='msg'><div class='head'>$time | 👤 <b>$sender</b></div>"
+        "<div class='body'>$message</div>$attachments</div>"
+    ),
+}
+# 图片用 thumb: 地址，由视图向缩略图服务取图，原图不在 GUI 线程解码
+IMAGE_TEMPLATE = Template(
+    "<div class='attachment'><img src='$src'></div>"
+)
+THUMBNAIL_SCHEME = 'thumb'
+LINK_TEMPLATE = Template(
+    "<div class='attachment'><a class='download' href='$href'>下载文件: $name</a></div>"
+)
+
+
+def file_url_path(path):
+    """本地路径转为 file:/// 后面的部分（兼容 Windows 路径）"""
+    return urllib.parse.quote(path.replace('\\', '/'))
+
+
+def thumbnail_url(path, digest=''):
+    """图片路径对应的缩略图地址；带上内容哈希，图片还没下载时可以按哈希向服务器获取"""
+    return f"{THUMBNAIL_SCHEME}:{urllib.parse.quote(path, safe='')};{digest or ''}"
+
+
+def parse_thumbnail_url(url):
+    """从缩略图地址取回 (图片路径, 内容哈希)"""
+    path, _, digest = url.split(':', 1)[1].partition(';')
+    return urllib.parse.unquote(path), digest
+
+
+class MessageRenderer:
+    """把消息字典渲染成 HTML 片段，片段按消息缓存"""
+
+    def __init__(self, max_cached=5000):
+        self.max_cached = max_cached
+        self.fragments = OrderedDict()  # (消息键, 当前用户) -> HTML
+
+    def message_key(self, message):
+        """有服务器 id 的消息按 id 缓存，本地消息按本地 id 或对象本身"""
+        if message.get('id') is not None:
+            return ('id', message['id'])
+        if message.get('local_id') is not None:
+            return ('local', message['local_id'])
+        return ('object', id(message))
+
+    def render(self, message, username):
+        key = (self.message_key(message), username)
+        if key[0][0] != 'object':
+            html = self.fragments.get(key)
+            if html is not None:
+                self.fragments.move_to_end(key)
+                return html
+        html = self.build(message, username)
+        if key[0][0] != 'object':
+            self.fragments[key] = html
+            if len(self.fragments) > self.max_cached:
+                self.fragments.popitem(last=False)
+        return html
+
+    def build(self, message, username):
+        """生成一条消息的 HTML（不含颜色）"""
+        sender = message.get('sender', '未知')
+        msg_type = message.get('type', 'broadcast')
+        try:
+            time_str = datetime.datetime.fromisoformat(message.get('timestamp', '')).strftime("%H:%M:%S")
+        except (TypeError, ValueError):
+            time_str = datetime.datetime.now().strftime("%H:%M:%S")
+
+        if msg_type in ('system', 'private'):
+            template = TEMPLATES[msg_type]
+        elif sender == username:
+            template = TEMPLATES['mine']
+        else:
+            template = TEMPLATES['other']
+        return template.substitute(
+            time=time_str,
+            sender=sender,
+            message=message.get('message', ''),
+            attachments=self.attachments(message)
+        )
+
+    def attachments(self, message):
+        """图片和文件下载链接"""
+        parts = []
+        image_path = message.get('image_path', '')
+        image_hash = message.get('image_hash', '')
+        if image_path and (image_hash or os.path.exists(image_path)):
+            parts.append(IMAGE_TEMPLATE.substitute(src=thumbnail_url(image_path, image_hash)))
+        elif image_path:
+            print(f"[调试] 图片路径不存在: {image_path}")
+
+        file_name = message.get('file_name', '')
+        file_id = message.get('file_id', '')
+        file_path = message.get('file_path', '')
+        if file_id and file_name:
+            parts.append(LINK_TEMPLATE.substitute(href=f"download://{file_id}", name=file_name))
+        elif file_path and os.path.exists(file_path):
+            # 兼容旧的file_path格式
+            parts.append(LINK_TEMPLATE.substitute(href=f"file:///{file_url_path(file_path)}", name=file_name))
+        return ''.join(parts)
+
+    def clear(self):
+        self.fragments.clear()
@@ -9,6 +9,13 @@ import pickle
 import pyaudio
 import threading
 import time
+import struct
+import math
+import hashlib
+import shutil
+import re
+import bisect
+from collections import deque
 
 # 自动设置QT平台插件路径
 def set_qt_plugin_path():
@@ -31,7 +38,59 @@ from PyQt5.QtWidgets import (
     QProgressBar, QStackedWidget, QTabWidget
 )
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QSize, QDateTime, QMetaObject
-from PyQt5.QtGui import QFont, QIcon, QTextCursor, QPalette, QColor
+from PyQt5.QtGui import QFont, QIcon, QPalette, QColor
+
+from chat_protocol import JsonStreamDecoder, receive_message, COMPRESSION
+from client_cache import MessageCache, CHAT_ROOM, private_conversation, channel_conversation
+from client_chat_view import MessageListView
+from client_message_markup import MessageRenderer, LIGHT_STYLESHEET, DARK_STYLESHEET, THUMBNAIL_SCHEME, parse_thumbnail_url
+from client_thumbnails import ThumbnailService
+from client_upload import ChunkedUpload, UPLOAD_RETRIES, UPLOAD_RETRY_DELAY_MS
+from client_bulk import BulkTransferThread
+
+class VoiceLatencyStats:
+    """语音端到端延迟统计（所有时间换算到服务器时钟）"""
+    COMPONENTS = ('mouth_to_ear', 'uplink', 'server', 'downlink', 'playout')
+    
+    def __init__(self, max_samples=500):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """清空统计（每次通话开始时调用）"""
+        with self.lock:
+            self.samples = {name: deque(maxlen=self.max_samples) for name in self.COMPONENTS}
+    
+    def add(self, **components):
+        """记录一帧的各段延迟（秒）"""
+        with self.lock:
+            for name, value in components.items():
+                if value is not None:
+                    self.samples[name].append(value)
+    
+    def percentile(self, name, p):
+        """按最近秩法计算百分位数，没有样本时返回 None"""
+        with self.lock:
+            values = sorted(self.samples[name])
+        if not values:
+            return None
+        index = min(len(values) - 1, max(0, math.ceil(p / 100.0 * len(values)) - 1))
+        return values[index]
+    
+    def count(self, name='mouth_to_ear'):
+        with self.lock:
+            return len(self.samples[name])
+    
+    def summary_text(self):
+        """生成在通话对话框中显示的文字"""
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.0f}"
+        
+        total = [ms(self.percentile('mouth_to_ear', p)) for p in (50, 95, 99)]
+        parts = [ms(self.percentile(name, 50)) for name in ('uplink', 'server', 'downlink', 'playout')]
+        return (f"端到端延迟 p50/p95/p99: {'/'.join(total)} ms\n"
+                f"采集→服务器 {parts[0]} | 转发 {parts[1]} | 下行 {parts[2]} | 播放 {parts[3]} ms")
 
 class VoiceClient(QThread):
     """语音客户端类 - 修复版本"""
@@ -77,6 +136,95 @@ class VoiceClient(QThread):
         # 线程同步
         self.audio_lock = threading.Lock()
         self.state_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        
+        # 延迟测量：帧序号、时钟偏移（服务器时间 - 本地时间）估计
+        self.audio_seq = 0
+        self.clock_offset = None
+        self.clock_samples = deque(maxlen=8)  # (rtt, offset)
+        self.latency_stats = VoiceLatencyStats()
+        self.ping_thread = None
+        self.PING_INTERVAL = 2.0
+        self.LATENCY_REPORT_EVERY = 5  # 每隔几次ping上报一次延迟
+        
+        # 会话恢复：连接意外断开（或连续 SILENCE_TIMEOUT 秒没有收到任何数据）时，
+        # 在服务器保留会话的时间内带令牌自动重连，通话和房间不用重新建立
+        self.resume_token = None
+        self.resume_grace = 20
+        self.RECONNECT_DELAY = 1.0
+        self.SILENCE_TIMEOUT = self.PING_INTERVAL * 3
+        self.last_received = time.time()
+    
+    def send_command(self, command):
+        """序列化并发送一条带长度前缀的语音命令"""
+        cmd = pickle.dumps(command)
+        length_prefix = struct.pack('>I', len(cmd))
+        with self.send_lock:
+            self.voice_socket.sendall(length_prefix + cmd)
+    
+    def ping_loop(self):
+        """定期发送ping估计时钟偏移，并上报延迟统计"""
+        round_count = 0
+        while self.running and self.connected:
+            try:
+                self.send_command({'type': 'ping', 'client_ts': time.time()})
+                round_count += 1
+                if round_count % self.LATENCY_REPORT_EVERY == 0 and self.latency_stats.count():
+                    self.send_command({
+                        'type': 'latency_report',
+                        'p50': self.latency_stats.percentile('mouth_to_ear', 50),
+                        'p95': self.latency_stats.percentile('mouth_to_ear', 95),
+                        'p99': self.latency_stats.percentile('mouth_to_ear', 99)
+                    })
+            except Exception as e:
+                if self.running:
+                    print(f"[语音] 发送ping失败: {e}")
+                break
+            
+            # 分段睡眠，断开时能尽快退出
+            deadline = time.time() + self.PING_INTERVAL
+            while self.running and self.connected and time.time() < deadline:
+                time.sleep(0.1)
+    
+    def handle_pong(self, command):
+        """根据 pong 更新时钟偏移估计（取最近几次中 RTT 最小的样本）"""
+        t0 = command.get('client_ts')
+        server_ts = command.get('server_ts')
+        t3 = command.get('client_rx_ts', time.time())
+        if t0 is None or server_ts is None:
+            return
+        rtt = t3 - t0
+        offset = server_ts - (t0 + t3) / 2.0
+        self.clock_samples.append((rtt, offset))
+        self.clock_offset = min(self.clock_samples)[1]
+    
+    def record_playout(self, command, playout_ts):
+        """记录一帧音频的各段延迟"""
+        capture_ts = command.get('capture_ts')
+        sender_offset = command.get('clock_offset')
+        server_rx_ts = command.get('server_rx_ts')
+        server_tx_ts = command.get('server_tx_ts')
+        client_rx_ts = command.get('client_rx_ts')
+        if capture_ts is None or server_rx_ts is None or server_tx_ts is None:
+            return
+        
+        my_offset = self.clock_offset
+        uplink = mouth_to_ear = downlink = None
+        if sender_offset is not None:
+            uplink = server_rx_ts - (capture_ts + sender_offset)
+            if my_offset is not None:
+                mouth_to_ear = (playout_ts + my_offset) - (capture_ts + sender_offset)
+        if my_offset is not None and client_rx_ts is not None:
+            downlink = (client_rx_ts + my_offset) - server_tx_ts
+        playout = playout_ts - client_rx_ts if client_rx_ts is not None else None
+        
+        self.latency_stats.add(
+            mouth_to_ear=mouth_to_ear,
+            uplink=uplink,
+            server=server_tx_ts - server_rx_ts,
+            downlink=downlink,
+            playout=playout
+        )
         
     def connect(self):
         """连接到语音服务器"""
@@ -86,17 +234,8 @@ class VoiceClient(QThread):
             # 清理现有连接
             self.disconnect()
             
-            # 创建新连接
-            self.voice_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.voice_socket.settimeout(5)
-            self.voice_socket.connect((self.host, self.port))
-            self.voice_socket.settimeout(None)
-            
-            # 发送用户名
-            username_data = self.username.encode()
-            import struct
-            length_prefix = struct.pack('>I', len(username_data))
-            self.voice_socket.sendall(length_prefix + username_data)
+            # 创建新连接并发送用户名
+            self.voice_socket = self.open_session()
             
             # 启动接收线程
             self.running = True
@@ -106,6 +245,8 @@ class VoiceClient(QThread):
             self.voice_thread.daemon = True
             self.voice_thread.start()
             
+            self.start_ping_thread()
+            
             print(f"[语音] 连接成功")
             return True
             
@@ -119,6 +260,54 @@ class VoiceClient(QThread):
             print(f"[语音] 连接失败: {e}")
             return False
     
+    def open_session(self):
+        """建立语音连接并发送用户名，有会话令牌时一并带上以恢复会话"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        try:
+            sock.connect((self.host, self.port))
+            hello = json.dumps({'username': self.username, 'resume_token': self.resume_token}).encode()
+            sock.sendall(struct.pack('>I', len(hello)) + hello)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        self.last_received = time.time()
+        return sock
+    
+    def start_ping_thread(self):
+        if self.ping_thread and self.ping_thread.is_alive():
+            return
+        self.ping_thread = threading.Thread(target=self.ping_loop)
+        self.ping_thread.daemon = True
+        self.ping_thread.start()
+    
+    def resume_session(self):
+        """连接意外断开后在服务器保留会话的时间内带令牌重连，返回是否重新连上"""
+        if not self.running or not self.resume_token:
+            return False
+        self.connected = False
+        deadline = time.time() + self.resume_grace
+        while self.running and time.time() < deadline:
+            try:
+                sock = self.open_session()
+            except OSError as e:
+                print(f"[语音] 重连失败: {e}")
+                time.sleep(self.RECONNECT_DELAY)
+                continue
+            with self.send_lock:
+                old_socket, self.voice_socket = self.voice_socket, sock
+            try:
+                old_socket.close()
+            except:
+                pass
+            self.connected = True
+            self.start_ping_thread()
+            print("[语音] 已重新连接语音服务器")
+            return True
+        print("[语音] 重连超时")
+        return False
+    
     def receive_voice_commands(self):
         """接收语音命令"""
         while self.running and self.connected:
@@ -130,6 +319,8 @@ class VoiceClient(QThread):
                 length_prefix = self.voice_socket.recv(4)
                 if not length_prefix:
                     print("[语音] 服务器关闭连接")
+                    if self.resume_session():
+                        continue
                     self.connected = False
                     break
                 
@@ -154,6 +345,9 @@ class VoiceClient(QThread):
                     print(f"[语音] 数据不完整: 预期{data_length}, 实际{len(data)}")
                     continue
                 
+                received_at = time.time()
+                self.last_received = received_at
+                
                 # 反序列化命令
                 try:
                     command = pickle.loads(data)
@@ -162,15 +356,28 @@ class VoiceClient(QThread):
                     continue
                 
                 cmd_type = command.get('type')
+                command['client_rx_ts'] = received_at
+                if cmd_type == 'pong':
+                    self.handle_pong(command)
+                    continue
                 print(f"[语音] 收到命令: {cmd_type}")
                 
                 # 处理命令
                 self.process_voice_command(cmd_type, command)
                     
             except socket.timeout:
+                # 服务器每次 ping 都会应答，长时间收不到数据说明连接已经断了
+                if time.time() - self.last_received > self.SILENCE_TIMEOUT:
+                    print("[语音] 长时间没有收到服务器数据")
+                    if self.resume_session():
+                        continue
+                    self.connected = False
+                    break
                 continue
             except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
                 print(f"[语音] 连接错误: {e}")
+                if self.resume_session():
+                    continue
                 self.connected = False
                 break
             except Exception as e:
@@ -190,7 +397,22 @@ class VoiceClient(QThread):
         """处理语音命令"""
         try:
             print(f"[语音] 收到命令: {cmd_type}, 参数: {command}")
-            if cmd_type == 'incoming_call':
+            if cmd_type == 'session':
+                self.resume_token = command.get('token')
+                self.resume_grace = command.get('grace', self.resume_grace)
+                if command.get('resumed'):
+                    print("[语音] 会话已恢复")
+                else:
+                    # 服务器已经结束了旧会话：通话按对方挂断处理，语音房间重新加入
+                    with self.state_lock:
+                        partner = self.current_call_partner
+                        room = self.current_room if self.in_room else None
+                    if partner:
+                        self.process_voice_command('call_ended', {'user': partner})
+                    if room:
+                        self.send_command({'type': 'join_room', 'room_id': room})
+                        
+            elif cmd_type == 'incoming_call':
                 caller = command.get('caller')
                 print(f"[语音] 来电: {caller}")
                 # 发射信号代替回调
@@ -203,6 +425,7 @@ class VoiceClient(QThread):
                     self.current_call_partner = callee
                     self.in_call = True
                     self.is_call_accepted = True
+                self.latency_stats.reset()
                 # 启动音频流 - 无论是发起方还是接收方都需要启动
                 self.start_audio()
                 print(f"[语音] 音频流已启动 for {self.username}")
@@ -261,6 +484,9 @@ class VoiceClient(QThread):
                             return
                             
                         self.output_stream.write(audio_data)
+                        # write 返回时数据已进入设备缓冲，再加上设备输出延迟即为播放时刻
+                        playout_ts = time.time() + self.output_stream.get_output_latency()
+                        self.record_playout(command, playout_ts)
                     except (IOError, OSError) as e:
                         print(f"[语音] 播放音频失败: {e}")
                         # 发生错误时安全结束音频流，不尝试重新启动
@@ -430,6 +656,8 @@ class VoiceClient(QThread):
                             audio_data = self.input_stream.read(self.CHUNK, exception_on_overflow=False)
                             if not audio_data:
                                 continue
+                            # read 返回时这一帧刚采集完成
+                            capture_ts = time.time()
                             print(f"[语音] 录制音频数据，大小: {len(audio_data)} bytes")
                         except Exception as e:
                             print(f"[语音] 录制音频失败: {e}")
@@ -441,30 +669,28 @@ class VoiceClient(QThread):
                         room_active = self.in_room
                     
                     if (call_active and self.current_call_partner and audio_data) or (room_active and self.current_room and audio_data):
+                        self.audio_seq += 1
+                        cmd = {
+                            'type': 'audio_data',
+                            'audio_data': audio_data,
+                            'seq': self.audio_seq,
+                            'capture_ts': capture_ts,
+                            'clock_offset': self.clock_offset
+                        }
                         if call_active and self.current_call_partner:
-                            cmd = pickle.dumps({
-                                'type': 'audio_data',
-                                'audio_data': audio_data
-                            })
                             print(f"[语音] 发送音频数据到 {self.current_call_partner}, 大小: {len(audio_data)} bytes")
                         elif room_active and self.current_room:
-                            cmd = pickle.dumps({
-                                'type': 'audio_data',
-                                'room_id': self.current_room,
-                                'audio_data': audio_data
-                            })
+                            cmd['room_id'] = self.current_room
                             print(f"[语音] 发送音频数据到房间 {self.current_room}, 大小: {len(audio_data)} bytes")
                         
                         # 发送数据
-                        import struct
-                        length_prefix = struct.pack('>I', len(cmd))
-                        
                         if self.voice_socket and self.running:
                             try:
-                                self.voice_socket.sendall(length_prefix + cmd)
-                            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+                                self.send_command(cmd)
+                            except OSError as e:
+                                # 接收线程会带令牌重连，期间的音频帧直接丢弃
                                 print(f"[语音] 发送音频失败: {e}")
-                                break
+                                continue
                     else:
                         # 如果状态已经改变，立即退出循环
                         with self.state_lock:
@@ -529,15 +755,12 @@ class VoiceClient(QThread):
                 if self.in_room or self.in_call:
                     return False
                 
-                cmd = pickle.dumps({
+                self.send_command({
                     'type': 'join_room',
                     'room_id': room_id
                 })
                 
-                import struct
-                length_prefix = struct.pack('>I', len(cmd))
-                self.voice_socket.sendall(length_prefix + cmd)
-                
+                self.latency_stats.reset()
                 self.in_room = True
                 self.current_room = room_id
                 self.start_audio()
@@ -557,14 +780,10 @@ class VoiceClient(QThread):
                     return True
                 
                 if self.current_room:
-                    cmd = pickle.dumps({
+                    self.send_command({
                         'type': 'leave_room',
                         'room_id': self.current_room
                     })
-                    
-                    import struct
-                    length_prefix = struct.pack('>I', len(cmd))
-                    self.voice_socket.sendall(length_prefix + cmd)
                 
                 self.safe_end_audio()
                 self.in_room = False
@@ -584,15 +803,11 @@ class VoiceClient(QThread):
                 if self.in_call or self.in_room:
                     return False
                 
-                cmd = pickle.dumps({
+                self.send_command({
                     'type': 'start_private_call',
                     'callee': callee
                 })
                 
-                import struct
-                length_prefix = struct.pack('>I', len(cmd))
-                self.voice_socket.sendall(length_prefix + cmd)
-                
                 self.current_call_partner = callee
                 # 不要立即设置in_call=True，等待对方接受后再设置
                 # 只设置call_accepted=False表示正在等待响应
@@ -612,15 +827,12 @@ class VoiceClient(QThread):
                 if self.in_call or self.in_room:
                     return False
                 
-                cmd = pickle.dumps({
+                self.send_command({
                     'type': 'accept_call',
                     'caller': caller
                 })
                 
-                import struct
-                length_prefix = struct.pack('>I', len(cmd))
-                self.voice_socket.sendall(length_prefix + cmd)
-                
+                self.latency_stats.reset()
                 self.in_call = True
                 self.current_call_partner = caller
                 
@@ -636,15 +848,11 @@ class VoiceClient(QThread):
     def reject_call(self, caller):
         """拒绝通话"""
         try:
-            cmd = pickle.dumps({
+            self.send_command({
                 'type': 'reject_call',
                 'caller': caller
             })
             
-            import struct
-            length_prefix = struct.pack('>I', len(cmd))
-            self.voice_socket.sendall(length_prefix + cmd)
-            
             print(f"[语音] 拒绝通话: {caller}")
             return True
             
@@ -671,16 +879,9 @@ class VoiceClient(QThread):
                 
                 # 发送结束命令
                 if was_in_call:
-                    cmd = pickle.dumps({
-                        'type': 'end_call'
-                    })
-                    
-                    import struct
-                    length_prefix = struct.pack('>I', len(cmd))
-                    
                     if self.voice_socket and self.running:
                         try:
-                            self.voice_socket.sendall(length_prefix + cmd)
+                            self.send_command({'type': 'end_call'})
                             print("[语音] 已发送结束命令")
                         except Exception as e:
                             print(f"[语音] 发送结束命令失败: {e}")
@@ -709,6 +910,14 @@ class VoiceClient(QThread):
         # 关闭音频
         self.safe_end_audio()
         
+        # 主动退出，通知服务器不用保留会话
+        if self.voice_socket and self.connected:
+            try:
+                self.send_command({'type': 'bye'})
+            except:
+                pass
+        self.resume_token = None
+        
         # 关闭socket
         if self.voice_socket:
             try:
@@ -733,28 +942,19 @@ class ReceiveThread(QThread):
     error_occurred = pyqtSignal(str)
     connection_closed = pyqtSignal()
     
-    def __init__(self, socket):
+    def __init__(self, socket, decoder=None):
         super().__init__()
         self.socket = socket
         self.running = True
+        # 登录握手时可能已多收到后续消息，沿用同一个解码器
+        self.decoder = decoder if decoder is not None else JsonStreamDecoder()
     
     def receive_complete_message(self, sock):
         """接收完整的JSON消息"""
-        buffer = b""
-        while True:
-            try:
-                data = sock.recv(1024)
-                if not data:
-                    return None
-                
-                buffer += data
-                try:
-                    message = json.loads(buffer.decode())
-                    return message
-                except json.JSONDecodeError:
-                    continue
-            except:
-                return None
+        try:
+            return receive_message(sock, self.decoder)
+        except:
+            return None
 
     def run(self):
         try:
@@ -773,12 +973,21 @@ class ReceiveThread(QThread):
         self.running = False
 
 class UserListWidget(QWidget):
-    """用户列表组件"""
+    """用户列表组件：聊天室、语音聊天室两个固定项在最上面，已加入的文字频道排在聊天室下面，再下面是按用户名排序的在线用户
+    
+    在线用户变化时只插入、删除变化的项，不重建整个列表，选中项和滚动位置保持不变。
+    """
     user_clicked = pyqtSignal(str)
     voice_call_clicked = pyqtSignal(str)
     
+    HEADER_ROWS = 3  # 聊天室、语音聊天室、分隔线
+    
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.current_user = None
+        self.sort_keys = []  # 已显示用户的排序键（有序），与列表中的行一一对应
+        self.items = {}      # 用户名 -> QListWidgetItem
+        self.channels = []   # 已加入的频道（有序），显示在聊天室下面
         self.initUI()
         self.user_list.itemClicked.connect(self.on_user_clicked)
     
@@ -870,25 +1079,6 @@ class UserListWidget(QWidget):
         """)
         layout.addWidget(self.user_list)
         
-        # 连接按钮信号
-        self.join_room_btn.clicked.connect(self.join_voice_room)
-        self.leave_room_btn.clicked.connect(self.leave_voice_room)
-    
-    def join_voice_room(self):
-        self.voice_call_clicked.emit("join_room")
-    
-    def leave_voice_room(self):
-        self.voice_call_clicked.emit("leave_room")
-    
-    def update_users(self, users, current_user):
-        users_list = list(users)
-        
-        if current_user and current_user not in users_list:
-            users_list.append(current_user)
-        
-        self.title_label.setText(f"在线用户 ({len(users_list)})")
-        self.user_list.clear()
-        
         # 添加聊天室选项
         chat_room_item = QListWidgetItem("聊天室")
         chat_room_item.setForeground(Qt.blue)
@@ -906,15 +1096,99 @@ class UserListWidget(QWidget):
         separator_item.setSizeHint(QSize(10, 5))
         self.user_list.addItem(separator_item)
         
-        # 添加在线用户
-        for user in users_list:
-            item = QListWidgetItem(user)
-            if user == current_user:
-                item.setText(f"{user} (我)")
-                item.setForeground(Qt.green)
-            
-            item.setData(Qt.UserRole, user)
-            self.user_list.addItem(item)
+        # 连接按钮信号
+        self.join_room_btn.clicked.connect(self.join_voice_room)
+        self.leave_room_btn.clicked.connect(self.leave_voice_room)
+    
+    def join_voice_room(self):
+        self.voice_call_clicked.emit("join_room")
+    
+    def leave_voice_room(self):
+        self.voice_call_clicked.emit("leave_room")
+    
+    def sort_key(self, user):
+        """自己排在最前面，其他人按用户名排序"""
+        return (user != self.current_user, user.casefold(), user)
+    
+    def update_users(self, users, current_user):
+        """用完整的在线用户列表更新显示，只增删有变化的用户"""
+        if current_user != self.current_user:
+            # 换了登录用户，排序和“(我)”标记都要变，清空重来
+            for user in list(self.items):
+                self.remove_user(user)
+            self.current_user = current_user
+        
+        wanted = set(users)
+        if current_user:
+            wanted.add(current_user)
+        removed = [user for user in self.items if user not in wanted]
+        added = [user for user in wanted if user not in self.items]
+        
+        # 变化较多时（例如登录时收到完整列表）暂停重绘，改完一次性刷新
+        bulk = len(removed) + len(added) > 50
+        if bulk:
+            self.user_list.setUpdatesEnabled(False)
+        try:
+            for user in removed:
+                self.remove_user(user)
+            for user in added:
+                self.add_user(user)
+        finally:
+            if bulk:
+                self.user_list.setUpdatesEnabled(True)
+    
+    def add_user(self, user):
+        """按排序位置插入一个用户"""
+        if user in self.items:
+            return
+        key = self.sort_key(user)
+        index = bisect.bisect_left(self.sort_keys, key)
+        item = QListWidgetItem(user)
+        if user == self.current_user:
+            item.setText(f"{user} (我)")
+            item.setForeground(Qt.green)
+        item.setData(Qt.UserRole, user)
+        self.user_list.insertItem(self.user_row(index), item)
+        self.sort_keys.insert(index, key)
+        self.items[user] = item
+        self.update_title()
+    
+    def remove_user(self, user):
+        """删除一个用户"""
+        if self.items.pop(user, None) is None:
+            return
+        index = bisect.bisect_left(self.sort_keys, self.sort_key(user))
+        del self.sort_keys[index]
+        self.user_list.takeItem(self.user_row(index))
+        self.update_title()
+    
+    def user_row(self, index):
+        """第 index 个用户在列表中的行号"""
+        return self.HEADER_ROWS + len(self.channels) + index
+    
+    def add_channel(self, channel):
+        """按名称顺序在聊天室下面插入一个频道"""
+        if channel in self.channels:
+            return
+        index = bisect.bisect_left(self.channels, channel)
+        item = QListWidgetItem(channel)
+        item.setForeground(Qt.blue)
+        self.user_list.insertItem(1 + index, item)
+        self.channels.insert(index, channel)
+    
+    def remove_channel(self, channel):
+        if channel not in self.channels:
+            return
+        index = self.channels.index(channel)
+        del self.channels[index]
+        self.user_list.takeItem(1 + index)
+    
+    def usernames(self):
+        """按显示顺序返回在线用户名"""
+        return [key[2] for key in self.sort_keys]
+    
+    def update_title(self):
+        self.title_label.setText(f"在线用户 ({len(self.items)})")
 
 class VoiceCallDialog(QDialog):
     """语音通话对话框"""
@@ -931,7 +1205,7 @@ class VoiceCallDialog(QDialog):
         
     def initUI(self):
         self.setWindowTitle("语音通话")
-        self.setFixedSize(300, 200)
+        self.setFixedSize(320, 250)
         
         layout = QVBoxLayout(self)
         
@@ -966,6 +1240,18 @@ class VoiceCallDialog(QDialog):
         self.timer_label.hide()
         layout.addWidget(self.timer_label)
         
+        # 延迟标签
+        self.latency_label = QLabel("")
+        self.latency_label.setAlignment(Qt.AlignCenter)
+        self.latency_label.setStyleSheet("""
+            QLabel {
+                font-size: 11px;
+                color: #666;
+            }
+        """)
+        self.latency_label.hide()
+        layout.addWidget(self.latency_label)
+        
         # 按钮布局
         self.button_layout = QHBoxLayout()
         
@@ -1058,6 +1344,11 @@ class VoiceCallDialog(QDialog):
             minutes = elapsed // 60
             seconds = elapsed % 60
             self.timer_label.setText(f"{minutes:02d}:{seconds:02d}")
+        
+        # 刷新端到端延迟
+        voice_client = getattr(self.parent_window, 'voice_client', None)
+        if voice_client:
+            self.latency_label.setText(voice_client.latency_stats.summary_text())
     
     def accept_call(self):
         """接听电话（来电对话框）或确认通话接受（去电对话框）"""
@@ -1071,6 +1362,7 @@ class VoiceCallDialog(QDialog):
         # 更新信息标签
         self.info_label.setText(f"与 {self.caller} 通话中...")
         self.timer_label.show()
+        self.latency_label.show()
         self.start_timer()
         
         if self.is_incoming:
@@ -1145,7 +1437,6 @@ class ChatClient(QMainWindow):
         self.connection_status = False
         self.message_count = 0
         self.is_dark_theme = False
-        self.received_files = {}
         
         # 语音相关
         self.voice_client = None
@@ -1160,10 +1451,30 @@ class ChatClient(QMainWindow):
         self.audio_input_device_index = -1
         self.audio_output_device_index = -1
         
-        self.messages = {
-            "chat_room": [],
-            "private": {}
-        }
+        # 聊天记录保存在本地缓存中，登录后按用户打开对应的数据库
+        self.message_cache = MessageCache()
+        # 本次连接中已向服务器请求过聊天记录的会话（"chat_room" 或私聊对象）
+        self.history_requested = set()
+        self.history_loading = set()    # 正在等待服务器应答的会话
+        self.history_exhausted = set()  # 服务器上已没有更早记录的会话
+        self.attachment_requests = {}    # (附件哈希, 保存路径) -> 等待的回调
+        self.uploads = {}                # file_id -> 未完成的分块上传
+        self.upload_conversations = {}   # file_id -> 发送时所在的会话，算好文件哈希后在这里显示
+        self.bulk_port = None            # 附件传输端口及令牌（登录时由服务器下发）
+        self.bulk_token = None
+        self.bulk_threads = set()
+        self.online_users = set()        # 在线用户，登录时服务器推送完整列表，之后按版本号应用增量
+        self.channels = set()            # 已加入的文字频道（不含默认的聊天室）
+        self.presence_version = 0
+        self.heartbeat_timer = QTimer()  # 登录后按服务器下发的间隔发送心跳
+        self.heartbeat_timer.timeout.connect(self.send_heartbeat)
+        
+        # 断线重连：服务器推送的消息带递增的序号，重连时带上恢复令牌和最后收到的序号，只补发错过的消息
+        self.resume_token = None
+        self.last_seq = 0
+        self.resume_attempts = 0
+        self.RESUME_ATTEMPTS = 5
+        self.RESUME_DELAY_MS = 2000
         
         self.initUI()
     
@@ -1295,10 +1606,14 @@ class ChatClient(QMainWindow):
         """)
         message_layout = QVBoxLayout(message_group)
         
-        self.message_area = QTextBrowser()
-        self.message_area.setReadOnly(True)
+        # 虚拟化的消息视图，只绘制可见的消息
+        self.message_renderer = MessageRenderer()
+        # 图片缩略图在后台线程生成，生成前显示占位图
+        self.thumbnails = ThumbnailService(os.path.join(os.getcwd(), 'thumbnails'), parent=self)
+        self.thumbnails.thumbnailReady.connect(self.on_thumbnail_ready)
+        self.message_area = MessageListView(self.format_message_html, LIGHT_STYLESHEET, self.load_message_resource)
         self.message_area.setStyleSheet("""
-            QTextBrowser {
+            QListView {
                 background-color: #fafafa;
                 border: 1px solid #d4b88c;
                 border-radius: 8px;
@@ -1307,9 +1622,9 @@ class ChatClient(QMainWindow):
                 selection-background-color: #8b4513;
             }
         """)
-        self.message_area.setLineWrapMode(QTextBrowser.WidgetWidth)
         self.message_area.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         self.message_area.anchorClicked.connect(self.handle_anchor_click)
+        self.message_area.verticalScrollBar().valueChanged.connect(self.on_message_scroll)
         message_layout.addWidget(self.message_area)
         
         chat_layout.addWidget(message_group)
@@ -1493,17 +1808,13 @@ class ChatClient(QMainWindow):
         
         self.chat_mode = "chat_room"
         self.current_chat_partner = None
+        self.current_channel = None
         splitter.setSizes([750, 250])
         
         main_layout.addWidget(splitter)
         
         # 创建系统托盘图标
         self.createSystemTray()
-        
-        # 初始化定时器
-        self.user_refresh_timer = QTimer(self)
-        self.user_refresh_timer.timeout.connect(self.show_online_users)
-        self.user_refresh_timer.start(5000)
     
     def createMenuBar(self):
         """创建菜单栏"""
@@ -1557,6 +1868,17 @@ class ChatClient(QMainWindow):
         exit_action.triggered.connect(self.close)
         file_menu.addAction(exit_action)
         
+        # 频道菜单
+        channel_menu = menubar.addMenu('频道')
+        
+        join_channel_action = QAction('加入频道', self)
+        join_channel_action.triggered.connect(self.join_channel)
+        channel_menu.addAction(join_channel_action)
+        
+        leave_channel_action = QAction('离开当前频道', self)
+        leave_channel_action.triggered.connect(self.leave_channel)
+        channel_menu.addAction(leave_channel_action)
+        
         # 语音菜单
         voice_menu = menubar.addMenu('语音')
         
@@ -1671,8 +1993,8 @@ class ChatClient(QMainWindow):
         self.voice_status.setStyleSheet(f"color: {color}; font-weight: bold; padding: 5px;")
         self.voice_status_label.setText(icon)
     
-    def connect_to_server(self):
-        """连接到服务器"""
+    def connect_to_server(self, resume=False):
+        """连接到服务器；resume 为 True 时用上次的用户名和恢复令牌断线重连，失败时不弹窗，返回是否连接成功"""
         try:
             self.update_connection_status(False)
             
@@ -1688,94 +2010,135 @@ class ChatClient(QMainWindow):
                 self.receive_thread.stop()
                 self.receive_thread = None
             
-            # 创建新连接
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            
-            try:
-                sock.connect((self.host, self.port))
-                sock.settimeout(None)
-                
-                # 获取用户名
+            if resume:
+                username = self.username
+            else:
+                # 先获取用户名再连接，服务器要求连接后很快发来用户名
                 username, ok = QInputDialog.getText(
                     self, "用户名", "请输入用户名:", QLineEdit.Normal, ""
                 )
                 if not ok:
-                    sock.close()
-                    return
+                    return False
                 
                 username = username.strip()
                 if not username:
                     QMessageBox.warning(self, "警告", "用户名不能为空")
-                    sock.close()
-                    return
+                    return False
+            
+            # 创建新连接
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            
+            try:
+                sock.connect((self.host, self.port))
+                sock.settimeout(None)
                 
-                # 发送用户名
-                sock.sendall(json.dumps({'username': username}).encode())
+                # 发送用户名，并告知服务器可以压缩发来的消息（解码器自动解压）；
+                # 断线重连时带上恢复令牌和最后收到的消息序号，服务器补发错过的消息
+                hello = {'username': username, 'compression': [COMPRESSION]}
+                if resume:
+                    hello.update(resume_token=self.resume_token, last_seq=self.last_seq)
+                sock.sendall(json.dumps(hello).encode())
                 
                 # 接收响应
-                buffer = b""
-                while True:
-                    data = sock.recv(1024)
-                    if not data:
-                        QMessageBox.warning(self, "错误", "连接失败")
-                        sock.close()
-                        return
+                decoder = JsonStreamDecoder()
+                resp_data = receive_message(sock, decoder)
+                if not resp_data:
+                    self.show_connect_error("错误", "连接失败", resume)
+                    sock.close()
+                    return False
+                
+                if resp_data.get('status') == 'success':
+                    self.username = username
+                    self.user_label.setText(f"用户: {username}")
+                    self.socket = sock
+                    self.resume_token = resp_data.get('resume_token')
+                    self.resume_attempts = 0
+                    if not resp_data.get('resumed'):
+                        self.last_seq = resp_data.get('seq', 0)
+                        for channel in list(self.channels):
+                            self.on_channel_left(channel)
                     
-                    buffer += data
-                    try:
-                        resp_data = json.loads(buffer.decode())
-                        
-                        if resp_data.get('status') == 'success':
-                            self.username = username
-                            self.user_label.setText(f"用户: {username}")
-                            self.socket = sock
-                            
-                            # 获取语音服务器端口
-                            self.voice_port = resp_data.get('voice_port', 8889)
-                            
-                            # 连接到语音服务器
-                            self.connect_to_voice_server()
-                            
-                            # 启动接收线程
-                            self.receive_thread = ReceiveThread(self.socket)
-                            self.receive_thread.message_received.connect(self.handle_server_message)
-                            self.receive_thread.error_occurred.connect(self.handle_error)
-                            self.receive_thread.connection_closed.connect(self.on_connection_closed)
-                            self.receive_thread.start()
-                            
-                            self.update_connection_status(True)
-                            self.display_message({
-                                'sender': "系统",
-                                'message': resp_data.get('message', '连接成功'),
-                                'type': 'system',
-                                'timestamp': datetime.datetime.now().isoformat()
-                            })
-                            
-                            self.user_list_widget.update_users([], self.username)
-                            self.show_online_users()
-                            
-                            return
-                        else:
-                            error_msg = resp_data.get('message', '连接失败')
-                            QMessageBox.warning(self, "错误", error_msg)
-                            sock.close()
-                            return
-                    except json.JSONDecodeError:
-                        continue
-                            
+                    # 打开本地聊天记录并显示上次的内容
+                    self.open_message_cache()
+                    self.render_conversation(self.current_conversation())
+                    
+                    # 获取语音服务器端口
+                    self.voice_port = resp_data.get('voice_port', 8889)
+                    
+                    # 附件上传下载走单独的端口
+                    self.bulk_port = resp_data.get('bulk_port')
+                    self.bulk_token = resp_data.get('bulk_token')
+                    
+                    # 连接到语音服务器（断线重连时语音连接自己恢复）
+                    if not (resume and self.voice_client):
+                        self.connect_to_voice_server()
+                    
+                    # 启动接收线程
+                    self.receive_thread = ReceiveThread(self.socket, decoder)
+                    self.receive_thread.message_received.connect(self.handle_server_message)
+                    self.receive_thread.error_occurred.connect(self.handle_error)
+                    self.receive_thread.connection_closed.connect(self.on_connection_closed)
+                    self.receive_thread.start()
+                    
+                    self.update_connection_status(True)
+                    
+                    # 按服务器要求的间隔发送心跳，长时间没有消息的连接会被服务器断开
+                    heartbeat_interval = resp_data.get('heartbeat_interval')
+                    if heartbeat_interval:
+                        self.heartbeat_timer.start(int(heartbeat_interval * 1000))
+                    
+                    self.display_message({
+                        'sender': "系统",
+                        'message': "已重新连接服务器" if resp_data.get('resumed') else resp_data.get('message', '连接成功'),
+                        'type': 'system',
+                        'timestamp': datetime.datetime.now().isoformat()
+                    })
+                    
+                    # 在线用户列表由服务器在登录后推送
+                    self.online_users = set()
+                    self.presence_version = 0
+                    self.user_list_widget.update_users([], self.username)
+                    
+                    # 只拉取聊天室最近一页记录
+                    self.history_requested = set()
+                    self.history_loading = set()
+                    self.history_exhausted = set()
+                    self.attachment_requests = {}
+                    self.request_history("chat_room")
+                    self.resume_uploads()
+                    
+                    # 重新上线后服务器不再保留频道，重新加入
+                    for channel in sorted(self.channels - set(resp_data.get('channels') or [])):
+                        self.send_channel_command('join_channel', channel)
+                    
+                    return True
+                else:
+                    error_msg = resp_data.get('message', '连接失败')
+                    self.show_connect_error("错误", error_msg, resume)
+                    sock.close()
+                    return False
+            
             except socket.timeout:
-                QMessageBox.critical(self, "连接错误", "连接超时")
+                self.show_connect_error("连接错误", "连接超时", resume)
                 sock.close()
             except ConnectionRefusedError:
-                QMessageBox.critical(self, "连接错误", "无法连接到服务器")
+                self.show_connect_error("连接错误", "无法连接到服务器", resume)
                 sock.close()
             except Exception as e:
-                QMessageBox.warning(self, "错误", f"连接失败: {str(e)}")
+                self.show_connect_error("错误", f"连接失败: {str(e)}", resume)
                 sock.close()
                 
         except Exception as e:
-            QMessageBox.critical(self, "连接错误", f"连接过程中发生错误: {str(e)}")
+            self.show_connect_error("连接错误", f"连接过程中发生错误: {str(e)}", resume)
+        return False
+    
+    def show_connect_error(self, title, text, quiet=False):
+        """提示连接失败；自动重连时只打印，不弹窗"""
+        if quiet:
+            print(f"[错误] 重连失败: {text}")
+        else:
+            QMessageBox.warning(self, title, text)
     
     def connect_to_voice_server(self):
         """连接到语音服务器"""
@@ -2017,6 +2380,13 @@ class ChatClient(QMainWindow):
         """处理来自服务器的消息"""
         msg_type = message_data.get('type', 'broadcast')
         
+        # 断线重连补发的消息可能与已经收到的重叠
+        seq = message_data.get('seq')
+        if seq is not None:
+            if seq <= self.last_seq:
+                return
+            self.last_seq = seq
+        
         if msg_type == 'system':
             msg = {
                 'sender': "系统",
@@ -2024,7 +2394,7 @@ class ChatClient(QMainWindow):
                 'type': 'system',
                 'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat())
             }
-            self.messages["chat_room"].append(msg)
+            self.message_cache.append(CHAT_ROOM, msg)
             
             if self.chat_mode == "chat_room":
                 self.display_message(msg)
@@ -2054,12 +2424,12 @@ class ChatClient(QMainWindow):
                 'sender': sender,
                 'message': message_data.get('message', ''),
                 'type': 'private',
-                'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat())
+                'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
+                'id': message_data.get('id')
             }
             
-            if sender not in self.messages["private"]:
-                self.messages["private"][sender] = []
-            self.messages["private"][sender].append(msg)
+            if not self.message_cache.append(private_conversation(sender), msg):
+                return
             
             if self.chat_mode == "private" and self.current_chat_partner == sender:
                 self.display_message(msg)
@@ -2073,6 +2443,23 @@ class ChatClient(QMainWindow):
                 
         elif msg_type == 'private_sent':
             target = message_data.get('target', '')
+            if target and message_data.get('id') is not None:
+                # 自己发出的私聊消息或附件的回执：发送时已经显示过，这里只按服务器 id 存入缓存；
+                # 附件发送时已缓存了带下载信息的一条，给它补上 id，找不到时再按文字存一条
+                conversation = private_conversation(target)
+                digest = message_data.get('hash')
+                if digest and self.message_cache.assign_server_id(conversation, digest, message_data['id']):
+                    return
+                msg = {
+                    'sender': self.username,
+                    'message': message_data.get('content', ''),
+                    'type': 'private',
+                    'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
+                    'id': message_data['id']
+                }
+                if self.message_cache.append(conversation, msg) and digest and self.current_conversation() == conversation:
+                    self.display_message(msg)
+                return
             msg = {
                 'sender': "系统",
                 'message': message_data.get('message', ''),
@@ -2080,34 +2467,52 @@ class ChatClient(QMainWindow):
                 'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat())
             }
             
-            if target not in self.messages["private"]:
-                self.messages["private"][target] = []
-            self.messages["private"][target].append(msg)
+            if target:
+                self.message_cache.append(private_conversation(target), msg)
             
             if self.chat_mode == "private" and self.current_chat_partner == target:
                 self.display_message(msg)
                 
         elif msg_type == 'users':
-            users = message_data.get('users', [])
-            self.user_list_widget.update_users(users, self.username)
+            self.set_online_users(message_data.get('users', []), message_data.get('version', self.presence_version))
+            
+        elif msg_type == 'presence':
+            self.apply_presence(message_data)
+            
+        elif msg_type == 'history':
+            self.merge_history(message_data)
+            
+        elif msg_type == 'attachment_data':
+            self.on_attachment_data(message_data)
             
         elif msg_type in ['broadcast', 'message']:
             msg = {
                 'sender': message_data.get('sender', '未知'),
                 'message': message_data.get('message', ''),
                 'type': 'broadcast',
-                'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat())
+                'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
+                'id': message_data.get('id')
             }
-            self.messages["chat_room"].append(msg)
+            channel = message_data.get('channel')
+            key = channel_conversation(channel) if channel else CHAT_ROOM
+            if not self.message_cache.append(key, msg):
+                return
             
-            if self.chat_mode == "chat_room":
+            if self.current_conversation() == key:
                 self.display_message(msg)
         
+        elif msg_type == 'channel_joined':
+            self.on_channel_joined(message_data.get('channel'), message_data.get('members', 0))
+        
+        elif msg_type == 'channel_left':
+            self.on_channel_left(message_data.get('channel'))
+        
         elif msg_type == 'file_receive':
             sender = message_data.get('sender', '未知')
             file_name = message_data.get('file_name', '未知文件')
             file_size = message_data.get('file_size', 0)
             file_content = message_data.get('file_content', '')
+            file_hash = message_data.get('file_hash', '')
             private = message_data.get('private', False)
             
             # 如果是自己发送的文件，跳过显示（避免重复）
@@ -2115,20 +2520,19 @@ class ChatClient(QMainWindow):
                 print(f"[文件] 收到自己发送的文件，跳过显示: {file_name}")
                 return
             
-            # 处理文件（不预加载到磁盘，存储到内存字典）
+            # 记录文件信息；服务器只发来内容哈希，点击下载时再按哈希获取内容
             try:
-                # 生成唯一文件ID
-                import uuid
-                file_id = str(uuid.uuid4())
+                if file_hash:
+                    file_id = file_hash
+                else:
+                    import uuid
+                    file_id = str(uuid.uuid4())
                 
-                # 存储文件元数据到内存字典
-                self.received_files[file_id] = {
-                    'file_name': file_name,
-                    'file_size': file_size,
-                    'file_content': file_content,
-                    'sender': sender,
-                    'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat())
-                }
+                self.message_cache.save_file(
+                    file_id, file_name, file_size, sender,
+                    message_data.get('timestamp', datetime.datetime.now().isoformat()),
+                    base64.b64decode(file_content) if file_content else None
+                )
                 
                 # 显示文件接收消息
                 message = f"发送了文件: {file_name} ({self.format_file_size(file_size)})"
@@ -2136,15 +2540,14 @@ class ChatClient(QMainWindow):
                     target = message_data.get('target', '')
                     # 对于接收者，应该将消息存储在发送者对应的字典键下，而不是目标用户（自己）
                     # 这样在切换到与发送者的聊天界面时才能看到消息
-                    if sender not in self.messages["private"]:
-                        self.messages["private"][sender] = []
-                    self.messages["private"][sender].append({
+                    self.message_cache.append(private_conversation(sender), {
                         'sender': sender,
                         'message': message,
                         'type': 'private',
                         'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
                         'file_id': file_id,
-                        'file_name': file_name
+                        'file_name': file_name,
+                        'id': message_data.get('id')
                     })
                     
                     if self.chat_mode == "private" and self.current_chat_partner == sender:
@@ -2157,7 +2560,7 @@ class ChatClient(QMainWindow):
                             'file_name': file_name
                         })
                 else:
-                    self.messages["chat_room"].append({
+                    self.message_cache.append(CHAT_ROOM, {
                         'sender': sender,
                         'message': message,
                         'type': 'broadcast',
@@ -2183,6 +2586,7 @@ class ChatClient(QMainWindow):
             sender = message_data.get('sender', '未知')
             image_name = message_data.get('image_name', '未知图片')
             image_content = message_data.get('image_content', '')
+            image_hash = message_data.get('image_hash', '')
             private = message_data.get('private', False)
             
             # 如果是自己发送的图片，跳过显示（避免重复）
@@ -2197,10 +2601,13 @@ class ChatClient(QMainWindow):
                 if not os.path.exists(save_dir):
                     os.makedirs(save_dir)
                 
-                # 保存图片
-                image_path = os.path.join(save_dir, image_name)
-                with open(image_path, 'wb') as f:
-                    f.write(base64.b64decode(image_content))
+                # 服务器只发来内容哈希时，图片在需要显示时才下载到这个路径
+                if image_hash:
+                    image_path = os.path.join(save_dir, f"{image_hash[:16]}_{os.path.basename(image_name)}")
+                else:
+                    image_path = os.path.join(save_dir, image_name)
+                    with open(image_path, 'wb') as f:
+                        f.write(base64.b64decode(image_content))
                 
                 # 显示图片接收消息
                 message = f"发送了图片: {image_name}"
@@ -2208,15 +2615,15 @@ class ChatClient(QMainWindow):
                     target = message_data.get('target', '')
                     # 对于接收者，应该将消息存储在发送者对应的字典键下，而不是目标用户（自己）
                     # 这样在切换到与发送者的聊天界面时才能看到消息
-                    if sender not in self.messages["private"]:
-                        self.messages["private"][sender] = []
-                    self.messages["private"][sender].append({
+                    self.message_cache.append(private_conversation(sender), {
                         'sender': sender,
                         'message': message,
                         'type': 'private',
                         'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
                         'image_path': image_path,
-                        'image_name': image_name
+                        'image_hash': image_hash,
+                        'image_name': image_name,
+                        'id': message_data.get('id')
                     })
                     
                     if self.chat_mode == "private" and self.current_chat_partner == sender:
@@ -2226,6 +2633,7 @@ class ChatClient(QMainWindow):
                             'type': 'private',
                             'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
                             'image_path': image_path,
+                            'image_hash': image_hash,
                             'image_name': image_name
                         })
                     else:
@@ -2236,12 +2644,13 @@ class ChatClient(QMainWindow):
                             'timestamp': datetime.datetime.now().isoformat()
                         })
                 else:
-                    self.messages["chat_room"].append({
+                    self.message_cache.append(CHAT_ROOM, {
                         'sender': sender,
                         'message': message,
                         'type': 'broadcast',
                         'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
                         'image_path': image_path,
+                        'image_hash': image_hash,
                         'image_name': image_name
                     })
                     
@@ -2252,158 +2661,266 @@ class ChatClient(QMainWindow):
                             'type': 'broadcast',
                             'timestamp': message_data.get('timestamp', datetime.datetime.now().isoformat()),
                             'image_path': image_path,
+                            'image_hash': image_hash,
                             'image_name': image_name
                         })
             except Exception as e:
                 print(f"[错误] 保存图片失败: {e}")
                 QMessageBox.warning(self, "错误", f"保存图片失败: {str(e)}")
     
-    def display_message(self, message_data):
-        """显示消息到聊天区域"""
-        sender = message_data.get('sender', '未知')
-        message = message_data.get('message', '')
-        msg_type = message_data.get('type', 'broadcast')
-        timestamp = message_data.get('timestamp', datetime.datetime.now().isoformat())
+    def open_message_cache(self):
+        """按服务器地址和用户名打开本地聊天记录数据库"""
+        name = re.sub(r'[^\w.-]', '_', f"{self.host}_{self.port}_{self.username}")
+        path = os.path.join(os.getcwd(), 'chat_cache', f"{name}.db")
+        if self.message_cache.path != path:
+            self.message_cache.close()
+            self.message_cache = MessageCache(path)
+            self.message_renderer.clear()
+    
+    def current_conversation(self):
+        """当前显示的会话键"""
+        if self.chat_mode == "private" and self.current_chat_partner:
+            return private_conversation(self.current_chat_partner)
+        if self.chat_mode == "channel" and self.current_channel:
+            return channel_conversation(self.current_channel)
+        return CHAT_ROOM
+    
+    def render_conversation(self, conversation):
+        """切换聊天区域到某个会话的最近一段消息，更早的在向上滚动时加载"""
+        messages = self.message_cache.start_view(conversation)
+        self.message_area.set_messages(messages)
+        self.message_count = len(messages)
+        self.message_counter.setText(f"消息: {self.message_count}")
+    
+    def on_message_scroll(self, value):
+        """滚动到顶部时加载更早的消息"""
+        scrollbar = self.message_area.verticalScrollBar()
+        if value == scrollbar.minimum() and scrollbar.maximum() > scrollbar.minimum():
+            self.load_older_messages()
+    
+    def load_older_messages(self):
+        """先从本地缓存向前翻一页，本地没有时再向服务器请求"""
+        conversation = self.current_conversation()
+        older = self.message_cache.older(conversation)
+        if older:
+            self.prepend_messages(older)
+            return
         
-        try:
-            dt = datetime.datetime.fromisoformat(timestamp)
-            time_str = dt.strftime("%H:%M:%S")
-        except:
-            time_str = datetime.datetime.now().strftime("%H:%M:%S")
-        
-        # 处理图片和文件
-        image_path = message_data.get('image_path', '')
-        file_path = message_data.get('file_path', '')
-        file_name = message_data.get('file_name', '')
-        
-        # 导入URL编码模块
-        import urllib.parse
-        
-        # 生成图片HTML
-        if image_path and os.path.exists(image_path):
-            # 修复Windows路径格式并进行URL编码
-            fixed_image_path = image_path.replace('\\', '/')
-            encoded_image_path = urllib.parse.quote(fixed_image_path)
-            image_html = f"<div style='margin-top: 5px;'><img src='file:///{encoded_image_path}' style='max-width: 300px; max-height: 200px; border: 1px solid #ddd; padding: 2px; border-radius: 5px;'></div>"
-            print(f"[调试] 显示图片: {image_path}, 编码后路径: file:///{encoded_image_path}")
+        if conversation == CHAT_ROOM:
+            name = "chat_room"
+        elif self.chat_mode == "channel":
+            name = self.current_channel
         else:
-            image_html = ""
-            if image_path:
-                print(f"[调试] 图片路径不存在: {image_path}")
-        
-        # 生成文件下载链接（使用download://协议）
-        file_id = message_data.get('file_id', '')
-        if file_id and file_name:
-            # 使用file_id生成download://链接
-            file_html = f"<div style='margin-top: 5px;'><a href='download://{file_id}' style='background-color: #3498db; color: white; text-decoration: none; padding: 5px 10px; border-radius: 3px; font-size: 0.9em; display: inline-block;'>下载文件: {file_name}</a></div>"
-            print(f"[调试] 显示文件下载链接: download://{file_id}, 文件名: {file_name}")
-        elif file_path and os.path.exists(file_path):
-            # 兼容旧的file_path格式
-            fixed_file_path = file_path.replace('\\', '/')
-            encoded_file_path = urllib.parse.quote(fixed_file_path)
-            file_html = f"<div style='margin-top: 5px;'><a href='file:///{encoded_file_path}' style='background-color: #3498db; color: white; text-decoration: none; padding: 5px 10px; border-radius: 3px; font-size: 0.9em; display: inline-block;'>下载文件: {file_name}</a></div>"
-            print(f"[调试] 显示文件下载链接: {file_path}, 编码后路径: file:///{encoded_file_path}")
+            name = self.current_chat_partner
+        if name not in self.history_exhausted and name not in self.history_loading:
+            self.request_history(name, before=self.message_cache.oldest_server_id(conversation))
+    
+    def prepend_messages(self, messages):
+        """把更早的消息插到聊天区域顶部，并保持当前看到的位置不动"""
+        self.message_area.prepend_messages(messages)
+        self.message_count += len(messages)
+        self.message_counter.setText(f"消息: {self.message_count}")
+    
+    def join_channel(self):
+        """输入频道名加入文字频道"""
+        if not self.connection_status:
+            QMessageBox.warning(self, "警告", "未连接到服务器")
+            return
+        channel, ok = QInputDialog.getText(self, "加入频道", "频道名（以 # 开头）:", QLineEdit.Normal, "#")
+        channel = channel.strip()
+        if ok and channel:
+            self.send_channel_command('join_channel', channel if channel.startswith('#') else f"#{channel}")
+    
+    def leave_channel(self):
+        """离开当前显示的频道"""
+        if self.chat_mode == "channel" and self.current_channel:
+            self.send_channel_command('leave_channel', self.current_channel)
+    
+    def send_channel_command(self, command, channel):
+        try:
+            self.socket.sendall(json.dumps({'type': command, 'channel': channel}).encode())
+        except Exception as e:
+            print(f"[错误] 发送频道命令失败: {e}")
+    
+    def on_channel_joined(self, channel, members):
+        """服务器确认加入频道：加到列表中并切换过去"""
+        self.channels.add(channel)
+        self.user_list_widget.add_channel(channel)
+        self.show_channel(channel)
+        self.display_message({
+            'sender': "系统",
+            'message': f"已加入频道 {channel}，当前 {members} 人",
+            'type': 'system',
+            'timestamp': datetime.datetime.now().isoformat()
+        })
+    
+    def on_channel_left(self, channel):
+        self.channels.discard(channel)
+        self.user_list_widget.remove_channel(channel)
+        if self.chat_mode == "channel" and self.current_channel == channel:
+            self.on_user_clicked("聊天室")
+    
+    def show_channel(self, channel):
+        """切换聊天区域到某个频道，首次打开时拉取聊天记录"""
+        self.chat_mode = "channel"
+        self.current_channel = channel
+        self.current_chat_partner = None
+        self.title_label.setText(f"频道 - {channel}")
+        self.render_conversation(channel_conversation(channel))
+        if channel not in self.history_requested:
+            self.request_history(channel)
+    
+    def send_heartbeat(self):
+        """发送心跳，让服务器知道连接仍然有效"""
+        if not self.socket or not self.connection_status:
+            return
+        try:
+            self.socket.sendall(json.dumps({'type': 'heartbeat'}).encode())
+        except Exception as e:
+            print(f"[错误] 发送心跳失败: {e}")
+    
+    def request_history(self, conversation, before=None):
+        """向服务器请求某个会话的一页聊天记录"""
+        if not self.socket or not self.connection_status:
+            return
+        
+        self.history_requested.add(conversation)
+        self.history_loading.add(conversation)
+        data = json.dumps({
+            'type': 'command',
+            'command': 'history',
+            'conversation': conversation,
+            'before': before,
+            'limit': 50
+        })
+        try:
+            self.socket.sendall(data.encode())
+        except Exception as e:
+            self.history_loading.discard(conversation)
+            print(f"[错误] 请求聊天记录失败: {e}")
+    
+    def merge_history(self, message_data):
+        """把服务器返回的聊天记录存入本地缓存（按 id 去重），并刷新当前会话"""
+        conversation = message_data.get('conversation', 'chat_room')
+        if conversation == "chat_room":
+            key = CHAT_ROOM
+        elif conversation.startswith('#'):
+            key = channel_conversation(conversation)
         else:
-            file_html = ""
-            if file_path:
-                print(f"[调试] 文件路径不存在: {file_path}")
+            key = private_conversation(conversation)
+        self.history_loading.discard(conversation)
+        if not message_data.get('has_more'):
+            self.history_exhausted.add(conversation)
+        
+        messages = []
+        for entry in message_data.get('messages', []):
+            sender = entry.get('sender', '未知')
+            content = entry.get('message', '')
+            if conversation == "chat_room" or conversation.startswith('#'):
+                msg_type = 'broadcast'
+            else:
+                msg_type = 'private'
+                # 与实时收到的私聊消息格式保持一致
+                if sender != self.username:
+                    content = f"{sender} (私聊): {content}"
+            messages.append({
+                'sender': sender,
+                'message': content,
+                'type': msg_type,
+                'timestamp': entry.get('timestamp', datetime.datetime.now().isoformat()),
+                'id': entry.get('id')
+            })
         
+        if not self.message_cache.add_history(key, messages) or key != self.current_conversation():
+            return
+        if message_data.get('before') is None:
+            # 最新一页：重新显示整个会话
+            self.render_conversation(key)
+        else:
+            # 向上翻页请求的结果
+            self.load_older_messages()
+    
+    def display_message(self, message_data):
+        """显示消息到聊天区域"""
         self.message_count += 1
         self.message_counter.setText(f"消息: {self.message_count}")
         
-        if self.is_dark_theme:
-            if msg_type == 'system':
-                html = f"""
-                    <div style='background-color: #4a4031; border-left: 4px solid #ffc107;
-                              padding: 8px; margin: 5px 0; border-radius: 0 5px 5px 0;'>
-                        <span style='color: #ffd700; font-size: 0.9em;'>{time_str}</span><br>
-                        <span style='color: #ffd700;'><b>📢 {sender}:</b> {message}</span>
-                        {image_html}
-                        {file_html}
-                    </div>
-                """
-            elif msg_type == 'private':
-                html = f"""
-                    <div style='background-color: #2c3e50; border-left: 4px solid #3498db;
-                              padding: 8px; margin: 5px 0; border-radius: 0 5px 5px 0;'>
-                        <span style='color: #3498db; font-size: 0.9em;'>{time_str}</span><br>
-                        <span style='color: #3498db;'><b>🔒 {sender}:</b> {message}</span>
-                        {image_html}
-                        {file_html}
-                    </div>
-                """
-            else:
-                if sender == self.username:
-                    sender = "我"
-                    bg_color = "#2c5f2d"
-                    border_color = "#4CAF50"
-                    text_color = "#4CAF50"
-                    icon = "🗨️"
-                else:
-                    bg_color = "#3c3c3c"
-                    border_color = "#777"
-                    text_color = "#ddd"
-                    icon = "👤"
-                
-                html = f"""
-                    <div style='background-color: {bg_color}; border-left: 4px solid {border_color};
-                              padding: 8px; margin: 5px 0; border-radius: 0 5px 5px 0;'>
-                        <div style='color: {text_color}; font-size: 0.9em;'>
-                            {time_str} | {icon} <b>{sender}</b>
-                        </div>
-                        <div style='color: {text_color}; margin-top: 3px;'>{message}</div>
-                        {image_html}
-                        {file_html}
-                    </div>
-                """
+        self.message_area.append_message(message_data)
+    
+    def format_message_html(self, message_data):
+        """生成一条消息的 HTML（颜色由主题样式表决定）"""
+        return self.message_renderer.render(message_data, self.username)
+    
+    def load_message_resource(self, url):
+        """消息视图中 thumb: 地址的图片由缩略图服务提供，本地还没有的图片先向服务器获取"""
+        if not url.startswith(f"{THUMBNAIL_SCHEME}:"):
+            return None
+        path, digest = parse_thumbnail_url(url)
+        if not os.path.exists(path) and digest:
+            self.fetch_attachment(digest, path, lambda result: self.on_image_fetched(path, result))
+            return self.thumbnails.placeholder
+        return self.thumbnails.thumbnail(path)
+    
+    def on_image_fetched(self, path, result):
+        """图片下载到本地后重新显示"""
+        if result is None:
+            return
+        self.message_area.invalidate(lambda message: message.get('image_path') == path)
+    
+    def fetch_attachment(self, digest, path, callback):
+        """按内容哈希向服务器获取附件并写入 path，同样的请求合并为一次；callback 收到 path，失败时为 None"""
+        key = (digest, path)
+        callbacks = self.attachment_requests.setdefault(key, [])
+        callbacks.append(callback)
+        if len(callbacks) > 1:
+            return
+        if self.bulk_port:
+            # 从附件端口下载，边收边写文件，不占用聊天连接
+            thread = BulkTransferThread(self.host, self.bulk_port, self.bulk_token, digest=digest, path=path)
+            thread.download_done.connect(lambda digest, path: self.finish_attachment(key, path))
+            thread.failed.connect(lambda digest, error, resumable: self.on_download_failed(key, error))
+            self.start_bulk_thread(thread)
+            return
+        try:
+            self.socket.sendall(json.dumps({'type': 'attachment_get', 'hash': digest}).encode())
+        except Exception as e:
+            print(f"[错误] 请求附件失败: {e}")
+            self.finish_attachment(key, None)
+    
+    def on_download_failed(self, key, error):
+        print(f"[错误] 获取附件失败: {error}")
+        self.finish_attachment(key, None)
+    
+    def finish_attachment(self, key, result):
+        """附件获取结束，把保存路径（失败时为 None）交给等待的回调"""
+        for callback in self.attachment_requests.pop(key, []):
+            callback(result)
+    
+    def on_attachment_data(self, message_data):
+        """服务器从聊天连接返回附件内容（未开启附件端口时），校验哈希后写入请求的路径"""
+        digest = message_data.get('hash', '')
+        data = None
+        if message_data.get('content'):
+            data = base64.b64decode(message_data['content'])
+            if hashlib.sha256(data).hexdigest() != digest:
+                print(f"[错误] 附件校验失败: {digest}")
+                data = None
         else:
-            if msg_type == 'system':
-                html = f"""
-                    <div style='background-color: #fff3cd; border-left: 4px solid #ffc107;
-                              padding: 8px; margin: 5px 0; border-radius: 0 5px 5px 0;'>
-                        <span style='color: #856404; font-size: 0.9em;'>{time_str}</span><br>
-                        <span style='color: #856404;'><b>📢 {sender}:</b> {message}</span>
-                        {image_html}
-                        {file_html}
-                    </div>
-                """
-            elif msg_type == 'private':
-                html = f"""
-                    <div style='background-color: #e7f3ff; border-left: 4px solid #2196F3;
-                              padding: 8px; margin: 5px 0; border-radius: 0 5px 5px 0;'>
-                        <span style='color: #0d47a1; font-size: 0.9em;'>{time_str}</span><br>
-                        <span style='color: #0d47a1;'><b>🔒 {sender}:</b> {message}</span>
-                        {image_html}
-                        {file_html}
-                    </div>
-                """
-            else:
-                if sender == self.username:
-                    sender = "我"
-                    bg_color = "#d4edda"
-                    border_color = "#28a745"
-                    text_color = "#155724"
-                    icon = "🗨️"
-                else:
-                    bg_color = "#f8f9fa"
-                    border_color = "#6c757d"
-                    text_color = "#212529"
-                    icon = "👤"
-                
-                html = f"""
-                    <div style='background-color: {bg_color}; border-left: 4px solid {border_color};
-                      padding: 8px; margin: 5px 0; border-radius: 0 5px 5px 0;'>
-                        <div style='color: {text_color}; font-size: 0.9em;'>
-                            {time_str} | {icon} <b>{sender}</b>
-                        </div>
-                        <div style='color: {text_color}; margin-top: 3px;'>{message}</div>
-                        {image_html}
-                        {file_html}
-                    </div>
-                """
-        
-        self.message_area.append(html)
-        self.message_area.moveCursor(QTextCursor.End)
+            print(f"[错误] 获取附件失败: {message_data.get('error', digest)}")
+        for key in [key for key in self.attachment_requests if key[0] == digest]:
+            result = None
+            if data is not None:
+                try:
+                    with open(key[1], 'wb') as f:
+                        f.write(data)
+                    result = key[1]
+                except OSError as e:
+                    print(f"[错误] 保存附件失败: {e}")
+            self.finish_attachment(key, result)
+    
+    def on_thumbnail_ready(self, path):
+        """缩略图生成后，重新排版用到它的消息"""
+        self.message_area.invalidate(lambda message: message.get('image_path') == path)
     
     def send_message(self):
         """发送消息"""
@@ -2437,26 +2954,18 @@ class ChatClient(QMainWindow):
                 'timestamp': timestamp
             }
             
-            if self.current_chat_partner not in self.messages["private"]:
-                self.messages["private"][self.current_chat_partner] = []
-            self.messages["private"][self.current_chat_partner].append(msg)
-            
+            # 先显示，服务器回执 private_sent 带上记录 id 后再存入本地缓存，与拉取的聊天记录按 id 去重
             self.display_message(msg)
         else:
-            data = json.dumps({
+            payload = {
                 'type': 'message',
                 'content': message,
                 'timestamp': timestamp
-            })
-            
-            msg = {
-                'sender': self.username,
-                'message': message,
-                'type': 'broadcast',
-                'timestamp': timestamp
             }
-            
-            self.messages["chat_room"].append(msg)
+            if self.chat_mode == "channel" and self.current_channel:
+                payload['channel'] = self.current_channel
+            # 自己的消息等服务器广播回来（带记录 id）再显示和缓存
+            data = json.dumps(payload)
         
         try:
             self.socket.sendall(data.encode())
@@ -2484,12 +2993,7 @@ class ChatClient(QMainWindow):
             return
         
         # 选择通话对象
-        users = []
-        for i in range(self.user_list_widget.user_list.count()):
-            item = self.user_list_widget.user_list.item(i)
-            user = item.text()
-            if user not in ["聊天室", "语音聊天室"] and user != f"{self.username} (我)":
-                users.append(user)
+        users = [user for user in self.user_list_widget.usernames() if user != self.username]
         
         if not users:
             QMessageBox.information(self, "提示", "没有可通话的用户")
@@ -3330,13 +3834,7 @@ class ChatClient(QMainWindow):
         self.current_chat_partner = username
         self.title_label.setText(f"私聊 - {username}")
         
-        self.message_area.clear()
-        self.message_count = 0
-        self.message_counter.setText("消息: 0")
-        
-        if username in self.messages["private"]:
-            for msg in self.messages["private"][username]:
-                self.display_message(msg)
+        self.render_conversation(private_conversation(username))
         
         self.display_message({
             'sender': "系统",
@@ -3344,6 +3842,35 @@ class ChatClient(QMainWindow):
             'type': 'system',
             'timestamp': datetime.datetime.now().isoformat()
         })
+        
+        if username not in self.history_requested:
+            self.request_history(username)
+    
+    def set_online_users(self, users, version):
+        """用完整的在线用户列表替换本地列表"""
+        self.online_users = set(users)
+        self.presence_version = version
+        self.user_list_widget.update_users(self.online_users, self.username)
+    
+    def apply_presence(self, message_data):
+        """处理服务器推送的在线用户列表：完整列表直接替换，增量按版本号依次应用"""
+        version = message_data.get('version', 0)
+        if message_data.get('full'):
+            self.set_online_users(message_data.get('users', []), version)
+            return
+        if version <= self.presence_version:
+            return
+        for user in message_data.get('joined', []):
+            self.online_users.add(user)
+            self.user_list_widget.add_user(user)
+        for user in message_data.get('left', []):
+            self.online_users.discard(user)
+            if user != self.username:
+                self.user_list_widget.remove_user(user)
+        if version != self.presence_version + 1:
+            # 中间漏了增量，重新拉取完整列表
+            self.show_online_users()
+        self.presence_version = version
     
     def show_online_users(self):
         """显示在线用户"""
@@ -3460,69 +3987,129 @@ class ChatClient(QMainWindow):
             return
         
         try:
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            encoded_data = base64.b64encode(file_data).decode('utf-8')
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-            
-            # 发送文件
-            if self.chat_mode == "private" and self.current_chat_partner:
-                msg_type = 'private_file'
-                target = self.current_chat_partner
-            else:
-                msg_type = 'file'
-                target = None
-            
-            file_msg = {
-                'type': msg_type,
-                'file_name': file_name,
-                'file_size': file_size,
-                'file_content': encoded_data
-            }
-            
-            if target:
-                file_msg['target'] = target
-            
-            self.socket.sendall(json.dumps(file_msg).encode())
+            # 分块上传，断线重连后从已确认的位置续传
+            target = self.current_chat_partner if self.chat_mode == "private" and self.current_chat_partner else None
+            upload = ChunkedUpload(file_path, 'file', target)
+            try:
+                self.start_upload(upload, self.current_conversation())
+            except Exception:
+                upload.close()
+                raise
             
-            # 显示发送的消息，保存文件到received_files以便自己也能下载
-            import uuid
-            file_id = str(uuid.uuid4())
+            # 文件哈希在传输线程中计算，算好后在 on_upload_hashed 里显示发送的消息
+            self.statusBar.showMessage(f"正在计算 {upload.file_name} 的校验值...")
             
-            # 保存文件到内存字典
-            self.received_files[file_id] = {
-                'file_name': file_name,
-                'file_size': file_size,
-                'file_content': encoded_data,
+        except Exception as e:
+            QMessageBox.warning(self, "上传失败", f"文件上传失败: {str(e)}")
+    
+    def start_upload(self, upload, conversation):
+        """登记并开始一个分块上传；服务器没有开启附件端口时抛出 ConnectionError，不登记"""
+        if not self.bulk_port:
+            raise ConnectionError("服务器未开启附件传输")
+        self.uploads[upload.file_id] = upload
+        self.upload_conversations[upload.file_id] = conversation
+        self.run_upload(upload)
+    
+    def run_upload(self, upload):
+        """在附件传输线程中上传（或续传）"""
+        if not self.bulk_port:
+            # 重新登录的服务器关闭了附件端口，无法续传
+            self.on_upload_failed(upload.file_id, "服务器未开启附件传输", False)
+            return
+        thread = BulkTransferThread(self.host, self.bulk_port, self.bulk_token, upload=upload)
+        thread.hashed.connect(self.on_upload_hashed)
+        thread.progress.connect(self.on_upload_progress)
+        thread.upload_done.connect(self.on_upload_done)
+        thread.failed.connect(self.on_upload_failed)
+        self.start_bulk_thread(thread)
+    
+    def start_bulk_thread(self, thread):
+        """启动附件传输线程，结束前保留引用"""
+        self.bulk_threads.add(thread)
+        thread.finished.connect(lambda: self.bulk_threads.discard(thread))
+        thread.start()
+    
+    def resume_uploads(self):
+        """重新登录后续传未完成的上传，服务器应答已收到的字节数"""
+        for upload in list(self.uploads.values()):
+            upload.retries = 0
+            print(f"[文件] 续传: {upload.file_name}")
+            self.run_upload(upload)
+    
+    def on_upload_hashed(self, file_id, file_hash):
+        """传输线程算好了文件哈希：显示发送的消息并保存到消息历史"""
+        upload = self.uploads.get(file_id)
+        conversation = self.upload_conversations.pop(file_id, None)
+        if upload is None or conversation is None:
+            return
+        
+        if upload.kind == 'image':
+            display_msg = {
                 'sender': '我',
+                'type': 'image_receive',
+                'message': f"发送图片: {upload.file_name}",
+                'image_path': os.path.join(os.getcwd(), 'sent_images', upload.file_name),
+                'image_hash': file_hash,
+                'image_name': upload.file_name,
                 'timestamp': datetime.datetime.now().isoformat()
             }
-            
+        else:
+            # 本地只记录文件信息，自己下载时和别人一样按哈希从服务器获取，不把文件内容读进内存
+            self.message_cache.save_file(
+                file_hash, upload.file_name, upload.file_size, '我',
+                datetime.datetime.now().isoformat(), None
+            )
             display_msg = {
                 'sender': '我',
                 'type': 'file_receive',
-                'message': f"发送文件: {file_name} ({self.format_file_size(file_size)})",
-                'file_name': file_name,
-                'file_size': file_size,
-                'file_content': encoded_data,
-                'file_id': file_id,
+                'message': f"发送文件: {upload.file_name} ({self.format_file_size(upload.file_size)})",
+                'file_name': upload.file_name,
+                'file_size': upload.file_size,
+                'file_id': file_hash,
                 'timestamp': datetime.datetime.now().isoformat()
             }
-            
-            # 保存到消息历史
-            if self.chat_mode == "private" and self.current_chat_partner:
-                if self.current_chat_partner not in self.messages["private"]:
-                    self.messages["private"][self.current_chat_partner] = []
-                self.messages["private"][self.current_chat_partner].append(display_msg)
-            else:
-                self.messages["chat_room"].append(display_msg)
-            
+        
+        # 保存到消息历史；期间切换了会话就只保存不显示
+        self.message_cache.append(conversation, display_msg)
+        if self.current_conversation() == conversation:
             self.display_message(display_msg)
-            
-        except Exception as e:
-            QMessageBox.warning(self, "上传失败", f"文件上传失败: {str(e)}")
+    
+    def on_upload_progress(self, file_id, acked, size):
+        upload = self.uploads.get(file_id)
+        if upload:
+            self.statusBar.showMessage(f"正在上传 {upload.file_name}: {upload.progress():.0%}")
+    
+    def on_upload_done(self, file_id, file_hash):
+        upload = self.uploads.pop(file_id, None)
+        self.upload_conversations.pop(file_id, None)
+        if upload:
+            upload.close()
+            self.statusBar.showMessage(f"{upload.file_name} 上传完成", 3000)
+    
+    def on_upload_failed(self, file_id, error, resumable):
+        """上传失败：连接问题时稍后续传（或等重新登录），服务器拒绝时放弃"""
+        upload = self.uploads.get(file_id)
+        if upload is None:
+            return
+        if resumable and upload.retries < UPLOAD_RETRIES:
+            upload.retries += 1
+            print(f"[文件] 上传中断，稍后续传: {upload.file_name} ({error})")
+            self.statusBar.showMessage(f"{upload.file_name} 上传中断，稍后续传", 5000)
+            QTimer.singleShot(UPLOAD_RETRY_DELAY_MS * upload.retries, lambda: self.retry_upload(file_id))
+            return
+        if resumable:
+            # 重试次数用完，保留到重新登录后续传
+            return
+        del self.uploads[file_id]
+        self.upload_conversations.pop(file_id, None)
+        upload.close()
+        self.statusBar.showMessage(f"{upload.file_name} 上传失败", 5000)
+        QMessageBox.warning(self, "上传失败", f"{upload.file_name} 上传失败: {error}")
+    
+    def retry_upload(self, file_id):
+        upload = self.uploads.get(file_id)
+        if upload and self.connection_status:
+            self.run_upload(upload)
     
     def handle_anchor_click(self, url):
         """处理链接点击事件"""
@@ -3533,12 +4120,12 @@ class ChatClient(QMainWindow):
     
     def download_file(self, file_id):
         """下载文件"""
-        if file_id not in self.received_files:
+        file_data = self.message_cache.load_file(file_id)
+        if file_data is None:
             QMessageBox.warning(self, "下载失败", "文件不存在")
             return
         
         try:
-            file_data = self.received_files[file_id]
             file_name = file_data.get('file_name', 'unknown_file')
             file_content = file_data.get('file_content')
             
@@ -3549,14 +4136,26 @@ class ChatClient(QMainWindow):
             if not save_path:
                 return
             
+            if file_content is None:
+                # 本地只有文件信息，按内容哈希（即 file_id）从服务器直接下载到保存位置
+                self.fetch_attachment(file_id, save_path, lambda result: self.on_file_fetched(save_path, result))
+                return
+            
             with open(save_path, 'wb') as f:
-                f.write(base64.b64decode(file_content))
+                f.write(file_content)
             
             QMessageBox.information(self, "下载成功", f"文件已保存到: {save_path}")
             
         except Exception as e:
             QMessageBox.warning(self, "下载失败", f"文件下载失败: {str(e)}")
     
+    def on_file_fetched(self, save_path, result):
+        """文件已下载到用户选择的位置"""
+        if result is None:
+            QMessageBox.warning(self, "下载失败", "文件下载失败，请稍后重试")
+            return
+        QMessageBox.information(self, "下载成功", f"文件已保存到: {save_path}")
+    
     def upload_image(self):
         """上传图片"""
         file_path, _ = QFileDialog.getOpenFileName(
@@ -3567,60 +4166,23 @@ class ChatClient(QMainWindow):
             return
         
         try:
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            encoded_data = base64.b64encode(file_data).decode('utf-8')
-            file_name = os.path.basename(file_path)
-            
-            # 发送图片
-            if self.chat_mode == "private" and self.current_chat_partner:
-                msg_type = 'private_image'
-                target = self.current_chat_partner
-            else:
-                msg_type = 'image'
-                target = None
-            
-            image_msg = {
-                'type': msg_type,
-                'image_name': file_name,
-                'image_content': encoded_data
-            }
-            
-            if target:
-                image_msg['target'] = target
-            
-            self.socket.sendall(json.dumps(image_msg).encode())
-            
-            # 保存图片到本地以便显示
-            save_dir = os.path.join(os.getcwd(), 'sent_images')
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            
-            # 保存图片
-            image_path = os.path.join(save_dir, file_name)
-            with open(image_path, 'wb') as f:
-                f.write(file_data)
-            
-            # 显示发送的消息
-            display_msg = {
-                'sender': '我',
-                'type': 'image_receive',
-                'message': f"发送图片: {file_name}",
-                'image_path': image_path,
-                'image_name': file_name,
-                'timestamp': datetime.datetime.now().isoformat()
-            }
-            
-            # 保存到消息历史
-            if self.chat_mode == "private" and self.current_chat_partner:
-                if self.current_chat_partner not in self.messages["private"]:
-                    self.messages["private"][self.current_chat_partner] = []
-                self.messages["private"][self.current_chat_partner].append(display_msg)
-            else:
-                self.messages["chat_room"].append(display_msg)
+            # 发送图片（与文件一样分块上传）
+            target = self.current_chat_partner if self.chat_mode == "private" and self.current_chat_partner else None
+            upload = ChunkedUpload(file_path, 'image', target)
+            try:
+                # 保存图片到本地以便显示
+                save_dir = os.path.join(os.getcwd(), 'sent_images')
+                if not os.path.exists(save_dir):
+                    os.makedirs(save_dir)
+                shutil.copyfile(file_path, os.path.join(save_dir, upload.file_name))
+                
+                self.start_upload(upload, self.current_conversation())
+            except Exception:
+                upload.close()
+                raise
             
-            self.display_message(display_msg)
+            # 文件哈希在传输线程中计算，算好后在 on_upload_hashed 里显示发送的消息
+            self.statusBar.showMessage(f"正在计算 {upload.file_name} 的校验值...")
             
         except Exception as e:
             QMessageBox.warning(self, "上传失败", f"图片上传失败: {str(e)}")
@@ -3744,8 +4306,9 @@ class ChatClient(QMainWindow):
                     background-color: #444;
                 }
             """)
+            self.message_area.set_stylesheet(DARK_STYLESHEET)
             self.message_area.setStyleSheet("""
-                QTextEdit {
+                QListView {
                     background-color: #2b2b2b !important;
                     color: white !important;
                     border: 1px solid #555;
@@ -3787,8 +4350,9 @@ class ChatClient(QMainWindow):
     
     def reset_light_theme_styles(self):
         """重置浅色主题样式"""
+        self.message_area.set_stylesheet(LIGHT_STYLESHEET)
         self.message_area.setStyleSheet("""
-            QTextEdit {
+            QListView {
                 background-color: #fafafa;
                 border: 1px solid #d4b88c;
                 border-radius: 8px;
@@ -3930,6 +4494,7 @@ class ChatClient(QMainWindow):
         font, ok = QFontDialog.getFont()
         if ok:
             self.message_area.setFont(font)
+            self.message_area.refresh()
             self.input_edit.setFont(font)
     
     def show_about(self):
@@ -3951,12 +4516,33 @@ class ChatClient(QMainWindow):
         QMessageBox.about(self, "关于", about_text)
     
     def reconnect(self):
-        """重新连接服务器"""
+        """重新连接服务器，有恢复令牌时不用重新输入用户名"""
         if self.connection_status:
             QMessageBox.information(self, "提示", "已经连接到服务器")
-        else:
+        elif not (self.resume_token and self.connect_to_server(resume=True)):
             self.connect_to_server()
     
+    def resume_connection(self):
+        """连接意外断开后自动重连，多次失败后放弃"""
+        if self.connection_status or not self.resume_token:
+            return
+        if self.connect_to_server(resume=True):
+            return
+        self.resume_attempts += 1
+        if self.resume_attempts < self.RESUME_ATTEMPTS:
+            QTimer.singleShot(self.RESUME_DELAY_MS, self.resume_connection)
+            return
+        self.resume_token = None
+        if self.voice_client:
+            self.voice_client.disconnect()
+            self.voice_client = None
+        self.display_message({
+            'sender': "系统",
+            'message': "无法重新连接服务器，请从菜单手动连接",
+            'type': 'system',
+            'timestamp': datetime.datetime.now().isoformat()
+        })
+    
     def disconnect(self):
         """断开连接"""
         try:
@@ -3965,6 +4551,9 @@ class ChatClient(QMainWindow):
                 self.voice_client.disconnect()
                 self.voice_client = None
             
+            self.heartbeat_timer.stop()
+            self.resume_token = None  # 主动断开，不再自动重连
+            
             # 断开主连接
             if self.connection_status and self.socket:
                 try:
@@ -3992,6 +4581,7 @@ class ChatClient(QMainWindow):
     def on_connection_closed(self):
         """连接关闭处理"""
         self.update_connection_status(False)
+        self.heartbeat_timer.stop()
         
         if self.receive_thread:
             self.receive_thread.stop()
@@ -4004,17 +4594,20 @@ class ChatClient(QMainWindow):
                 pass
             self.socket = None
         
-        # 断开语音连接
-        if self.voice_client:
-            self.voice_client.disconnect()
-            self.voice_client = None
-        
         self.display_message({
             'sender': "系统",
             'message': "服务器连接已断开",
             'type': 'system',
             'timestamp': datetime.datetime.now().isoformat()
         })
+        
+        # 意外断开时带恢复令牌自动重连，语音连接在此期间自己恢复；否则断开语音连接
+        if self.resume_token:
+            self.resume_attempts = 0
+            QTimer.singleShot(self.RESUME_DELAY_MS, self.resume_connection)
+        elif self.voice_client:
+            self.voice_client.disconnect()
+            self.voice_client = None
     
     def handle_error(self, error_message):
         """处理错误"""
@@ -4029,11 +4622,7 @@ class ChatClient(QMainWindow):
             self.chat_mode = "chat_room"
             self.current_chat_partner = None
             self.title_label.setText("网络聊天室")
-            self.message_area.clear()
-            self.message_count = 0
-            self.message_counter.setText("消息: 0")
-            for msg in self.messages["chat_room"]:
-                self.display_message(msg)
+            self.render_conversation(CHAT_ROOM)
             self.display_message({
                 'sender': "系统",
                 'message': "已切换到聊天室",
@@ -4042,22 +4631,21 @@ class ChatClient(QMainWindow):
             })
         elif username == "语音聊天室":
             self.join_voice_room()
+        elif username.startswith('#'):
+            self.show_channel(username)
         else:
             self.chat_mode = "private"
             self.current_chat_partner = username
             self.title_label.setText(f"私聊 - {username}")
-            self.message_area.clear()
-            self.message_count = 0
-            self.message_counter.setText("消息: 0")
-            if username in self.messages["private"]:
-                for msg in self.messages["private"][username]:
-                    self.display_message(msg)
+            self.render_conversation(private_conversation(username))
             self.display_message({
                 'sender': "系统",
                 'message': f"已进入与 {username} 的私聊界面",
                 'type': 'system',
                 'timestamp': datetime.datetime.now().isoformat()
             })
+            if username not in self.history_requested:
+                self.request_history(username)
     
     def createSystemTray(self):
         """创建系统托盘图标"""
@@ -4101,6 +4689,9 @@ class ChatClient(QMainWindow):
         if hasattr(self, 'timer') and self.timer:
             self.timer.stop()
         
+        # 等待后台缩略图任务结束
+        self.thumbnails.shutdown()
+        
         event.accept()
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+# client_thumbnails.py
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QColor
+
+THUMBNAIL_WIDTH = 300
+THUMBNAIL_HEIGHT = 200
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """按块计算文件的 SHA-256，不把整个文件读进内存"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ThumbnailTask(QRunnable):
+    """在线程池中为一张图片生成缩略图"""
+
+    def __init__(self, service, path):
+        super().__init__()
+        self.service = service
+        self.path = path
+
+    def run(self):
+        try:
+            image = self.service.build(self.path)
+        except Exception as e:
+            print(f"[缩略图] 生成失败 {self.path}: {e}")
+            image = None
+        self.service.finished.emit(self.path, image if image is not None else QImage())
+
+
+class ThumbnailService(QObject):
+    """图片缩略图服务：解码和缩放在线程池中完成，结果按内容哈希缓存到磁盘，内存中保留最近使用的一部分"""
+
+    thumbnailReady = pyqtSignal(str)
+    finished = pyqtSignal(str, QImage)
+
+    def __init__(self, cache_dir, max_images=200, workers=2, parent=None):
+        super().__init__(parent)
+        self.cache_dir = cache_dir
+        self.max_images = max_images
+        self.images = OrderedDict()  # 图片路径 -> 缩略图 QImage
+        self.pending = set()
+        self.failed = set()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(workers)
+        self.placeholder = QImage(THUMBNAIL_WIDTH // 2, THUMBNAIL_HEIGHT // 2, QImage.Format_RGB32)
+        self.placeholder.fill(QColor('#dddddd'))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.finished.connect(self.on_finished)
+
+    def thumbnail(self, path):
+        """返回缩略图；还没生成时返回占位图并在后台生成，完成后发出 thumbnailReady"""
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+            return image
+        if path not in self.pending and path not in self.failed:
+            self.pending.add(path)
+            self.pool.start(ThumbnailTask(self, path))
+        return self.placeholder
+
+    def build(self, path):
+        """工作线程中执行：读取磁盘缓存，没有时解码原图并缩放后写入缓存"""
+        cache_path = os.path.join(self.cache_dir, f"{file_digest(path)}.png")
+        if os.path.exists(cache_path):
+            image = QImage(cache_path)
+            if not image.isNull():
+                return image
+
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid() and (size.width() > THUMBNAIL_WIDTH or size.height() > THUMBNAIL_HEIGHT):
+            # JPEG 等格式可以直接按缩小后的尺寸解码，不必先解出整张大图
+            reader.setScaledSize(size.scaled(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            raise ValueError(reader.errorString())
+        if image.width() > THUMBNAIL_WIDTH or image.height() > THUMBNAIL_HEIGHT:
+            image = image.scaled(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        if image.save(temp_path, 'PNG'):
+            os.replace(temp_path, cache_path)
+        return image
+
+    def on_finished(self, path, image):
+        """回到 GUI 线程后放入内存缓存"""
+        self.pending.discard(path)
+        if image.isNull():
+            self.failed.add(path)
+            return
+        self.images[path] = image
+        if len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+        self.thumbnailReady.emit(path)
+
+    def shutdown(self):
+        """退出前等待正在生成的缩略图"""
+        self.pool.clear()
+        self.pool.waitForDone()
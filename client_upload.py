@@ -0,0 +1,130 @@
+# client_upload.py
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import time
+import uuid
+import zlib
+
+MIN_CHUNK_SIZE = 16 * 1024
+INITIAL_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+WINDOW = 4                # 最多同时在途（未确认）的块数
+CHUNK_TARGET_SECONDS = 0.2  # 一块从发出到确认的期望耗时，用于调整块大小
+HASH_BLOCK_SIZE = 1024 * 1024
+UPLOAD_RETRIES = 3            # 上传中断后自动续传的次数，之后等重新登录再续传
+UPLOAD_RETRY_DELAY_MS = 2000
+
+
+def file_sha256(path):
+    """按块计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChunkedUpload:
+    """一个分块上传的发送状态：按偏移发块、处理确认、出错或重连后从已确认的位置继续
+
+    文件内容不读进内存，发送时才从磁盘按块读取，内存占用与文件大小无关。
+    文件哈希由传输线程在第一次上传前调用 compute_hash() 计算，大文件也不会卡住界面。
+    """
+
+    def __init__(self, path, kind='file', target=None, file_id=None):
+        self.path = path
+        self.kind = kind
+        self.target = target
+        self.file_id = file_id or uuid.uuid4().hex
+        self.file_name = os.path.basename(path)
+        self.file = open(path, 'rb')
+        try:
+            self.file_size = os.fstat(self.file.fileno()).st_size
+        except OSError:
+            self.file.close()
+            raise
+        self.file_hash = None   # 由传输线程计算
+
+        self.chunk_size = INITIAL_CHUNK_SIZE
+        self.acked = 0          # 服务器已确认的字节数
+        self.next_offset = 0    # 下一块的偏移
+        self.in_flight = {}     # 块结束偏移 -> 发出时间
+        self.ready = False      # 是否收到 file_upload_ready
+        self.completing = False  # 是否已发送 file_upload_complete
+        self.retries = 0        # 中断后自动续传的次数
+
+    def compute_hash(self):
+        """计算整个文件的 SHA-256（耗时与文件大小成正比，不要在界面线程调用）"""
+        self.file_hash = file_sha256(self.path)
+        return self.file_hash
+
+    def request(self):
+        """file_upload_request 消息；重连后再次发送即可续传"""
+        self.ready = False
+        self.completing = False
+        message = {
+            'type': 'file_upload_request',
+            'file_id': self.file_id,
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'file_hash': self.file_hash,
+            'kind': self.kind
+        }
+        if self.target:
+            message['target'] = self.target
+        return message
+
+    def on_ready(self, received):
+        """服务器告知已收到的字节数，从这里开始发"""
+        self.acked = self.next_offset = received
+        self.in_flight.clear()
+        self.ready = True
+
+    def next_chunks(self):
+        """窗口内可以发送的块，返回 [(消息, 数据)]"""
+        chunks = []
+        while self.ready and self.next_offset < self.file_size and len(self.in_flight) < WINDOW:
+            self.file.seek(self.next_offset)
+            payload = self.file.read(min(self.chunk_size, self.file_size - self.next_offset))
+            if not payload:
+                break
+            chunks.append(({
+                'type': 'file_upload_chunk',
+                'file_id': self.file_id,
+                'offset': self.next_offset,
+                'checksum': zlib.crc32(payload)
+            }, payload))
+            self.next_offset += len(payload)
+            self.in_flight[self.next_offset] = time.monotonic()
+        return chunks
+
+    def on_ack(self, offset, error=None):
+        """处理 file_upload_ack：出错时回退到服务器确认的位置，否则按确认耗时调整块大小"""
+        if error:
+            self.acked = self.next_offset = offset
+            self.in_flight.clear()
+            self.chunk_size = max(MIN_CHUNK_SIZE, self.chunk_size // 2)
+            return
+        sent_at = self.in_flight.pop(offset, None)
+        self.acked = max(self.acked, offset)
+        for end in [end for end in self.in_flight if end <= offset]:
+            del self.in_flight[end]
+        if sent_at is not None:
+            elapsed = time.monotonic() - sent_at
+            if elapsed < CHUNK_TARGET_SECONDS:
+                self.chunk_size = min(MAX_CHUNK_SIZE, self.chunk_size * 2)
+            elif elapsed > CHUNK_TARGET_SECONDS * 2:
+                self.chunk_size = max(MIN_CHUNK_SIZE, self.chunk_size // 2)
+
+    @property
+    def done(self):
+        """所有数据都已被确认"""
+        return self.ready and self.acked >= self.file_size
+
+    def progress(self):
+        return self.acked / self.file_size if self.file_size else 1.0
+
+    def close(self):
+        """上传结束后关闭文件"""
+        self.file.close()
@@ -0,0 +1,257 @@
+# load_test_chat.py
+# 无界面的聊天服务器压力测试工具：建立大量协议级连接，按设定速率发送各类消息
+import argparse
+import asyncio
+import base64
+import json
+import math
+import random
+import re
+import time
+
+from chat_protocol import JsonStreamDecoder, RECV_SIZE
+
+# 嵌入在消息内容 / 文件名中的测试标记：LT|<发送者编号>|<发送时刻>
+MARK_RE = re.compile(r'LT\|(\d+)\|(\d+\.\d+)')
+KINDS = ('message', 'private', 'users', 'heartbeat', 'file')
+
+
+def percentile(values, p):
+    """最近秩法百分位数，values 需已排序"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+class LoadStats:
+    """压测统计：发送数、送达数、延迟样本和错误"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.sent = {kind: 0 for kind in KINDS}
+        self.delivered = {kind: 0 for kind in KINDS}
+        self.latencies = {kind: [] for kind in KINDS}
+        self.errors = {}
+        self.connected = 0
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def deliver(self, kind, sent_at):
+        self.delivered[kind] += 1
+        self.latencies[kind].append(time.monotonic() - sent_at)
+
+    def report(self, title):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        print(f"\n==== {title}  运行 {elapsed:.1f}s  在线连接 {self.connected} ====")
+        print(f"{'类型':<10}{'发送':>10}{'送达':>10}{'送达/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for kind in KINDS:
+            values = sorted(self.latencies[kind])
+            print(f"{kind:<10}{self.sent[kind]:>10}{self.delivered[kind]:>10}"
+                  f"{self.delivered[kind] / elapsed:>10.1f}"
+                  f"{format_ms(percentile(values, 50)):>10}{format_ms(percentile(values, 99)):>10}")
+        total_sent = sum(self.sent.values())
+        total_delivered = sum(self.delivered.values())
+        print(f"总计: 发送 {total_sent} ({total_sent / elapsed:.1f}/s)，送达 {total_delivered} ({total_delivered / elapsed:.1f}/s)")
+        if self.errors:
+            print("错误: " + ", ".join(f"{kind}={count}" for kind, count in sorted(self.errors.items())))
+        else:
+            print("错误: 0")
+
+
+class LoadClient:
+    """单个模拟客户端"""
+
+    def __init__(self, index, args, stats, registry):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.registry = registry
+        self.username = f"{args.prefix}{index}"
+        self.reader = None
+        self.writer = None
+        # users / heartbeat 请求按发送顺序应答
+        self.pending = {'users': [], 'heartbeat': []}
+
+    async def connect(self):
+        """连接并完成用户名握手，成功返回 True"""
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.args.host, self.args.port), self.args.timeout)
+            self.writer.write(json.dumps({'username': self.username}).encode())
+            await self.writer.drain()
+            self.decoder = JsonStreamDecoder()
+            response = await asyncio.wait_for(self.next_message(), self.args.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.stats.error('connect')
+            return False
+        if not response or response.get('status') != 'success':
+            self.stats.error('login')
+            self.writer.close()
+            return False
+        self.stats.connected += 1
+        self.registry.append(self)
+        return True
+
+    async def next_message(self):
+        while not self.decoder.messages:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            self.decoder.feed(data)
+        return self.decoder.pop()
+
+    async def send(self, kind, payload):
+        try:
+            self.writer.write(json.dumps(payload).encode())
+            await self.writer.drain()
+            self.stats.sent[kind] += 1
+        except (OSError, RuntimeError):
+            self.stats.error(f'send_{kind}')
+
+    def mark(self):
+        return f"LT|{self.index}|{time.monotonic():.6f}"
+
+    def build(self, kind):
+        """构造一条测试消息"""
+        if kind == 'message':
+            return {'type': 'message', 'content': self.mark()}
+        if kind == 'private':
+            peers = [client for client in self.registry if client is not self]
+            if not peers:
+                return None
+            return {'type': 'private', 'target': random.choice(peers).username, 'content': self.mark()}
+        if kind == 'users':
+            self.pending['users'].append(time.monotonic())
+            return {'type': 'command', 'command': 'users'}
+        if kind == 'heartbeat':
+            self.pending['heartbeat'].append(time.monotonic())
+            return {'type': 'heartbeat'}
+        if kind == 'file':
+            return {
+                'type': 'file',
+                'file_name': f"{self.mark()}.bin",
+                'file_size': self.args.file_size,
+                'file_content': self.args.file_content
+            }
+        return None
+
+    async def sender(self, kind, rate, deadline):
+        """按泊松过程发送某一类消息"""
+        if rate <= 0:
+            return
+        while not self.writer.is_closing():
+            delay = random.expovariate(rate)
+            if time.monotonic() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+            payload = self.build(kind)
+            if payload:
+                await self.send(kind, payload)
+
+    def handle(self, message):
+        """根据收到的消息统计送达和延迟"""
+        msg_type = message.get('type')
+        if msg_type in ('message', 'private', 'file_receive'):
+            text = message.get('file_name', '') if msg_type == 'file_receive' else message.get('message', '')
+            match = MARK_RE.search(text)
+            if match:
+                kind = 'file' if msg_type == 'file_receive' else msg_type
+                self.stats.deliver(kind, float(match.group(2)))
+        elif msg_type == 'users':
+            if self.pending['users']:
+                self.stats.deliver('users', self.pending['users'].pop(0))
+        elif msg_type == 'heartbeat_ack':
+            if self.pending['heartbeat']:
+                self.stats.deliver('heartbeat', self.pending['heartbeat'].pop(0))
+
+    async def receiver(self):
+        try:
+            while True:
+                message = await self.next_message()
+                if message is None:
+                    self.stats.error('disconnected')
+                    break
+                self.handle(message)
+        except (OSError, asyncio.CancelledError):
+            pass
+
+    async def run(self, deadline):
+        receiver = asyncio.create_task(self.receiver())
+        rates = {
+            'message': self.args.message_rate,
+            'private': self.args.private_rate,
+            'users': self.args.users_rate,
+            'heartbeat': self.args.heartbeat_rate,
+            'file': self.args.file_rate
+        }
+        await asyncio.gather(*(self.sender(kind, rate, deadline) for kind, rate in rates.items()))
+        # 留出时间接收尚在途中的消息
+        await asyncio.sleep(self.args.drain)
+        receiver.cancel()
+        self.writer.close()
+
+
+async def run_load(args):
+    stats = LoadStats()
+    registry = []
+    clients = [LoadClient(i, args, stats, registry) for i in range(args.clients)]
+
+    # 按 ramp 速率逐步建立连接
+    print(f"正在建立 {args.clients} 个连接到 {args.host}:{args.port} ...")
+    connect_tasks = []
+    for client in clients:
+        connect_tasks.append(asyncio.create_task(client.connect()))
+        if args.ramp > 0:
+            await asyncio.sleep(1.0 / args.ramp)
+    results = await asyncio.gather(*connect_tasks)
+    print(f"连接完成: 成功 {sum(results)}，失败 {len(results) - sum(results)}")
+
+    stats.started = time.monotonic()
+    deadline = stats.started + args.duration
+    tasks = [asyncio.create_task(client.run(deadline)) for client, ok in zip(clients, results) if ok]
+
+    async def periodic_report():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            stats.report("中间结果")
+
+    reporter = asyncio.create_task(periodic_report())
+    await asyncio.gather(*tasks)
+    reporter.cancel()
+    stats.report("最终结果")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天服务器无界面压力测试')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--clients', type=int, default=100, help='并发连接数')
+    parser.add_argument('--ramp', type=float, default=200, help='每秒新建连接数，0 表示一次性建立')
+    parser.add_argument('--duration', type=float, default=30, help='发送阶段持续时间（秒）')
+    parser.add_argument('--drain', type=float, default=2, help='发送结束后继续接收的时间（秒）')
+    parser.add_argument('--prefix', default='lt_', help='用户名前缀')
+    parser.add_argument('--message-rate', type=float, default=0.2, help='每连接每秒聊天室消息数')
+    parser.add_argument('--private-rate', type=float, default=0.1, help='每连接每秒私聊消息数')
+    parser.add_argument('--users-rate', type=float, default=0.2, help='每连接每秒 users 命令数')
+    parser.add_argument('--heartbeat-rate', type=float, default=0.1, help='每连接每秒心跳数')
+    parser.add_argument('--file-rate', type=float, default=0.0, help='每连接每秒文件发送数')
+    parser.add_argument('--file-size', type=int, default=10 * 1024, help='测试文件大小（字节）')
+    parser.add_argument('--timeout', type=float, default=10, help='连接/登录超时（秒）')
+    parser.add_argument('--report-interval', type=float, default=5, help='中间结果打印间隔（秒）')
+    args = parser.parse_args()
+    args.file_content = base64.b64encode(random.randbytes(args.file_size)).decode()
+
+    try:
+        asyncio.run(run_load(args))
+    except KeyboardInterrupt:
+        print("\n压测中断")
+
+
+if __name__ == "__main__":
+    main()
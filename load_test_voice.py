@@ -0,0 +1,281 @@
+# load_test_voice.py
+# 无音频硬件的语音服务器压力测试工具：模拟大量语音会话，按真实节奏发送合成音频
+import argparse
+import asyncio
+import math
+import pickle
+import struct
+import time
+
+from load_test_chat import percentile, format_ms
+
+# 与客户端一致的音频参数：1024 个采样、16 位单声道、44.1 kHz
+CHUNK = 1024
+RATE = 44100
+FRAME_INTERVAL = CHUNK / RATE
+# 每帧 PCM 开头写入的标记：序号(uint32) + 采集时刻(double)
+STAMP = struct.Struct('>Id')
+# 与客户端一致每 2 秒发一次 ping；服务器 30 秒收不到任何命令就断开，只收听的会话也要保活
+PING_INTERVAL = 2
+
+
+def build_tone(frequency):
+    """生成一帧正弦波 PCM 作为模板"""
+    samples = [int(8000 * math.sin(2 * math.pi * frequency * i / RATE)) for i in range(CHUNK)]
+    return bytearray(struct.pack(f'<{CHUNK}h', *samples))
+
+
+class StreamStats:
+    """某个收听者收到的某个发言者的音频流统计"""
+
+    def __init__(self):
+        self.first_seq = None
+        self.max_seq = 0
+        self.seen = set()
+        self.received = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.first_at = None
+        self.last_at = None
+
+    def add(self, seq, now):
+        if self.first_seq is None:
+            self.first_seq = seq
+            self.first_at = now
+        self.last_at = now
+        self.received += 1
+        if seq in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(seq)
+        if seq < self.max_seq:
+            self.reordered += 1
+        self.max_seq = max(self.max_seq, seq)
+
+    def expected(self):
+        return 0 if self.first_seq is None else self.max_seq - self.first_seq + 1
+
+    def lost(self):
+        return self.expected() - len(self.seen)
+
+
+class VoiceLoadStats:
+    """全部会话的汇总统计"""
+
+    def __init__(self):
+        self.sent = 0
+        self.latencies = []
+        self.streams = {}  # (listener, speaker) -> StreamStats
+        self.errors = {}
+        self.connected = 0
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, title, elapsed):
+        streams = list(self.streams.values())
+        received = sum(stream.received for stream in streams)
+        expected = sum(stream.expected() for stream in streams)
+        lost = sum(stream.lost() for stream in streams)
+        reordered = sum(stream.reordered for stream in streams)
+        duplicates = sum(stream.duplicates for stream in streams)
+        rates = sorted(
+            (stream.received - 1) / (stream.last_at - stream.first_at)
+            for stream in streams if stream.received > 1 and stream.last_at > stream.first_at
+        )
+        latencies = sorted(self.latencies)
+        print(f"\n==== {title}  运行 {elapsed:.1f}s  在线会话 {self.connected}  音频流 {len(streams)} ====")
+        print(f"发送帧: {self.sent} ({self.sent / max(elapsed, 1e-9):.1f}/s)")
+        print(f"收到帧: {received} ({received / max(elapsed, 1e-9):.1f}/s)，期望 {expected}")
+        print(f"丢失: {lost} ({100.0 * lost / expected if expected else 0:.2f}%)，乱序: {reordered}，重复: {duplicates}")
+        print(f"单流帧率 p50/最低: {percentile(rates, 50) or 0:.1f}/{rates[0] if rates else 0:.1f} 帧/秒"
+              f"（实时为 {1 / FRAME_INTERVAL:.1f}）")
+        print(f"延迟 p50/p99/最大: {format_ms(percentile(latencies, 50))}/"
+              f"{format_ms(percentile(latencies, 99))}/{format_ms(latencies[-1] if latencies else None)} ms")
+        print("错误: " + (", ".join(f"{k}={v}" for k, v in sorted(self.errors.items())) or "0"))
+
+
+class VoiceSession:
+    """单个模拟语音会话"""
+
+    def __init__(self, index, room_id, is_speaker, args, stats):
+        self.index = index
+        self.username = f"{args.prefix}{index}"
+        self.room_id = room_id
+        self.is_speaker = is_speaker
+        self.args = args
+        self.stats = stats
+        self.writer = None
+        self.keepalive_task = None
+        self.tone = build_tone(220 + 20 * (index % 40))
+
+    async def send_command(self, command):
+        data = pickle.dumps(command)
+        self.writer.write(struct.pack('>I', len(data)) + data)
+        await self.writer.drain()
+
+    async def read_command(self):
+        length = struct.unpack('>I', await self.reader.readexactly(4))[0]
+        return pickle.loads(await self.reader.readexactly(length))
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.args.host, self.args.port), self.args.timeout)
+            name = self.username.encode()
+            self.writer.write(struct.pack('>I', len(name)) + name)
+            await self.send_command({'type': 'join_room', 'room_id': self.room_id})
+        except (OSError, asyncio.TimeoutError):
+            self.stats.error('connect')
+            return False
+        self.stats.connected += 1
+        # 从加入房间起就保活：会话多时，先建立的会话要等全部建立完才开始发送
+        self.keepalive_task = asyncio.create_task(self.keepalive())
+        return True
+
+    async def keepalive(self):
+        """定期发送 ping，和真实客户端一样保持连接活跃"""
+        try:
+            while True:
+                await asyncio.sleep(PING_INTERVAL)
+                await self.send_command({'type': 'ping', 'client_ts': time.time()})
+        except (OSError, RuntimeError):
+            self.stats.error('ping')
+        except asyncio.CancelledError:
+            pass
+
+    async def speak(self, deadline):
+        """按 1024 采样 / 44.1 kHz 的真实节奏发送音频帧"""
+        seq = 0
+        next_at = time.monotonic()
+        while time.monotonic() < deadline:
+            seq += 1
+            capture_ts = time.time()
+            STAMP.pack_into(self.tone, 0, seq, capture_ts)
+            try:
+                await self.send_command({
+                    'type': 'audio_data',
+                    'room_id': self.room_id,
+                    'audio_data': bytes(self.tone),
+                    'seq': seq,
+                    'capture_ts': capture_ts,
+                    'clock_offset': 0.0  # 与服务器同机运行，时钟一致
+                })
+                self.stats.sent += 1
+            except (OSError, RuntimeError):
+                self.stats.error('send')
+                return
+            next_at += FRAME_INTERVAL
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -1:
+                # 落后超过一秒说明本机已饱和，不再补发
+                self.stats.error('sender_behind')
+                next_at = time.monotonic()
+
+    async def listen(self):
+        try:
+            while True:
+                command = await self.read_command()
+                if command.get('type') != 'audio_data':
+                    continue
+                now = time.time()
+                audio = command.get('audio_data') or b''
+                if len(audio) < STAMP.size:
+                    self.stats.error('short_frame')
+                    continue
+                # 以 PCM 中的标记为准，验证音频内容本身未被破坏
+                seq, capture_ts = STAMP.unpack_from(audio, 0)
+                if seq != command.get('seq'):
+                    self.stats.error('corrupt_frame')
+                key = (self.username, command.get('sender'))
+                stream = self.stats.streams.get(key)
+                if stream is None:
+                    stream = self.stats.streams[key] = StreamStats()
+                stream.add(seq, now)
+                self.stats.latencies.append(now - capture_ts)
+        except (asyncio.IncompleteReadError, OSError):
+            self.stats.error('disconnected')
+        except asyncio.CancelledError:
+            pass
+
+    async def run(self, deadline):
+        listener = asyncio.create_task(self.listen())
+        if self.is_speaker:
+            await self.speak(deadline)
+        else:
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+        await asyncio.sleep(self.args.drain)
+        listener.cancel()
+        self.keepalive_task.cancel()
+        self.writer.close()
+
+
+def room_for(index, args):
+    if args.rooms <= 1:
+        return 'public'
+    return f"{args.room_prefix}{index % args.rooms}"
+
+
+async def run_load(args):
+    stats = VoiceLoadStats()
+    sessions = []
+    speakers_per_room = {}
+    for i in range(args.sessions):
+        room_id = room_for(i, args)
+        count = speakers_per_room.get(room_id, 0)
+        is_speaker = count < args.speakers
+        speakers_per_room[room_id] = count + is_speaker
+        sessions.append(VoiceSession(i, room_id, is_speaker, args, stats))
+
+    print(f"正在建立 {args.sessions} 个语音会话到 {args.host}:{args.port}，"
+          f"{len(speakers_per_room)} 个房间，每房间最多 {args.speakers} 个发言者 ...")
+    results = []
+    for session in sessions:
+        results.append(await session.connect())
+        if args.ramp > 0:
+            await asyncio.sleep(1.0 / args.ramp)
+    print(f"会话建立完成: 成功 {sum(results)}，失败 {len(results) - sum(results)}")
+    # 等服务器处理完所有 join_room
+    await asyncio.sleep(0.5)
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    tasks = [asyncio.create_task(s.run(deadline)) for s, ok in zip(sessions, results) if ok]
+
+    async def periodic_report():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            stats.report("中间结果", time.monotonic() - started)
+
+    reporter = asyncio.create_task(periodic_report())
+    await asyncio.gather(*tasks)
+    reporter.cancel()
+    stats.report("最终结果", min(time.monotonic() - started, args.duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='语音服务器无音频硬件压力测试')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8889)
+    parser.add_argument('--sessions', type=int, default=20, help='语音会话总数')
+    parser.add_argument('--rooms', type=int, default=1, help='房间数，1 表示全部加入 public')
+    parser.add_argument('--room-prefix', default='load_room_', help='多房间时的房间名前缀')
+    parser.add_argument('--speakers', type=int, default=2, help='每个房间的发言者数')
+    parser.add_argument('--duration', type=float, default=20, help='发送阶段持续时间（秒）')
+    parser.add_argument('--drain', type=float, default=1, help='发送结束后继续接收的时间（秒）')
+    parser.add_argument('--ramp', type=float, default=100, help='每秒新建会话数，0 表示一次性建立')
+    parser.add_argument('--prefix', default='vt_', help='用户名前缀')
+    parser.add_argument('--timeout', type=float, default=10, help='连接超时（秒）')
+    parser.add_argument('--report-interval', type=float, default=5, help='中间结果打印间隔（秒）')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_load(args))
+    except KeyboardInterrupt:
+        print("\n压测中断")
+
+
+if __name__ == "__main__":
+    main()
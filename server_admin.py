@@ -0,0 +1,149 @@
+# server_admin.py
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    """管理端口请求处理"""
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, data):
+        self.send_body(code, json.dumps(data, ensure_ascii=False).encode(), 'application/json; charset=utf-8')
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = self.server.metrics.render().encode()
+            self.send_body(200, body, 'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/profile/status' and self.server.profiler:
+            self.send_json(200, self.server.profiler.status())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        """运行时分析控制，不影响已连接的客户端"""
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        profiler = self.server.profiler
+        if not profiler:
+            self.send_error(404)
+            return
+        try:
+            if url.path == '/profile/start':
+                profiler.start(params.get('mode', 'sampling'), float(params.get('interval', 0.005)))
+                result = profiler.status()
+            elif url.path == '/profile/stop':
+                result = {'stopped': profiler.stop()}
+            elif url.path == '/profile/dump':
+                path, summary = profiler.dump()
+                result = {'path': path, 'summary': summary}
+            elif url.path == '/tracemalloc/start':
+                profiler.tracemalloc_start(int(params.get('frames', 1)))
+                result = profiler.status()
+            elif url.path == '/tracemalloc/snapshot':
+                path, summary = profiler.tracemalloc_snapshot(int(params.get('top', 20)))
+                result = {'path': path, 'summary': summary}
+            elif url.path == '/tracemalloc/stop':
+                profiler.tracemalloc_stop()
+                result = profiler.status()
+            else:
+                self.send_error(404)
+                return
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except RuntimeError as e:
+            self.send_json(409, {'error': str(e)})
+        else:
+            self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        # 抓取指标很频繁，不打印访问日志
+        pass
+
+
+class AdminServer:
+    """本地管理 HTTP 服务，提供 /metrics 和运行时分析控制"""
+
+    def __init__(self, metrics, host='127.0.0.1', port=8890, profiler=None):
+        self.metrics = metrics
+        self.profiler = profiler
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        """在后台线程中启动管理服务"""
+        self.httpd = ThreadingHTTPServer((self.host, self.port), AdminRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = self.metrics
+        self.httpd.profiler = self.profiler
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print(f"管理服务启动在 http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        """关闭管理服务"""
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+# 命令行动作 -> (HTTP 方法, 路径)
+ACTIONS = {
+    'status': ('GET', '/profile/status'),
+    'profile-start': ('POST', '/profile/start'),
+    'profile-stop': ('POST', '/profile/stop'),
+    'profile-dump': ('POST', '/profile/dump'),
+    'tracemalloc-start': ('POST', '/tracemalloc/start'),
+    'tracemalloc-snapshot': ('POST', '/tracemalloc/snapshot'),
+    'tracemalloc-stop': ('POST', '/tracemalloc/stop'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='向运行中的服务器发送管理命令')
+    parser.add_argument('action', choices=sorted(ACTIONS))
+    parser.add_argument('--port', type=int, default=8890, help='管理端口')
+    parser.add_argument('--mode', choices=['sampling', 'deterministic'], default='sampling', help='profile-start 的分析模式')
+    parser.add_argument('--interval', type=float, default=0.005, help='采样间隔（秒）')
+    parser.add_argument('--frames', type=int, default=1, help='tracemalloc 记录的栈深度，越深开销越大')
+    args = parser.parse_args()
+
+    method, path = ACTIONS[args.action]
+    if args.action == 'profile-start':
+        path += f'?mode={args.mode}&interval={args.interval}'
+    elif args.action == 'tracemalloc-start':
+        path += f'?frames={args.frames}'
+    request = urllib.request.Request(f'http://127.0.0.1:{args.port}{path}', method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read().decode())
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read().decode()).get('error', e)
+        except ValueError:
+            message = e
+        print(f"[错误] {message}")
+        return
+    summary = result.pop('summary', None)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if summary:
+        print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# server_attachments.py
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import re
+import threading
+
+from server_metrics import MetricsRegistry
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class AttachmentStore:
+    """按内容 SHA-256 寻址的附件存储：同样的内容只保存一份，消息里只带哈希"""
+
+    def __init__(self, root='attachments', metrics=None):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.stored_total = self.metrics.counter('attachments_stored_total', '按是否重复统计的附件上传数', ['result'])
+        self.stored_bytes = self.metrics.counter('attachments_stored_bytes_total', '新写入附件存储的字节数')
+        self.downloads_total = self.metrics.counter('attachments_downloads_total', '按结果统计的附件下载请求数', ['result'])
+        self.downloaded_bytes = self.metrics.counter('attachments_downloaded_bytes_total', '附件下载发送的字节数')
+
+    def path(self, digest):
+        """哈希对应的文件路径，哈希格式不对时返回 None"""
+        if not isinstance(digest, str) or not _DIGEST_RE.match(digest):
+            return None
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        path = self.path(digest)
+        return path is not None and os.path.exists(path)
+
+    def put(self, data):
+        """保存附件内容，返回 (哈希, 大小)；内容已存在时不重复写入"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        with self.lock:
+            if os.path.exists(path):
+                self.stored_total.inc(result='duplicate')
+                return digest, len(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        self.stored_total.inc(result='new')
+        self.stored_bytes.inc(len(data))
+        return digest, len(data)
+
+    def put_file(self, temp_path, digest):
+        """把已写好的临时文件放入存储，内容与 digest 不符时删除临时文件并抛出 ValueError；返回 (哈希, 大小)"""
+        sha = hashlib.sha256()
+        size = 0
+        with open(temp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+                size += len(chunk)
+        path = self.path(digest)
+        if path is None or sha.hexdigest() != digest:
+            os.remove(temp_path)
+            raise ValueError('文件校验失败')
+        with self.lock:
+            if os.path.exists(path):
+                os.remove(temp_path)
+                self.stored_total.inc(result='duplicate')
+                return digest, size
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        self.stored_total.inc(result='new')
+        self.stored_bytes.inc(size)
+        return digest, size
+
+    def open(self, digest):
+        """以二进制只读方式打开附件，不存在时返回 None"""
+        path = self.path(digest)
+        try:
+            f = open(path, 'rb')
+        except (TypeError, OSError):
+            self.downloads_total.inc(result='missing')
+            return None
+        self.downloads_total.inc(result='ok')
+        return f
+
+    def get(self, digest, max_size=None):
+        """读取附件内容，不存在时返回 None；超过 max_size 字节时抛出 ValueError，不读取"""
+        path = self.path(digest)
+        try:
+            with open(path, 'rb') as f:
+                if max_size is not None and os.fstat(f.fileno()).st_size > max_size:
+                    raise ValueError('附件太大')
+                data = f.read()
+        except (TypeError, OSError):
+            self.downloads_total.inc(result='missing')
+            return None
+        self.downloads_total.inc(result='ok')
+        self.downloaded_bytes.inc(len(data))
+        return data
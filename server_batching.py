@@ -0,0 +1,103 @@
+# server_batching.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from server_metrics import MetricsRegistry
+
+
+class SendBatcher:
+    """广播合并发送：窗口期内发给同一连接的广播和上下线通知攒在一起，一次 sendall 发出
+
+    窗口在 min_window 和 max_window 之间随负载调整：一次合并里平均每个连接攒到两条以上消息时加大窗口，
+    每个连接都只有一条（合并没有收益）时减小窗口，空闲时广播只多等 min_window。
+    直接发送（send_now）先把该连接还没发出的广播一起发出，保证同一连接上的消息顺序不变。
+    """
+
+    def __init__(self, max_window=0.005, min_window=None, on_error=None, metrics=None):
+        self.max_window = max_window
+        self.min_window = min_window if min_window is not None else max_window / 10
+        self.window = self.min_window
+        self.on_error = on_error      # 批量发送失败时调用 on_error(sock)
+        self.lock = threading.Lock()
+        self.pending = {}             # 连接 -> 等待发送的数据列表
+        self.socket_locks = {}        # 连接 -> 发送锁，同一连接同时只有一个线程在写
+        self.wakeup = threading.Event()
+
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.flushes_total = self.metrics.counter('chat_batch_flushes_total', '合并发送的轮数')
+        self.batched_messages = self.metrics.counter('chat_batch_messages_total', '经合并发送的消息数')
+        self.send_calls = self.metrics.counter('chat_send_calls_total', '聊天连接调用 sendall 的次数', ['mode'])
+        self.window_seconds = self.metrics.gauge('chat_batch_window_seconds', '当前的合并窗口')
+        self.window_seconds.set(self.window)
+
+    def start(self):
+        thread = threading.Thread(target=self.flush_loop)
+        thread.daemon = True
+        thread.start()
+
+    def socket_lock(self, sock):
+        with self.lock:
+            lock = self.socket_locks.get(sock)
+            if lock is None:
+                lock = self.socket_locks[sock] = threading.Lock()
+            return lock
+
+    def queue(self, sock, data):
+        """把一条消息加入该连接的待发送数据，窗口结束时发出"""
+        with self.lock:
+            self.pending.setdefault(sock, []).append(data)
+        self.wakeup.set()
+
+    def send_now(self, sock, data):
+        """立即发送（连同该连接还没发出的广播），失败时抛出异常"""
+        with self.socket_lock(sock):
+            with self.lock:
+                parts = self.pending.pop(sock, [])
+            parts.append(data)
+            sock.sendall(b''.join(parts))
+        return len(parts)
+
+    def discard(self, sock):
+        """连接关闭后丢弃它的待发送数据"""
+        with self.lock:
+            self.pending.pop(sock, None)
+            self.socket_locks.pop(sock, None)
+
+    def flush_loop(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.window)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """发出所有连接攒下的数据，并按本轮的合并程度调整窗口"""
+        with self.lock:
+            sockets = list(self.pending)
+        messages = 0
+        writes = 0
+        for sock in sockets:
+            with self.socket_lock(sock):
+                with self.lock:
+                    parts = self.pending.pop(sock, None)
+                if not parts:
+                    continue
+                try:
+                    sock.sendall(b''.join(parts))
+                except OSError:
+                    self.discard(sock)
+                    if self.on_error:
+                        self.on_error(sock)
+                messages += len(parts)
+                writes += 1
+        if not writes:
+            return
+        self.flushes_total.inc()
+        self.batched_messages.inc(messages)
+        self.send_calls.inc(writes, mode='batched')
+        if messages >= 2 * writes:
+            self.window = min(self.max_window, self.window * 1.5)
+        elif messages == writes:
+            self.window = max(self.min_window, self.window / 2)
+        self.window_seconds.set(self.window)
@@ -0,0 +1,157 @@
+# server_bulk.py
+# -*- coding: utf-8 -*-
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_protocol import JsonStreamDecoder, RECV_SIZE, encode_message
+from server_metrics import MetricsRegistry
+from server_ratelimit import RATE_LIMITED_MESSAGE
+
+IDLE_TIMEOUT = 10  # 秒；收不到任何数据就关闭连接，空闲连接不长时间占着工作线程
+
+
+class BulkServer:
+    """附件传输服务：文件上传和下载走单独的端口和线程池，不占用聊天连接，也不拿聊天服务器的全局锁
+
+    每个连接先发送 {"type": "bulk_hello", "token": ...}（登录聊天服务器时下发的令牌），之后按顺序处理请求。
+    连接在处理期间独占一个工作线程，IDLE_TIMEOUT 秒内收不到数据就关闭（客户端中断后会自动续传）。
+    """
+
+    def __init__(self, chat_server, host='0.0.0.0', port=8891, workers=16, metrics=None):
+        self.chat = chat_server
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk')
+
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.connections_total = self.metrics.counter('bulk_connections_total', '附件传输服务累计接受的连接数')
+        self.active_connections = self.metrics.gauge('bulk_active_connections', '正在由工作线程处理的附件传输连接数')
+        self.queued_connections = self.metrics.gauge('bulk_queued_connections', '等待空闲工作线程的附件传输连接数')
+        self.bytes_in = self.metrics.counter('bulk_bytes_received_total', '附件传输连接接收的字节数')
+        self.bytes_out = self.metrics.counter('bulk_bytes_sent_total', '附件传输连接发送的字节数')
+        self.requests_total = self.metrics.counter('bulk_requests_total', '按类型统计的附件传输请求数', ['type'])
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+
+    def start(self):
+        self.server.bind((self.host, self.port))
+        self.server.listen(socket.SOMAXCONN)
+        print(f"附件传输服务启动在 {self.host}:{self.port}（{self.workers} 个工作线程）")
+        while True:
+            client_socket, addr = self.server.accept()
+            self.connections_total.inc()
+            with self.queued_lock:
+                self.queued += 1
+                self.queued_connections.set(self.queued)
+            self.pool.submit(self.handle_connection, client_socket, addr)
+
+    def send(self, sock, message, payload=None):
+        data = encode_message(message, payload)
+        sock.sendall(data)
+        self.bytes_out.inc(len(data))
+
+    def receive(self, sock, decoder):
+        """读取下一条消息，连接关闭时返回 None"""
+        while not decoder.messages:
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.bytes_in.inc(len(data))
+            decoder.feed(data)
+        return decoder.pop()
+
+    def handle_connection(self, client_socket, addr):
+        """在工作线程中处理一个附件传输连接"""
+        with self.queued_lock:
+            self.queued -= 1
+            self.queued_connections.set(self.queued)
+        self.active_connections.inc()
+        decoder = JsonStreamDecoder()
+        try:
+            client_socket.settimeout(IDLE_TIMEOUT)
+            hello = self.receive(client_socket, decoder)
+            username = self.chat.bulk_user(hello.get('token')) if hello and hello.get('type') == 'bulk_hello' else None
+            if not username:
+                self.send(client_socket, {'type': 'bulk_error', 'error': '令牌无效，请重新登录'})
+                return
+            self.send(client_socket, {'type': 'bulk_ready'})
+
+            while True:
+                request = self.receive(client_socket, decoder)
+                if not request:
+                    break
+                self.handle_request(client_socket, username, request)
+        except Exception as e:
+            print(f"[附件] 连接 {addr} 错误: {e}")
+        finally:
+            self.active_connections.dec()
+            client_socket.close()
+
+    def handle_request(self, client_socket, username, request):
+        """处理一条上传或下载请求"""
+        msg_type = request.get('type')
+        self.requests_total.inc(type=str(msg_type))
+        uploads = self.chat.uploads
+
+        if msg_type == 'file_upload_request':
+            # 分块上传：见 file_upload_protocol.md
+            try:
+                response = uploads.start(username, request)
+            except ValueError as e:
+                response = {'type': 'file_upload_error', 'file_id': request.get('file_id'), 'error': str(e)}
+            self.send(client_socket, response)
+
+        elif msg_type == 'file_upload_chunk':
+            response = uploads.chunk(username, request, request.get('payload', b''))
+            if response:
+                self.send(client_socket, response)
+
+        elif msg_type == 'file_upload_complete':
+            file_id = request.get('file_id')
+            # 和聊天连接上发送文件、图片共用该用户的 attachment 令牌桶
+            if not self.chat.check_rate(username, 'attachment'):
+                self.send(client_socket, {'type': 'file_upload_error', 'file_id': file_id, 'error': RATE_LIMITED_MESSAGE})
+                return
+            try:
+                upload = uploads.complete(username, file_id)
+            except ValueError as e:
+                self.send(client_socket, {'type': 'file_upload_error', 'file_id': file_id, 'error': str(e)})
+                return
+            self.send(client_socket, {'type': 'file_upload_done', 'file_id': file_id, 'file_hash': upload['hash']})
+            self.chat.announce_attachment(username, upload['kind'], upload['name'], upload['hash'],
+                                          upload['size'], upload['target'])
+
+        elif msg_type == 'attachment_get':
+            self.send_attachment(client_socket, request.get('hash'), request.get('offset', 0), request.get('length'))
+
+        else:
+            self.send(client_socket, {'type': 'bulk_error', 'error': f'未知请求: {msg_type}'})
+
+    def send_attachment(self, client_socket, digest, offset=0, length=None):
+        """先发送 attachment_data（stream_size 为数据长度），再用 sendfile 直接从附件文件发送 [offset, offset + length)，数据不经过 Python 内存"""
+        store = self.chat.attachments
+        f = store.open(digest)
+        if f is None:
+            self.send(client_socket, {'type': 'attachment_data', 'hash': digest, 'error': '附件不存在'})
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if length is None:
+                length = size - offset if isinstance(offset, int) else None
+            if not isinstance(offset, int) or not isinstance(length, int) or not 0 <= offset <= size or length < 0:
+                self.send(client_socket, {'type': 'attachment_data', 'hash': digest, 'error': '范围无效'})
+                return
+            length = min(length, size - offset)
+            header = {'type': 'attachment_data', 'hash': digest, 'size': size, 'offset': offset, 'length': length}
+            if length:
+                header['stream_size'] = length
+            self.send(client_socket, header)
+            if length:
+                sent = client_socket.sendfile(f, offset, length)
+                self.bytes_out.inc(sent)
+                store.downloaded_bytes.inc(sent)
@@ -0,0 +1,216 @@
+# server_history.py
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from server_metrics import MetricsRegistry
+
+CHAT_ROOM = 'chat_room'
+
+
+def private_conversation(user_a, user_b):
+    """两人私聊的会话键，与双方顺序无关；用 JSON 数组表示两个用户名，任何用户名都不会拼出别人的会话键"""
+    return 'private:' + json.dumps(sorted((user_a, user_b)), ensure_ascii=False)
+
+
+def channel_conversation(channel):
+    """频道的会话键；默认的聊天室仍用 CHAT_ROOM"""
+    return CHAT_ROOM if channel == CHAT_ROOM else f"channel:{channel}"
+
+
+class HistoryStore:
+    """聊天记录：每个会话一个内存环形缓冲区用于热读，批量异步写入 SQLite（WAL 模式）"""
+
+    COLUMNS = ('id', 'conversation', 'sender', 'target', 'type', 'message', 'timestamp')
+
+    def __init__(self, db_path='chat_history.db', ring_size=200, max_conversations=1000,
+                 flush_interval=0.5, batch_size=500, metrics=None):
+        self.db_path = db_path
+        self.ring_size = ring_size
+        self.max_conversations = max_conversations
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.lock = threading.Lock()
+        self.rings = OrderedDict()  # conversation -> {'messages': deque, 'complete': bool}
+        self.pending = []           # 尚未写入数据库的记录
+        self.in_flight = []         # 正在写入数据库的记录
+        self.flush_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+
+        self.write_conn = self._connect()
+        self.write_conn.execute('PRAGMA journal_mode=WAL')
+        self.write_conn.execute('PRAGMA synchronous=NORMAL')
+        self.write_conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                conversation TEXT NOT NULL,
+                sender TEXT,
+                target TEXT,
+                type TEXT,
+                message TEXT,
+                timestamp TEXT
+            )''')
+        self.write_conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, id)')
+        self.migrate_private_keys()
+        self.write_conn.commit()
+        self.read_conn = self._connect()
+        self.last_id = self.write_conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.messages_total = self.metrics.counter('chat_history_messages_total', '写入聊天记录的消息数')
+        self.pending_gauge = self.metrics.gauge('chat_history_pending', '等待写入数据库的聊天记录数')
+        self.flush_seconds = self.metrics.histogram('chat_history_flush_seconds', '一批聊天记录写入数据库的耗时')
+        self.reads_total = self.metrics.counter('chat_history_reads_total', '按来源统计的历史分页读取次数', ['source'])
+
+        self.running = True
+        self.wakeup = threading.Event()
+        self.writer = threading.Thread(target=self.write_loop, name='history-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def migrate_private_keys(self):
+        """把旧格式的私聊会话键 private:a|b 改为 private_conversation 的格式；含多个 | 的无法确定双方，保持不变"""
+        rows = self.write_conn.execute(
+            "SELECT DISTINCT conversation FROM messages WHERE conversation LIKE 'private:%' "
+            "AND conversation NOT LIKE 'private:[%'"
+        ).fetchall()
+        for (key,) in rows:
+            users = key[len('private:'):].split('|')
+            if len(users) == 2:
+                self.write_conn.execute('UPDATE messages SET conversation = ? WHERE conversation = ?',
+                                        (private_conversation(*users), key))
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def append(self, conversation, sender, message, msg_type, target=None):
+        """记录一条消息，返回带有全局递增 id 和时间戳的记录"""
+        self._ring(conversation)
+        with self.lock:
+            self.last_id += 1
+            entry = {
+                'id': self.last_id,
+                'conversation': conversation,
+                'sender': sender,
+                'target': target,
+                'type': msg_type,
+                'message': message,
+                'timestamp': datetime.datetime.now().isoformat()
+            }
+            # 预热之后缓冲区可能已被淘汰，此时记录只在 pending 中，下次预热会读到
+            ring = self.rings.get(conversation)
+            if ring is not None:
+                if len(ring['messages']) == self.ring_size:
+                    ring['complete'] = False
+                ring['messages'].append(entry)
+            self.pending.append(entry)
+            self.pending_gauge.set(len(self.pending))
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+        self.messages_total.inc()
+        return entry
+
+    def page(self, conversation, before=None, limit=50):
+        """返回 id 小于 before 的最近 limit 条消息（从旧到新）以及是否还有更早的消息"""
+        self._ring(conversation)
+        with self.lock:
+            ring = self.rings.get(conversation)
+            if ring is not None:
+                messages = [e for e in ring['messages'] if before is None or e['id'] < before]
+                if len(messages) > limit or ring['complete']:
+                    self.reads_total.inc(source='memory')
+                    return messages[-limit:], len(messages) > limit
+        self.reads_total.inc(source='sqlite')
+        messages = self._load(conversation, before, limit + 1)
+        return messages[-limit:], len(messages) > limit
+
+    def _ring(self, conversation):
+        """取得会话的环形缓冲区，首次访问时从数据库预热（调用方不能持有 self.lock，之后加锁时应重新从 self.rings 取）
+
+        读数据库不持有 self.lock，其他会话的写入和读取不会等待磁盘；读完再加锁放入，
+        期间已有其他线程放入时用已有的那个。新消息在取得缓冲区之后才分配 id，不会漏掉。
+        """
+        with self.lock:
+            ring = self.rings.get(conversation)
+            if ring is not None:
+                self.rings.move_to_end(conversation)
+                return ring
+        messages = self._load(conversation, None, self.ring_size)
+        with self.lock:
+            ring = self.rings.get(conversation)
+            if ring is None:
+                ring = {'messages': deque(messages, maxlen=self.ring_size),
+                        'complete': len(messages) < self.ring_size}
+                self.rings[conversation] = ring
+                if len(self.rings) > self.max_conversations:
+                    self.rings.popitem(last=False)
+            return ring
+
+    def _load(self, conversation, before, limit):
+        """从数据库读取，并合并尚未落盘的记录（调用方不能持有 self.lock）"""
+        with self.lock:
+            # 先取未落盘的记录再查数据库：写线程在提交之后才清空 in_flight，两者之间不会漏掉
+            unflushed = [e for e in self.in_flight + self.pending
+                         if e['conversation'] == conversation and (before is None or e['id'] < before)]
+        with self.read_lock:
+            rows = self.read_conn.execute(
+                'SELECT id, conversation, sender, target, type, message, timestamp FROM messages '
+                'WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                (conversation, before if before is not None else self.last_id + 1, limit)
+            ).fetchall()
+        merged = {e['id']: e for e in (dict(zip(self.COLUMNS, row)) for row in rows)}
+        merged.update((e['id'], e) for e in unflushed)
+        return [merged[key] for key in sorted(merged)[-limit:]]
+
+    def write_loop(self):
+        """后台写线程：定时或积累到一批后写入数据库"""
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"[错误] 写入聊天记录失败: {e}")
+
+    def flush(self):
+        """把待写入的记录在一个事务中写入数据库"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                batch = self.in_flight = self.pending
+                self.pending = []
+                self.pending_gauge.set(0)
+            start = time.perf_counter()
+            try:
+                with self.write_conn:
+                    self.write_conn.executemany(
+                        'INSERT OR IGNORE INTO messages (id, conversation, sender, target, type, message, timestamp) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        [tuple(e[column] for column in self.COLUMNS) for e in batch]
+                    )
+            except sqlite3.Error:
+                # 写入失败时放回队列，下次重试
+                with self.lock:
+                    self.pending = batch + self.pending
+                    self.in_flight = []
+                    self.pending_gauge.set(len(self.pending))
+                raise
+            self.flush_seconds.observe(time.perf_counter() - start)
+            with self.lock:
+                self.in_flight = []
+
+    def close(self):
+        """停止写线程并写入剩余记录"""
+        self.running = False
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+        self.write_conn.close()
+        self.read_conn.close()
@@ -0,0 +1,235 @@
+# server_profiler.py
+# -*- coding: utf-8 -*-
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+class SamplingProfiler:
+    """采样分析器：定时抓取所有线程的调用栈，生成火焰图用的折叠栈"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    self.samples[';'.join(reversed(stack))] += 1
+                self.sample_count += 1
+            del frames
+            time.sleep(self.interval)
+
+    def dump(self, path):
+        """写出折叠栈（每行：栈;栈;栈 次数），可直接交给 flamegraph.pl / speedscope"""
+        with self.lock:
+            items = sorted(self.samples.items())
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in items:
+                f.write(f"{stack} {count}\n")
+        return len(items)
+
+
+class RuntimeProfiler:
+    """可在运行中开关的分析器，支持确定性（cProfile）和采样两种模式，以及 tracemalloc 快照"""
+
+    def __init__(self, dump_dir='profiles'):
+        self.dump_dir = dump_dir
+        self.mode = None
+        self.started_at = None
+        self.sampler = None
+        self.lock = threading.Lock()
+        # 确定性模式：每个线程一个 cProfile，只在处理消息期间启用；
+        # 同一时刻只有一个线程启用（Python 3.12 起同时启用第二个会抛出 ValueError），其他线程的这次处理不计入
+        self.thread_profiles = {}  # thread ident -> (Profile, Lock)
+        self.profiling = threading.Lock()
+        self.profiled_sections = 0
+        self.skipped_sections = 0
+        self.last_snapshot = None
+
+    def status(self):
+        """当前状态"""
+        return {
+            'mode': self.mode,
+            'running_seconds': round(time.time() - self.started_at, 1) if self.started_at else 0,
+            'profiled_threads': len(self.thread_profiles),
+            'profiled_sections': self.profiled_sections,
+            'skipped_sections': self.skipped_sections,
+            'note': self.coverage_note(),
+            'samples': self.sampler.sample_count if self.sampler else 0,
+            'tracemalloc': tracemalloc.is_tracing()
+        }
+
+    def start(self, mode='sampling', interval=0.005):
+        """开始分析；已在运行时抛出 RuntimeError"""
+        if mode not in ('sampling', 'deterministic'):
+            raise ValueError(f"未知的分析模式: {mode}")
+        with self.lock:
+            if self.mode:
+                raise RuntimeError(f"分析器已在运行（{self.mode}）")
+            self.thread_profiles = {}
+            self.profiled_sections = 0
+            self.skipped_sections = 0
+            self.sampler = None
+            if mode == 'sampling':
+                self.sampler = SamplingProfiler(interval)
+                self.sampler.start()
+            self.mode = mode
+            self.started_at = time.time()
+        print(f"[分析] 已启动 {mode} 分析")
+
+    def stop(self):
+        """停止分析，已收集的数据保留到下一次 start，可继续 dump"""
+        with self.lock:
+            mode = self.mode
+            self.mode = None
+            self.started_at = None
+        if self.sampler:
+            self.sampler.stop()
+        print(f"[分析] 已停止 {mode} 分析")
+        return mode
+
+    def coverage_note(self):
+        """确定性模式的覆盖情况：同一时刻只分析一个线程，并发处理的消息不计入结果"""
+        with self.lock:
+            profiled, skipped = self.profiled_sections, self.skipped_sections
+        if not profiled and not skipped:
+            return None
+        return (f"确定性分析同一时刻只分析一个处理线程：已分析 {profiled} 次消息处理，"
+                f"跳过 {skipped} 次（{skipped / (profiled + skipped):.0%}）与之并发的处理")
+
+    def count_section(self, profiled):
+        with self.lock:
+            if profiled:
+                self.profiled_sections += 1
+            else:
+                self.skipped_sections += 1
+
+    @contextmanager
+    def section(self):
+        """包裹一次消息处理；确定性模式下在当前线程启用 cProfile，已有线程在分析时不分析这一次"""
+        if self.mode != 'deterministic' or not self.profiling.acquire(blocking=False):
+            if self.mode == 'deterministic':
+                self.count_section(False)
+            yield
+            return
+        try:
+            ident = threading.get_ident()
+            entry = self.thread_profiles.get(ident)
+            if entry is None:
+                entry = self.thread_profiles.setdefault(ident, (cProfile.Profile(), threading.Lock()))
+            profile, profile_lock = entry
+            with profile_lock:
+                try:
+                    profile.enable()
+                    enabled = True
+                except ValueError:
+                    # 其他分析工具（调试器、sys.monitoring）正在使用，不影响消息处理
+                    enabled = False
+                self.count_section(enabled)
+                try:
+                    yield
+                finally:
+                    if enabled:
+                        profile.disable()
+        finally:
+            self.profiling.release()
+
+    def _dump_path(self, suffix):
+        os.makedirs(self.dump_dir, exist_ok=True)
+        name = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.abspath(os.path.join(self.dump_dir, f"{name}-{os.getpid()}{suffix}"))
+
+    def dump(self, top=30):
+        """把已收集的数据写入磁盘，返回 (文件路径, 摘要文本)"""
+        if self.sampler:
+            path = self._dump_path('.folded')
+            stacks = self.sampler.dump(path)
+            return path, f"{self.sampler.sample_count} 次采样，{stacks} 条不同调用栈"
+
+        stats = None
+        for profile, profile_lock in list(self.thread_profiles.values()):
+            # 持有线程锁，保证该线程此刻不在处理消息
+            with profile_lock:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+        if stats is None:
+            raise RuntimeError("没有可导出的分析数据")
+        path = self._dump_path('.prof')
+        stats.dump_stats(path)
+        summary_path = path[:-len('.prof')] + '.txt'
+        note = self.coverage_note()
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            if note:
+                f.write(note + '\n')
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(top)
+        with open(summary_path, encoding='utf-8') as f:
+            return path, f.read()
+
+    def tracemalloc_start(self, frames=1):
+        """开始跟踪内存分配；frames 越大开销越高（25 层时消息延迟会升到秒级）"""
+        if tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc 已在运行")
+        tracemalloc.start(frames)
+        self.last_snapshot = None
+        print(f"[分析] tracemalloc 已启动（{frames} 层栈）")
+
+    def tracemalloc_stop(self):
+        tracemalloc.stop()
+        self.last_snapshot = None
+        print("[分析] tracemalloc 已停止")
+
+    def tracemalloc_snapshot(self, top=20):
+        """保存内存快照，返回 (文件路径, 按行统计的摘要；有上一快照时附带差异)"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc 未启动")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        path = self._dump_path('.tracemalloc')
+        snapshot.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"当前 {current / 1024:.1f} KB，峰值 {peak / 1024:.1f} KB", "", f"占用最多的 {top} 处:"]
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:top])
+        if self.last_snapshot is not None:
+            lines.extend(["", f"与上一快照相比变化最大的 {top} 处:"])
+            lines.extend(str(stat) for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:top])
+        self.last_snapshot = snapshot
+        return path, '\n'.join(lines)
@@ -0,0 +1,91 @@
+# server_ratelimit.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+# 按消息类别限流（聊天按用户，语音按连接）：类别 -> (每秒补充的令牌数, 桶容量即允许的突发数)
+CHAT_RATE_LIMITS = {
+    'text': (5, 20),          # 聊天室、频道、私聊消息和通话状态通知
+    'attachment': (1, 5),     # 发送文件、图片（含附件端口上完成的上传），按哈希下载附件
+    'roster': (2, 10),        # users、history 命令，加入、离开频道
+}
+
+# 音频帧按 1024 个采样（44100Hz 下约 43 帧/秒）计数，留一些余量给网络抖动后的补发
+VOICE_RATE_LIMITS = {
+    'audio': (60, 120),       # 音频帧
+    'signal': (5, 20),        # ping、加入离开房间、呼叫、接听、挂断等命令
+}
+
+# 聊天消息开始被丢弃时给发送者的提示
+RATE_LIMITED_MESSAGE = '发送太快，部分消息没有送出，请稍后再试'
+
+# 消息类型 -> 类别，不在表中的类型（心跳、断开等）不限流
+CHAT_MESSAGE_CLASSES = {
+    'message': 'text',
+    'private': 'text',
+    'voice_status': 'text',
+    'file': 'attachment',
+    'private_file': 'attachment',
+    'image': 'attachment',
+    'private_image': 'attachment',
+    'attachment_get': 'attachment',
+    'command': 'roster',
+    'join_channel': 'roster',
+    'leave_channel': 'roster',
+}
+
+VOICE_COMMAND_CLASSES = {
+    'audio_data': 'audio',
+    'ping': 'signal',
+    'latency_report': 'signal',
+    'join_room': 'signal',
+    'leave_room': 'signal',
+    'start_private_call': 'signal',
+    'accept_call': 'signal',
+    'reject_call': 'signal',
+    'end_call': 'signal',
+}
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多攒 burst 个，每条消息消耗 cost 个"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1, now=None):
+        """令牌足够时扣除并返回 True，否则返回 False（不扣除）"""
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    """一个用户或连接的限流器，每个类别一个令牌桶；聊天连接和附件连接的线程会同时使用，加锁"""
+
+    def __init__(self, limits):
+        self.buckets = {category: TokenBucket(rate, burst) for category, (rate, burst) in limits.items()}
+        self.dropped = dict.fromkeys(self.buckets, 0)  # 类别 -> 连续丢弃的消息数，放行一条后清零
+        self.lock = threading.Lock()
+
+    def allow(self, category, cost=1):
+        """该类别的消息是否放行；没有配置限额的类别总是放行"""
+        bucket = self.buckets.get(category)
+        if bucket is None:
+            return True
+        with self.lock:
+            if bucket.take(cost):
+                self.dropped[category] = 0
+                return True
+            self.dropped[category] += 1
+            return False
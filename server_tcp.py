@@ -5,14 +5,32 @@ import threading
 import json
 import sys
 import base64
-import os
 import time
 import struct
 import pickle
+import secrets
+import re
+from collections import deque
+
+from server_metrics import MetricsRegistry, TimedLock
+from server_admin import AdminServer
+from server_profiler import RuntimeProfiler
+from server_attachments import AttachmentStore
+from server_uploads import UploadManager
+from server_bulk import BulkServer
+from server_batching import SendBatcher
+from server_timers import TimerWheel
+from server_ratelimit import RateLimiter, RATE_LIMITED_MESSAGE, CHAT_RATE_LIMITS, VOICE_RATE_LIMITS, CHAT_MESSAGE_CLASSES, VOICE_COMMAND_CLASSES
+from server_history import HistoryStore, CHAT_ROOM, private_conversation, channel_conversation
+from chat_protocol import JsonStreamDecoder, RECV_SIZE, COMPRESSION, compress_frame
+
+CHANNEL_NAME = re.compile(r'^#[^\s#]{1,32}$')  # 频道名以 # 开头，用户名不能以 # 开头
+RESERVED_NAMES = {CHAT_ROOM, '系统'}  # 会话名和系统消息的发送者，不能用作用户名
+INLINE_ATTACHMENT_MAX = 1024 * 1024  # 聊天连接上 attachment_get 能取的最大附件，更大的只能走附件端口
 
 class VoiceServer:
     """语音服务器类，处理语音通话"""
-    def __init__(self, host='0.0.0.0', voice_port=8889):
+    def __init__(self, host='0.0.0.0', voice_port=8889, metrics=None, profiler=None, timers=None, rate_limits=VOICE_RATE_LIMITS):
         self.host = host
         self.voice_port = voice_port
         self.voice_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -22,6 +40,25 @@ class VoiceServer:
         self.voice_clients = {}  # username -> voice_socket
         self.voice_rooms = {}    # room_id -> {usernames}
         self.private_calls = {}  # caller -> callee
+        self.send_locks = {}     # voice_socket -> 发送锁，避免多个线程的帧交错
+        
+        # 超时（秒）：连接后发来用户名、两条命令之间（客户端每 2 秒 ping 一次）、呼叫无人接听
+        self.handshake_timeout = 10
+        self.idle_timeout = 30
+        self.ring_timeout = 30
+        self.last_seen = {}      # voice_socket -> 最近一次收到命令的时间
+        self.idle_timers = {}    # voice_socket -> 空闲检查定时器
+        self.ring_timers = {}    # caller -> 呼叫超时定时器
+        
+        # 可恢复的会话：连接意外断开后保留房间和通话状态 resume_grace 秒，客户端带令牌重连即可继续
+        self.resume_grace = 20
+        self.sessions = {}       # username -> {'token', 'socket', 'grace_timer'}
+        
+        # 每个连接按类别限流（音频帧、信令命令），超出的命令在转发前丢弃
+        self.rate_limits = rate_limits
+        
+        # 逐帧打印音频日志（调试用，高负载时会严重拖慢转发）
+        self.verbose_audio_log = False
         
         # 音频参数
         self.CHUNK = 1024
@@ -29,7 +66,59 @@ class VoiceServer:
         self.CHANNELS = 1
         self.RATE = 44100
         
-        self.lock = threading.Lock()
+        # 运行指标（与聊天服务器共用同一个注册表）
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.init_metrics()
+        
+        self.lock = TimedLock(self.lock_wait_seconds, 'voice')
+        
+        # 时间轮（与聊天服务器共用，单独运行时自己创建）
+        if timers is None:
+            timers = TimerWheel(metrics=self.metrics)
+            timers.start()
+        self.timers = timers
+        
+        # 运行时分析器（由管理端口开关）
+        self.profiler = profiler if profiler is not None else RuntimeProfiler()
+    
+    def init_metrics(self):
+        """注册语音服务器指标"""
+        m = self.metrics
+        self.connections_total = m.counter('voice_connections_total', '语音服务器累计接受的连接数')
+        self.connected_clients = m.gauge('voice_connected_clients', '当前在线的语音客户端数')
+        self.sessions_total = m.counter('voice_sessions_total', '按结果统计的语音会话（new 为新会话，resumed 为断线重连后恢复，expired 为没有按时重连）', ['event'])
+        self.timeouts_total = m.counter('voice_timeouts_total', '按原因统计的语音超时（handshake、idle 为断开连接，ring 为呼叫无人接听）', ['reason'])
+        self.commands_total = m.counter('voice_commands_received_total', '按类型统计的语音命令数', ['type'])
+        self.throttled_total = m.counter('voice_throttled_total', '超出限流被丢弃的语音命令数（audio 按 1024 个采样计）', ['category'])
+        self.bytes_in = m.counter('voice_bytes_received_total', '语音连接接收的字节数')
+        self.bytes_out = m.counter('voice_bytes_sent_total', '语音连接发送的字节数')
+        self.frames_forwarded = m.counter('voice_audio_frames_forwarded_total', '成功转发的音频帧数')
+        self.frames_dropped = m.counter('voice_audio_frames_dropped_total', '转发失败而丢弃的音频帧数')
+        self.room_listeners = m.gauge('voice_room_listeners', '每个语音房间的在线人数', ['room'])
+        self.send_queue_depth = m.gauge('voice_send_queue_depth', '正在等待 sendall 完成的发送数')
+        self.lock_wait_seconds = m.histogram('server_lock_wait_seconds', '获取服务器全局锁的等待时间', ['lock'])
+        self.uplink_seconds = m.histogram('voice_uplink_seconds', '音频帧从采集到到达服务器的时间（已校正时钟偏移）')
+        self.forward_seconds = m.histogram('voice_server_forward_seconds', '音频帧在服务器内从接收到发出的时间')
+        self.mouth_to_ear_seconds = m.gauge('voice_mouth_to_ear_seconds', '客户端上报的端到端延迟百分位数', ['user', 'quantile'])
+    
+    def update_room_gauge(self, room_id):
+        """刷新房间人数指标（调用方需持有锁）"""
+        if room_id in self.voice_rooms:
+            self.room_listeners.set(len(self.voice_rooms[room_id]), room=room_id)
+        else:
+            self.room_listeners.remove(room=room_id)
+    
+    def recv_exact(self, sock, length):
+        """接收指定长度的数据，连接关闭时返回已收到的部分"""
+        data = b''
+        while len(data) < length:
+            remaining = length - len(data)
+            chunk = sock.recv(min(4096, remaining))
+            if not chunk:
+                break
+            data += chunk
+        self.bytes_in.inc(len(data))
+        return data
     
     def send_with_length_prefix(self, sock, data):
         """发送带有长度前缀的数据"""
@@ -37,26 +126,34 @@ class VoiceServer:
         serialized_data = pickle.dumps(data)
         
         # 2. 计算数据长度并转换为4字节的大端序
-        import struct
         length_prefix = struct.pack('>I', len(serialized_data))
         
         # 3. 发送长度前缀 + 数据
+        send_lock = self.send_locks.get(sock)
+        if send_lock is None:
+            send_lock = self.send_locks.setdefault(sock, threading.Lock())
+        self.send_queue_depth.inc()
         try:
-            sock.sendall(length_prefix + serialized_data)
+            with send_lock:
+                sock.sendall(length_prefix + serialized_data)
+            self.bytes_out.inc(len(length_prefix) + len(serialized_data))
             return True
         except Exception as e:
             print(f"[错误] 发送数据失败: {e}")
             return False
+        finally:
+            self.send_queue_depth.dec()
     
     def start(self):
         """启动语音服务器"""
         self.voice_server.bind((self.host, self.voice_port))
-        self.voice_server.listen(5)
+        self.voice_server.listen(socket.SOMAXCONN)
         print(f"语音服务器启动在 {self.host}:{self.voice_port}")
         
         while True:
             voice_socket, addr = self.voice_server.accept()
             print(f"新语音连接: {addr}")
+            self.connections_total.inc()
             
             # 为新语音客户端创建线程
             thread = threading.Thread(
@@ -68,202 +165,79 @@ class VoiceServer:
     
     def handle_voice_client(self, voice_socket):
         """处理语音客户端连接"""
+        username = None
+        limiter = RateLimiter(self.rate_limits)
+        # 连接后 handshake_timeout 秒内没有发来用户名就断开
+        handshake_timer = self.timers.schedule(self.handshake_timeout, self.expire_connection, voice_socket, 'handshake', kind='voice_handshake')
         try:
             # 接收用户名（使用长度前缀）
             # 1. 接收4字节的长度前缀
-            length_prefix = voice_socket.recv(4)
-            if not length_prefix:
+            length_prefix = self.recv_exact(voice_socket, 4)
+            if len(length_prefix) != 4:
                 return
             
             # 2. 解析长度
-            import struct
             data_length = struct.unpack('>I', length_prefix)[0]
             
             # 3. 接收完整的用户名数据
-            username_data = b''
-            while len(username_data) < data_length:
-                remaining = data_length - len(username_data)
-                chunk = voice_socket.recv(min(4096, remaining))
-                if not chunk:
-                    break
-                username_data += chunk
+            username_data = self.recv_exact(voice_socket, data_length)
             
             if len(username_data) != data_length:
                 print(f"[错误] 用户名数据接收不完整")
                 return
             
-            username = username_data.decode().strip()
+            # 新客户端发送 {"username", "resume_token"}，旧客户端只发送用户名
+            resume_token = None
+            if username_data.startswith(b'{'):
+                hello = json.loads(username_data.decode())
+                username = str(hello.get('username', '')).strip()
+                resume_token = hello.get('resume_token')
+            else:
+                username = username_data.decode().strip()
+            if not username:
+                return
+            handshake_timer.cancel()
             
             with self.lock:
+                resumed = self.attach_session(username, resume_token, voice_socket)
                 self.voice_clients[username] = voice_socket
+                self.connected_clients.set(len(self.voice_clients))
+                self.last_seen[voice_socket] = time.monotonic()
+                self.idle_timers[voice_socket] = self.timers.schedule(self.idle_timeout, self.check_idle, voice_socket, kind='voice_idle')
+                self.send_with_length_prefix(voice_socket, {
+                    'type': 'session',
+                    'token': self.sessions[username]['token'],
+                    'resumed': resumed,
+                    'grace': self.resume_grace
+                })
             
-            print(f"{username} 加入语音系统")
+            print(f"{username} {'恢复语音会话' if resumed else '加入语音系统'}")
             
             # 持续处理语音命令
             while True:
                 try:
                     # 1. 接收4字节的长度前缀
-                    length_prefix = voice_socket.recv(4)
-                    if not length_prefix:
+                    length_prefix = self.recv_exact(voice_socket, 4)
+                    if len(length_prefix) != 4:
                         break
                     
                     # 2. 解析长度
                     data_length = struct.unpack('>I', length_prefix)[0]
                     
                     # 3. 接收完整的数据
-                    cmd_data = b''
-                    while len(cmd_data) < data_length:
-                        remaining = data_length - len(cmd_data)
-                        chunk = voice_socket.recv(min(4096, remaining))
-                        if not chunk:
-                            break
-                        cmd_data += chunk
+                    cmd_data = self.recv_exact(voice_socket, data_length)
                     
                     if len(cmd_data) != data_length:
                         print(f"[错误] 数据接收不完整: 预期 {data_length} 字节，实际收到 {len(cmd_data)} 字节")
                         continue
                     
+                    received_at = time.time()
+                    self.last_seen[voice_socket] = time.monotonic()
                     command = pickle.loads(cmd_data)
-                    cmd_type = command.get('type')
-                    
-                    if cmd_type == 'join_room':
-                        # 加入语音聊天室
-                        room_id = command.get('room_id', 'public')
-                        with self.lock:
-                            if room_id not in self.voice_rooms:
-                                self.voice_rooms[room_id] = set()
-                            self.voice_rooms[room_id].add(username)
-                        
-                        print(f"{username} 加入语音房间 {room_id}")
-                        
-                    elif cmd_type == 'leave_room':
-                        # 离开语音聊天室
-                        room_id = command.get('room_id', 'public')
-                        with self.lock:
-                            if room_id in self.voice_rooms and username in self.voice_rooms[room_id]:
-                                self.voice_rooms[room_id].remove(username)
-                                if not self.voice_rooms[room_id]:
-                                    del self.voice_rooms[room_id]
-                        
-                        print(f"{username} 离开语音房间 {room_id}")
-                        
-                    elif cmd_type == 'start_private_call':
-                        # 发起私人通话
-                        callee = command.get('callee')
-                        with self.lock:
-                            if callee in self.voice_clients:
-                                self.private_calls[username] = callee
-                                # 通知对方
-                                notify_cmd = {
-                                    'type': 'incoming_call',
-                                    'caller': username
-                                }
-                                self.send_with_length_prefix(self.voice_clients[callee], notify_cmd)
-                                print(f"{username} 呼叫 {callee}")
-                        
-                    elif cmd_type == 'accept_call':
-                        # 接受通话
-                        caller = command.get('caller')
-                        with self.lock:
-                            if caller in self.private_calls and self.private_calls[caller] == username:
-                                # 创建双向通话关系
-                                self.private_calls[username] = caller
-                                # 通知对方已接受
-                                accept_cmd = {
-                                    'type': 'call_accepted',
-                                    'callee': username
-                                }
-                                if caller in self.voice_clients:
-                                    try:
-                                        if self.send_with_length_prefix(self.voice_clients[caller], accept_cmd):
-                                            print(f"[语音] 已通知 {caller} 通话被接受")
-                                        else:
-                                            print(f"[语音] 通知 {caller} 通话被接受失败")
-                                    except Exception as e:
-                                        print(f"[错误] 发送通话接受通知失败: {e}")
-                                print(f"{username} 接受了 {caller} 的通话")
-                        
-                    elif cmd_type == 'reject_call':
-                        # 拒绝通话
-                        caller = command.get('caller')
-                        with self.lock:
-                            if caller in self.private_calls and self.private_calls[caller] == username:
-                                del self.private_calls[caller]
-                                # 通知对方已拒绝
-                                reject_cmd = {
-                                    'type': 'call_rejected',
-                                    'callee': username
-                                }
-                                self.send_with_length_prefix(self.voice_clients[caller], reject_cmd)
-                                print(f"{username} 拒绝了 {caller} 的通话")
-                        
-                    elif cmd_type == 'end_call':
-                        # 结束通话
-                        with self.lock:
-                            if username in self.private_calls:
-                                other = self.private_calls[username]
-                                # 清理双向通话关系
-                                if other in self.private_calls:
-                                    del self.private_calls[other]
-                                del self.private_calls[username]
-                                # 通知双方通话结束
-                                end_cmd = {
-                                    'type': 'call_ended',
-                                    'user': username
-                                }
-                                # 通知对方
-                                if other in self.voice_clients:
-                                    try:
-                                        self.send_with_length_prefix(self.voice_clients[other], end_cmd)
-                                    except Exception as e:
-                                        print(f"[错误] 发送结束通话通知给 {other} 失败: {e}")
-                                # 通知发起结束的一方
-                                try:
-                                    self.send_with_length_prefix(self.voice_clients[username], end_cmd)
-                                except Exception as e:
-                                    print(f"[错误] 发送结束通话通知给 {username} 失败: {e}")
-                                print(f"{username} 结束通话")
-                        
-                    elif cmd_type == 'audio_data':
-                        # 转发音频数据
-                        room_id = command.get('room_id')
-                        audio_data = command.get('audio_data')
-                        
-                        print(f"[语音] 收到音频数据 from {username}, 大小: {len(audio_data)} bytes")
-                        if room_id:
-                            print(f"[语音] 来自房间: {room_id}")
-                        else:
-                            print(f"[语音] 私人通话数据")
-                        
-                        # 确定转发目标
-                        targets = []
-                        with self.lock:
-                            if room_id:  # 房间语音
-                                if room_id in self.voice_rooms:
-                                    targets = list(self.voice_rooms[room_id])
-                                    print(f"[语音] 房间 {room_id} 中的用户: {targets}")
-                            elif username in self.private_calls:  # 私人通话
-                                other = self.private_calls[username]
-                                targets = [other]
-                                print(f"[语音] 私人通话目标: {other}")
-                        
-                        # 转发给所有目标（除了发送者自己）
-                        for target in targets:
-                            if target != username and target in self.voice_clients:
-                                try:
-                                    forward_cmd = {
-                                    'type': 'audio_data',
-                                    'sender': username,
-                                    'audio_data': audio_data,
-                                    'room_id': room_id
-                                }
-                                    print(f"[语音] 转发音频数据 to {target}, 大小: {len(audio_data)} bytes")
-                                    if self.send_with_length_prefix(self.voice_clients[target], forward_cmd):
-                                        print(f"[语音] 转发成功 to {target}")
-                                    else:
-                                        print(f"[语音] 转发失败 to {target}")
-                                except Exception as e:
-                                    print(f"[语音] 转发到 {target} 时出错: {e}")
+                    if not self.check_rate(limiter, username, command, len(cmd_data)):
+                        continue
+                    with self.profiler.section():
+                        self.handle_voice_command(voice_socket, username, command, received_at)
                         
                 except (EOFError, ConnectionError):
                     break
@@ -272,80 +246,543 @@ class VoiceServer:
             print(f"语音客户端处理错误: {e}")
         finally:
             # 清理
+            handshake_timer.cancel()
+            with self.lock:
+                idle_timer = self.idle_timers.pop(voice_socket, None)
+                if idle_timer:
+                    idle_timer.cancel()
+                self.last_seen.pop(voice_socket, None)
+                # 会话仍属于这个连接时（没有被重连接管、也没有主动退出）保留状态等待重连
+                session = self.sessions.get(username)
+                if session is not None and session['socket'] is voice_socket:
+                    self.voice_clients.pop(username, None)
+                    self.connected_clients.set(len(self.voice_clients))
+                    session['grace_timer'] = self.timers.schedule(self.resume_grace, self.expire_session, username, session['token'], kind='voice_resume')
+                    print(f"{username} 的语音连接断开，保留会话 {self.resume_grace} 秒")
+            
+            self.send_locks.pop(voice_socket, None)
+            try:
+                voice_socket.close()
+            except:
+                pass
+    
+    def check_rate(self, limiter, username, command, size):
+        """按类别限流，超出时丢弃命令并计数；音频帧按大小折算成 1024 个采样的帧数"""
+        category = VOICE_COMMAND_CLASSES.get(command.get('type'))
+        cost = max(1, size // (self.CHUNK * 2)) if category == 'audio' else 1
+        if limiter.allow(category, cost):
+            return True
+        self.throttled_total.inc(cost, category=category)
+        if limiter.dropped[category] == 1:
+            print(f"[限流] {username} 的 {category} 命令过快，开始丢弃")
+        return False
+    
+    def attach_session(self, username, token, voice_socket):
+        """令牌有效时恢复该用户的会话，否则结束旧会话并新建；返回是否恢复（调用方需持有 self.lock）"""
+        session = self.sessions.get(username)
+        resumed = (session is not None and isinstance(token, str)
+                   and secrets.compare_digest(session['token'], token))
+        if session is not None:
+            if session['grace_timer']:
+                session['grace_timer'].cancel()
+            # 旧连接可能还没发现自己已经断开（或同名用户重复登录），关掉它
+            if session['socket'] is not voice_socket:
+                try:
+                    session['socket'].shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            if not resumed:
+                self.end_session(username)
+        self.sessions[username] = {
+            'token': secrets.token_urlsafe(16),
+            'socket': voice_socket,
+            'grace_timer': None
+        }
+        self.sessions_total.inc(event='resumed' if resumed else 'new')
+        return resumed
+    
+    def expire_session(self, username, token):
+        """断线后没有在 resume_grace 秒内重连：结束会话"""
+        with self.lock:
+            session = self.sessions.get(username)
+            if session is None or session['token'] != token or username in self.voice_clients:
+                return
+            self.sessions_total.inc(event='expired')
+            self.end_session(username)
+        print(f"{username} 没有重连，语音会话结束")
+    
+    def end_session(self, username):
+        """结束用户的语音会话：退出所有房间、结束通话（调用方需持有 self.lock）"""
+        session = self.sessions.pop(username, None)
+        if session is not None and session['grace_timer']:
+            session['grace_timer'].cancel()
+        self.voice_clients.pop(username, None)
+        self.connected_clients.set(len(self.voice_clients))
+        for quantile in ('p50', 'p95', 'p99'):
+            self.mouth_to_ear_seconds.remove(user=username, quantile=quantile)
+        # 从所有房间移除
+        for room_id in list(self.voice_rooms.keys()):
+            if username in self.voice_rooms[room_id]:
+                self.voice_rooms[room_id].remove(username)
+                if not self.voice_rooms[room_id]:
+                    del self.voice_rooms[room_id]
+                self.update_room_gauge(room_id)
+        # 结束私人通话
+        if username in self.private_calls:
+            other = self.private_calls[username]
+            if other in self.voice_clients:
+                end_cmd = {'type': 'call_ended', 'user': username}
+                try:
+                    self.send_with_length_prefix(self.voice_clients[other], end_cmd)
+                except:
+                    pass
+            del self.private_calls[username]
+        self.cancel_ring_timer(username)
+        # 如果有人呼叫当前用户，也要清理
+        for caller, callee in list(self.private_calls.items()):
+            if callee == username:
+                del self.private_calls[caller]
+                self.cancel_ring_timer(caller)
+        print(f"{username} 离开语音系统")
+    
+    def expire_connection(self, voice_socket, reason):
+        """握手或空闲超时：关闭连接的读写，由该连接的处理线程清理"""
+        self.timeouts_total.inc(reason=reason)
+        print(f"[语音] 连接超时断开 ({reason})")
+        try:
+            voice_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def check_idle(self, voice_socket):
+        """空闲检查：期间收到过命令就按剩余时间重新定时，否则断开"""
+        with self.lock:
+            last_seen = self.last_seen.get(voice_socket)
+            if last_seen is None:
+                return
+            idle = time.monotonic() - last_seen
+            if idle < self.idle_timeout:
+                self.idle_timers[voice_socket] = self.timers.schedule(self.idle_timeout - idle, self.check_idle, voice_socket, kind='voice_idle')
+                return
+        self.expire_connection(voice_socket, 'idle')
+    
+    def cancel_ring_timer(self, caller):
+        """取消呼叫超时（调用方需持有 self.lock）"""
+        timer = self.ring_timers.pop(caller, None)
+        if timer:
+            timer.cancel()
+    
+    def expire_ring(self, caller, callee):
+        """呼叫 ring_timeout 秒无人接听：取消呼叫，通知主叫超时、被叫关闭来电提示"""
+        with self.lock:
+            if self.private_calls.get(caller) != callee or self.private_calls.get(callee) == caller:
+                return
+            self.ring_timers.pop(caller, None)
+            del self.private_calls[caller]
+            self.timeouts_total.inc(reason='ring')
+            print(f"[语音] {caller} 呼叫 {callee} 无人接听，已超时")
+            notices = (
+                (caller, {'type': 'call_rejected', 'callee': callee, 'reason': 'timeout'}),
+                (callee, {'type': 'call_ended', 'user': caller})
+            )
+            for user, notice in notices:
+                if user in self.voice_clients:
+                    try:
+                        self.send_with_length_prefix(self.voice_clients[user], notice)
+                    except Exception as e:
+                        print(f"[错误] 发送呼叫超时通知给 {user} 失败: {e}")
+    
+    def handle_voice_command(self, voice_socket, username, command, received_at):
+        """处理一条语音命令"""
+        cmd_type = command.get('type')
+        self.commands_total.inc(type=str(cmd_type))
+        
+        if cmd_type == 'bye':
+            # 客户端主动退出，不保留会话
+            with self.lock:
+                self.end_session(username)
+        
+        elif cmd_type == 'ping':
+            # 时钟偏移估计：原样带回客户端时间戳并附上服务器时间
+            self.send_with_length_prefix(voice_socket, {
+                'type': 'pong',
+                'client_ts': command.get('client_ts'),
+                'server_ts': time.time()
+            })
+        
+        elif cmd_type == 'latency_report':
+            # 客户端上报的端到端延迟
+            for quantile in ('p50', 'p95', 'p99'):
+                value = command.get(quantile)
+                if value is not None:
+                    self.mouth_to_ear_seconds.set(value, user=username, quantile=quantile)
+        
+        elif cmd_type == 'join_room':
+            # 加入语音聊天室
+            room_id = command.get('room_id', 'public')
+            with self.lock:
+                if room_id not in self.voice_rooms:
+                    self.voice_rooms[room_id] = set()
+                self.voice_rooms[room_id].add(username)
+                self.update_room_gauge(room_id)
+            
+            print(f"{username} 加入语音房间 {room_id}")
+            
+        elif cmd_type == 'leave_room':
+            # 离开语音聊天室
+            room_id = command.get('room_id', 'public')
+            with self.lock:
+                if room_id in self.voice_rooms and username in self.voice_rooms[room_id]:
+                    self.voice_rooms[room_id].remove(username)
+                    if not self.voice_rooms[room_id]:
+                        del self.voice_rooms[room_id]
+                    self.update_room_gauge(room_id)
+            
+            print(f"{username} 离开语音房间 {room_id}")
+            
+        elif cmd_type == 'start_private_call':
+            # 发起私人通话
+            callee = command.get('callee')
+            with self.lock:
+                if callee in self.voice_clients:
+                    self.private_calls[username] = callee
+                    self.cancel_ring_timer(username)
+                    self.ring_timers[username] = self.timers.schedule(self.ring_timeout, self.expire_ring, username, callee, kind='ring')
+                    # 通知对方
+                    notify_cmd = {
+                        'type': 'incoming_call',
+                        'caller': username
+                    }
+                    self.send_with_length_prefix(self.voice_clients[callee], notify_cmd)
+                    print(f"{username} 呼叫 {callee}")
+            
+        elif cmd_type == 'accept_call':
+            # 接受通话
+            caller = command.get('caller')
+            with self.lock:
+                if caller in self.private_calls and self.private_calls[caller] == username:
+                    self.cancel_ring_timer(caller)
+                    # 创建双向通话关系
+                    self.private_calls[username] = caller
+                    # 通知对方已接受
+                    accept_cmd = {
+                        'type': 'call_accepted',
+                        'callee': username
+                    }
+                    if caller in self.voice_clients:
+                        try:
+                            if self.send_with_length_prefix(self.voice_clients[caller], accept_cmd):
+                                print(f"[语音] 已通知 {caller} 通话被接受")
+                            else:
+                                print(f"[语音] 通知 {caller} 通话被接受失败")
+                        except Exception as e:
+                            print(f"[错误] 发送通话接受通知失败: {e}")
+                    print(f"{username} 接受了 {caller} 的通话")
+            
+        elif cmd_type == 'reject_call':
+            # 拒绝通话
+            caller = command.get('caller')
+            with self.lock:
+                if caller in self.private_calls and self.private_calls[caller] == username:
+                    del self.private_calls[caller]
+                    self.cancel_ring_timer(caller)
+                    # 通知对方已拒绝
+                    reject_cmd = {
+                        'type': 'call_rejected',
+                        'callee': username
+                    }
+                    self.send_with_length_prefix(self.voice_clients[caller], reject_cmd)
+                    print(f"{username} 拒绝了 {caller} 的通话")
+            
+        elif cmd_type == 'end_call':
+            # 结束通话
             with self.lock:
-                if username in self.voice_clients:
-                    del self.voice_clients[username]
-                # 从所有房间移除
-                for room_id in list(self.voice_rooms.keys()):
-                    if username in self.voice_rooms[room_id]:
-                        self.voice_rooms[room_id].remove(username)
-                        if not self.voice_rooms[room_id]:
-                            del self.voice_rooms[room_id]
-                # 结束私人通话
                 if username in self.private_calls:
                     other = self.private_calls[username]
+                    # 清理双向通话关系
+                    if other in self.private_calls:
+                        del self.private_calls[other]
+                    del self.private_calls[username]
+                    self.cancel_ring_timer(username)
+                    self.cancel_ring_timer(other)
+                    # 通知双方通话结束
+                    end_cmd = {
+                        'type': 'call_ended',
+                        'user': username
+                    }
+                    # 通知对方
                     if other in self.voice_clients:
-                        end_cmd = {'type': 'call_ended', 'user': username}
                         try:
                             self.send_with_length_prefix(self.voice_clients[other], end_cmd)
-                        except:
-                            pass
-                    del self.private_calls[username]
-                # 如果有人呼叫当前用户，也要清理
-                for caller, callee in list(self.private_calls.items()):
-                    if callee == username:
-                        del self.private_calls[caller]
+                        except Exception as e:
+                            print(f"[错误] 发送结束通话通知给 {other} 失败: {e}")
+                    # 通知发起结束的一方
+                    try:
+                        self.send_with_length_prefix(self.voice_clients[username], end_cmd)
+                    except Exception as e:
+                        print(f"[错误] 发送结束通话通知给 {username} 失败: {e}")
+                    print(f"{username} 结束通话")
             
-            try:
-                voice_socket.close()
-            except:
-                pass
+        elif cmd_type == 'audio_data':
+            # 转发音频数据
+            room_id = command.get('room_id')
+            audio_data = command.get('audio_data')
+            capture_ts = command.get('capture_ts')
+            clock_offset = command.get('clock_offset')
+            if capture_ts is not None and clock_offset is not None:
+                self.uplink_seconds.observe(max(0.0, received_at - (capture_ts + clock_offset)))
+            
+            if self.verbose_audio_log:
+                print(f"[语音] 收到音频数据 from {username}, 大小: {len(audio_data)} bytes")
+                if room_id:
+                    print(f"[语音] 来自房间: {room_id}")
+                else:
+                    print(f"[语音] 私人通话数据")
+            
+            # 确定转发目标
+            targets = []
+            with self.lock:
+                if room_id:  # 房间语音
+                    if room_id in self.voice_rooms:
+                        targets = list(self.voice_rooms[room_id])
+                elif username in self.private_calls:  # 私人通话
+                    other = self.private_calls[username]
+                    targets = [other]
             
-            print(f"{username} 离开语音系统")
+            # 转发给所有目标（除了发送者自己）
+            for target in targets:
+                if target != username and target in self.voice_clients:
+                    try:
+                        forward_cmd = {
+                        'type': 'audio_data',
+                        'sender': username,
+                        'audio_data': audio_data,
+                        'room_id': room_id,
+                        'seq': command.get('seq'),
+                        'capture_ts': capture_ts,
+                        'clock_offset': clock_offset,
+                        'server_rx_ts': received_at,
+                        'server_tx_ts': time.time()
+                    }
+                        self.forward_seconds.observe(forward_cmd['server_tx_ts'] - received_at)
+                        if self.send_with_length_prefix(self.voice_clients[target], forward_cmd):
+                            self.frames_forwarded.inc()
+                        else:
+                            self.frames_dropped.inc()
+                            print(f"[语音] 转发失败 to {target}")
+                    except Exception as e:
+                        self.frames_dropped.inc()
+                        print(f"[语音] 转发到 {target} 时出错: {e}")
+                elif target != username:
+                    # 目标已离线
+                    self.frames_dropped.inc()
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=8888, voice_port=8889):
+    def __init__(self, host='0.0.0.0', port=8888, voice_port=8889, admin_port=8890, history_db='chat_history.db',
+                 attachment_dir='attachments', bulk_port=8891, compression=True, batch_window=0.005,
+                 heartbeat_interval=30, handshake_timeout=10, replay_size=1000, resume_grace=60,
+                 rate_limits=CHAT_RATE_LIMITS, voice_rate_limits=VOICE_RATE_LIMITS):
         self.host = host
         self.port = port
         self.voice_port = voice_port
+        self.admin_port = admin_port
+        self.bulk_port = bulk_port
+        self.bulk_tokens = {}  # 附件传输令牌 -> 用户名
+        self.compression = compression
+        self.compressed_sockets = set()  # 握手时协商了压缩的连接
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.clients = {}
-        self.lock = threading.Lock()
+        self.presence_version = 0  # 在线用户列表的版本号，每次上线/下线加一
+        
+        # 推送给客户端的消息带全局递增的序号，最近 replay_size 条留在补发缓冲区中；
+        # 断线的客户端在 resume_grace 秒内带令牌和最后收到的序号重连，服务器只补发它错过的部分
+        self.seq = 0
+        self.replay = deque(maxlen=replay_size)  # (序号, 数据, 接收者, 排除的用户)
+        self.resume_grace = resume_grace
+        self.resume_tokens = {}  # 已断开连接的恢复令牌 -> 用户名
+        
+        # 文字频道：频道名 -> 订阅的用户名，频道消息只发给订阅者；所有人都在默认的聊天室中
+        self.channels = {CHAT_ROOM: set()}
+        
+        # 客户端每 heartbeat_interval 秒发一次心跳，连续三个间隔没有收到任何消息就断开；
+        # 连接后 handshake_timeout 秒内没有发来用户名也断开
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = heartbeat_interval * 3
+        self.handshake_timeout = handshake_timeout
+        
+        # 每个用户按类别限流（文字消息、附件、用户列表和聊天记录），超出的消息在广播前丢弃；
+        # 聊天连接和附件连接共用同一组令牌桶，断线重连也不会重置
+        self.rate_limits = rate_limits
+        self.rate_limiters = {}  # 用户名 -> RateLimiter
+        
+        # 运行指标
+        self.metrics = MetricsRegistry()
+        self.init_metrics()
+        self.lock = TimedLock(self.lock_wait_seconds, 'chat')
+        
+        # 时间轮：握手超时、空闲断开和呼叫超时都由它的一个线程驱动（与语音服务器共用）
+        self.timers = TimerWheel(metrics=self.metrics)
+        self.timers.start()
+        
+        # 广播合并发送，batch_window 为最大合并窗口（秒），0 表示每条广播立即发送
+        self.batcher = None
+        if batch_window:
+            self.batcher = SendBatcher(batch_window, on_error=self.drop_connection, metrics=self.metrics)
+            self.batcher.start()
+        
+        # 运行时分析器（两个服务器共用，由管理端口开关）
+        self.profiler = RuntimeProfiler()
+        
+        # 聊天记录
+        self.history = HistoryStore(history_db, metrics=self.metrics)
+        
+        # 附件存储（按内容哈希）
+        self.attachments = AttachmentStore(attachment_dir, metrics=self.metrics)
+        self.uploads = UploadManager(self.attachments, metrics=self.metrics)
+        
+        # 附件上传下载走单独的端口和线程池
+        if self.bulk_port:
+            self.bulk_server = BulkServer(self, host, bulk_port, metrics=self.metrics)
+            bulk_thread = threading.Thread(target=self.bulk_server.start)
+            bulk_thread.daemon = True
+            bulk_thread.start()
         
         # 启动语音服务器
-        self.voice_server = VoiceServer(host, voice_port)
+        self.voice_server = VoiceServer(host, voice_port, metrics=self.metrics, profiler=self.profiler, timers=self.timers,
+                                        rate_limits=voice_rate_limits)
         voice_thread = threading.Thread(target=self.voice_server.start)
         voice_thread.daemon = True
         voice_thread.start()
         
         print(f"语音服务器已启动，端口: {voice_port}")
     
-    def receive_complete_message(self, sock):
-        """接收完整的 JSON 消息（处理粘包）"""
-        buffer = b""
-        while True:
-            data = sock.recv(1024)
+    def init_metrics(self):
+        """注册聊天服务器指标"""
+        m = self.metrics
+        self.connections_total = m.counter('chat_connections_total', '聊天服务器累计接受的连接数')
+        self.connected_clients = m.gauge('chat_connected_clients', '当前在线的聊天用户数')
+        self.messages_total = m.counter('chat_messages_received_total', '按类型统计的聊天消息数', ['type'])
+        self.bytes_in = m.counter('chat_bytes_received_total', '聊天连接接收的字节数')
+        self.bytes_out = m.counter('chat_bytes_sent_total', '聊天连接发送的字节数')
+        self.send_queue_depth = m.gauge('chat_send_queue_depth', '正在等待 sendall 完成的发送数')
+        self.send_calls = m.counter('chat_send_calls_total', '聊天连接调用 sendall 的次数', ['mode'])
+        self.throttled_total = m.counter('chat_throttled_total', '按类别统计的超出限流被丢弃的消息数', ['category'])
+        self.timeouts_total = m.counter('chat_timeouts_total', '按原因统计的超时断开（handshake 为握手超时，idle 为没有心跳）', ['reason'])
+        self.resumes_total = m.counter('chat_resumes_total', '按结果统计的断线重连（takeover 为接管还没断开的旧连接，rejoin 为重新上线，gap 为错过的消息已不在补发缓冲区中）', ['result'])
+        self.replayed_messages = m.counter('chat_replayed_messages_total', '断线重连后补发的消息数')
+        self.channel_count = m.gauge('chat_channels', '当前的文字频道数（含默认聊天室）')
+        self.channel_fanout = m.histogram('chat_channel_fanout', '每条频道消息的接收人数', buckets=(1, 10, 100, 1000, 10000))
+        self.presence_updates = m.counter('chat_presence_updates_total', '推送的在线用户列表（full 为完整列表，delta 为增量）', ['kind'])
+        self.lock_wait_seconds = m.histogram('server_lock_wait_seconds', '获取服务器全局锁的等待时间', ['lock'])
+        self.compression_frames = m.counter('chat_compression_frames_total', '按结果统计的消息压缩次数', ['result'])
+        self.compression_raw_bytes = m.counter('chat_compression_raw_bytes_total', '启用压缩的连接上消息压缩前的字节数', ['direction'])
+        self.compression_wire_bytes = m.counter('chat_compression_wire_bytes_total', '启用压缩的连接上实际传输的字节数', ['direction'])
+        self.compression_ratio = m.gauge('chat_compression_ratio', '启用压缩的连接上累计的压缩比（压缩前/传输）', ['direction'])
+        self.compression_seconds = m.counter('chat_compression_cpu_seconds_total', '压缩和解压消息消耗的 CPU 时间', ['op'])
+    
+    def send_data(self, sock, data, cache=None, batch=False):
+        """发送 JSON 字符串并记录流量，失败时抛出异常；cache 用于广播时同一条消息只压缩一次
+
+        batch 为 True 时（广播）交给合并发送，在窗口结束时与发给同一连接的其他广播一起发出，发送失败时关闭连接。
+        """
+        payload = data.encode()
+        if sock in self.compressed_sockets:
+            payload = self.compress_data(payload, cache)
+        self.bytes_out.inc(len(payload))
+        if self.batcher is not None and batch:
+            self.batcher.queue(sock, payload)
+            return
+        self.send_queue_depth.inc()
+        try:
+            if self.batcher is not None:
+                self.batcher.send_now(sock, payload)
+            else:
+                sock.sendall(payload)
+        finally:
+            self.send_queue_depth.dec()
+        self.send_calls.inc(mode='direct')
+    
+    def drop_connection(self, sock):
+        """发送失败：关闭连接的读写，由该连接的处理线程清理用户"""
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def expire_connection(self, sock, reason):
+        """握手或空闲超时：关闭连接的读写，由该连接的处理线程清理"""
+        self.timeouts_total.inc(reason=reason)
+        print(f"连接超时断开 ({reason})")
+        self.drop_connection(sock)
+    
+    def check_idle(self, username, sock):
+        """空闲检查：期间收到过消息就按剩余时间重新定时，否则断开"""
+        with self.lock:
+            info = self.clients.get(username)
+            if info is None or info['socket'] is not sock:
+                return
+            idle = time.monotonic() - info['last_seen']
+            if idle < self.idle_timeout:
+                info['idle_timer'] = self.timers.schedule(self.idle_timeout - idle, self.check_idle, username, sock, kind='chat_idle')
+                return
+        self.expire_connection(sock, 'idle')
+    
+    def compress_data(self, payload, cache=None):
+        """压缩一条消息，太小、已经压缩过或压缩后没有变小时原样返回"""
+        if cache is not None and 'frame' in cache:
+            frame = cache['frame']
+        else:
+            started = time.thread_time()
+            frame = compress_frame(payload)
+            self.compression_seconds.inc(time.thread_time() - started, op='compress')
+            self.compression_frames.inc(result='compressed' if frame else 'skipped')
+            if cache is not None:
+                cache['frame'] = frame
+        wire = frame or payload
+        self.record_compression('out', len(payload), len(wire))
+        return wire
+    
+    def on_inflate(self, wire_size, raw_size, seconds):
+        """解码器解压一条客户端发来的消息后记录指标"""
+        self.compression_seconds.inc(seconds, op='decompress')
+        self.record_compression('in', raw_size, wire_size)
+    
+    def record_compression(self, direction, raw_size, wire_size):
+        self.compression_raw_bytes.inc(raw_size, direction=direction)
+        self.compression_wire_bytes.inc(wire_size, direction=direction)
+        self.compression_ratio.set(
+            self.compression_raw_bytes.value(direction=direction) / self.compression_wire_bytes.value(direction=direction),
+            direction=direction
+        )
+    
+    def receive_complete_message(self, sock, decoder=None):
+        """接收完整的 JSON 消息（处理粘包），多余的数据留在 decoder 中供下次读取"""
+        if decoder is None:
+            decoder = JsonStreamDecoder()
+        while not decoder.messages:
+            data = sock.recv(RECV_SIZE)
             if not data:
                 return None
             
-            buffer += data
-            try:
-                # 尝试解析 JSON，如果成功说明收到完整消息
-                message = json.loads(buffer.decode())
-                return message
-            except json.JSONDecodeError:
-                # 消息不完整，继续接收
-                continue
+            self.bytes_in.inc(len(data))
+            decoder.feed(data)
+        return decoder.pop()
     
     def start(self):
         self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.server.listen(socket.SOMAXCONN)
         print(f"聊天服务器启动在 {self.host}:{self.port}")
         
+        # 启动本地管理端口（Prometheus 指标、运行时分析）
+        if self.admin_port:
+            self.admin_server = AdminServer(self.metrics, '127.0.0.1', self.admin_port, profiler=self.profiler)
+            self.admin_server.start()
+        
         while True:
             client_socket, addr = self.server.accept()
             print(f"新连接: {addr}")
+            self.connections_total.inc()
             
             # 为新客户端创建线程
             thread = threading.Thread(
@@ -359,291 +796,542 @@ class ChatServer:
         """处理单个客户端连接"""
         username = None
         added_to_clients = False
+        decoder = JsonStreamDecoder(on_inflate=self.on_inflate)
+        handshake_timer = self.timers.schedule(self.handshake_timeout, self.expire_connection, client_socket, 'handshake', kind='chat_handshake')
         
         try:
             # 接收并验证用户名
-            username_data = self.receive_complete_message(client_socket)
+            username_data = self.receive_complete_message(client_socket, decoder)
+            handshake_timer.cancel()
             if not username_data:
                 return
                 
             username = username_data.get('username')
-            if not username:
+            if not isinstance(username, str) or not username:
                 response = json.dumps({'status': 'error', 'message': '用户名不能为空'})
-                client_socket.sendall(response.encode())
+                self.send_data(client_socket, response)
+                return
+            if username.startswith('#') or '|' in username or username in RESERVED_NAMES:
+                response = json.dumps({'status': 'error', 'message': '用户名不能以 # 开头、不能包含 |，也不能是 chat_room 或 系统'})
+                self.send_data(client_socket, response)
                 return
             
-            # 检查用户名是否已存在
+            # 检查用户名是否已存在；带有效恢复令牌的断线重连可以接管还没断开的旧连接
+            presented_token = username_data.get('resume_token')
+            last_seq = username_data.get('last_seq')
             with self.lock:
-                if username in self.clients:
+                held = self.clients.get(username)
+                resumed = isinstance(presented_token, str) and (
+                    secrets.compare_digest(held['resume_token'], presented_token) if held
+                    else self.resume_tokens.get(presented_token) == username)
+                if held and not resumed:
                     response = json.dumps({'status': 'error', 'message': '用户名已存在'})
-                    client_socket.sendall(response.encode())
+                    self.send_data(client_socket, response)
                     return
+                if resumed:
+                    self.resume_tokens.pop(presented_token, None)
+                    replay = self.can_replay(last_seq)
+                    self.resumes_total.inc(result='takeover' if held else 'rejoin')
+                    if not replay:
+                        self.resumes_total.inc(result='gap')
+                    if held:
+                        held['idle_timer'].cancel()
+                        self.bulk_tokens.pop(held['bulk_token'], None)
+                        self.drop_connection(held['socket'])
                 
-                # 发送连接成功响应
+                # 发送连接成功响应（不压缩），客户端支持时之后发出的消息都压缩
+                bulk_token = secrets.token_urlsafe(16)
+                resume_token = secrets.token_urlsafe(16)
+                compress = self.compression and COMPRESSION in (username_data.get('compression') or [])
                 response = json.dumps({
                     'status': 'success',
                     'message': f'欢迎 {username} 加入聊天室',
                     'sender': '系统',
                     'type': 'connect',
-                    'voice_port': self.voice_port  # 发送语音服务器端口
+                    'voice_port': self.voice_port,  # 发送语音服务器端口
+                    'bulk_port': self.bulk_port,    # 附件传输端口及令牌
+                    'bulk_token': bulk_token,
+                    'compression': COMPRESSION if compress else None,
+                    'heartbeat_interval': self.heartbeat_interval,
+                    'resume_token': resume_token,   # 断线重连时带上
+                    'resumed': resumed,
+                    'channels': sorted(held['channels']) if held else [CHAT_ROOM],  # 已订阅的频道
+                    'replay': resumed and replay,  # 为 False 时客户端需要重新拉取错过的聊天记录
+                    'seq': self.seq
                 })
-                client_socket.sendall(response.encode())
+                self.send_data(client_socket, response)
+                if compress:
+                    self.compressed_sockets.add(client_socket)
                 
                 # 保存客户端信息
-                self.clients[username] = {
+                client = self.clients[username] = {
                     'socket': client_socket,
-                    'address': addr
+                    'address': addr,
+                    'bulk_token': bulk_token,
+                    'resume_token': resume_token,
+                    'channels': held['channels'] if held else {CHAT_ROOM},
+                    'last_seen': time.monotonic(),
+                    'idle_timer': self.timers.schedule(self.idle_timeout, self.check_idle, username, client_socket, kind='chat_idle')
                 }
+                self.bulk_tokens[bulk_token] = username
+                if username not in self.rate_limiters:
+                    self.rate_limiters[username] = RateLimiter(self.rate_limits)
+                self.channels[CHAT_ROOM].add(username)
+                self.connected_clients.set(len(self.clients))
                 added_to_clients = True
+                
+                # 其他人收到上线增量（接管旧连接时在线列表没有变化），新用户收到完整的在线列表，之后只收增量
+                if not held:
+                    self.publish_presence(joined=username)
+                self.send_data(client_socket, json.dumps({
+                    'type': 'presence',
+                    'full': True,
+                    'version': self.presence_version,
+                    'users': list(self.clients)
+                }))
+                self.presence_updates.inc(kind='full')
+                
+                # 补发断线期间错过的消息，之后的消息在释放锁后按序号继续推送
+                if resumed and replay:
+                    self.replay_missed(username, client_socket, last_seq)
             
-            print(f"{username} 加入聊天室")
-            self.broadcast(f"{username} 加入了聊天室", sender="系统", exclude=username, msg_type='broadcast')
-            
-            # 发送欢迎消息给新用户
-            welcome_msg = json.dumps({
-                'sender': '系统',
-                'message': f'欢迎加入聊天室！当前在线用户数: {len(self.clients)}',
-                'voice_port': self.voice_port,  # 包含语音端口
-                'type': 'system'
-            })
-            client_socket.sendall(welcome_msg.encode())
+            if held:
+                print(f"{username} 断线重连")
+            else:
+                print(f"{username} 加入聊天室")
+                self.broadcast(f"{username} 加入了聊天室", sender="系统", exclude=username, msg_type='broadcast')
+                
+                # 发送欢迎消息给新用户
+                welcome_msg = json.dumps({
+                    'sender': '系统',
+                    'message': f'欢迎加入聊天室！当前在线用户数: {len(self.clients)}',
+                    'voice_port': self.voice_port,  # 包含语音端口
+                    'type': 'system'
+                })
+                self.send_data(client_socket, welcome_msg)
             
             # 持续接收消息
             while True:
-                message_data = self.receive_complete_message(client_socket)
+                message_data = self.receive_complete_message(client_socket, decoder)
                 if not message_data:
                     break
+                client['last_seen'] = time.monotonic()
+                if not self.check_rate(username, CHAT_MESSAGE_CLASSES.get(message_data.get('type')), client_socket):
+                    continue
                     
-                msg_type = message_data.get('type')
-                
-                if msg_type == 'message':
-                    content = message_data.get('content', '')
-                    if content.strip():
-                        print(f"{username}: {content}")
-                        self.broadcast(
-                            content,
-                            sender=username,
-                            msg_type='message'
-                        )
-                        
-                elif msg_type == 'private':
-                    target = message_data.get('target')
-                    content = message_data.get('content', '')
-                    if target and content.strip():
-                        self.send_private(
-                            target,
-                            f"{username} (私聊): {content}",
-                            sender=username
-                        )
-                        
-                elif msg_type == 'command':
-                    if message_data.get('command') == 'users':
-                        users_list = self.get_online_users()
-                        response = json.dumps({
-                            'sender': '系统',
-                            'message': f'在线用户: {", ".join(users_list)}',
-                            'type': 'users',
-                            'users': users_list
-                        })
-                        client_socket.sendall(response.encode())
-                
-                elif msg_type == 'heartbeat':
-                    response = json.dumps({'type': 'heartbeat_ack'})
-                    client_socket.sendall(response.encode())
-                
-                elif msg_type == 'file':
-                    file_name = message_data.get('file_name')
-                    file_size = message_data.get('file_size')
-                    file_content = message_data.get('file_content')
-                    
-                    if file_name and file_size and file_content:
-                        print(f"{username} 上传了文件: {file_name} ({file_size} 字节)")
-                        file_msg = json.dumps({
-                            'type': 'file_receive',
-                            'sender': username,
-                            'file_name': file_name,
-                            'file_size': file_size,
-                            'file_content': file_content
-                        })
-                        self.broadcast_raw(file_msg)
-                
-                elif msg_type == 'image':
-                    image_name = message_data.get('image_name')
-                    image_content = message_data.get('image_content')
-                    
-                    if image_name and image_content:
-                        print(f"{username} 发送了图片: {image_name}")
-                        image_msg = json.dumps({
-                            'type': 'image_receive',
-                            'sender': username,
-                            'image_name': image_name,
-                            'image_content': image_content
-                        })
-                        self.broadcast_raw(image_msg)
-                        
-                elif msg_type == 'private_image':
-                    target = message_data.get('target')
-                    image_name = message_data.get('image_name')
-                    image_content = message_data.get('image_content')
-                    
-                    if target and image_name and image_content:
-                        print(f"{username} 私发图片给 {target}: {image_name}")
-                        image_msg = json.dumps({
-                            'type': 'image_receive',
-                            'sender': username,
-                            'image_name': image_name,
-                            'image_content': image_content,
-                            'private': True,
-                            'target': target
-                        })
-                        
-                        confirm_msg = json.dumps({
-                            'type': 'private_sent',
-                            'sender': '系统',
-                            'message': f'[私聊给 {target}] 发送图片: {image_name}'
-                        })
-                        
-                        with self.lock:
-                            if target in self.clients:
-                                try:
-                                    self.clients[target]['socket'].sendall(image_msg.encode())
-                                except:
-                                    pass
-                            
-                            if username in self.clients:
-                                try:
-                                    self.clients[username]['socket'].sendall(confirm_msg.encode())
-                                except:
-                                    pass
-                                     
-                elif msg_type == 'private_file':
-                    target = message_data.get('target')
-                    file_name = message_data.get('file_name')
-                    file_size = message_data.get('file_size')
-                    file_content = message_data.get('file_content')
-                    
-                    if target and file_name and file_size and file_content:
-                        print(f"{username} 私发文件给 {target}: {file_name} ({file_size} 字节)")
-                        file_msg = json.dumps({
-                            'type': 'file_receive',
-                            'sender': username,
-                            'file_name': file_name,
-                            'file_size': file_size,
-                            'file_content': file_content,
-                            'private': True,
-                            'target': target
-                        })
-                        
-                        confirm_msg = json.dumps({
-                            'type': 'private_sent',
-                            'sender': '系统',
-                            'message': f'[私聊给 {target}] 发送文件: {file_name}'
-                        })
-                        
-                        with self.lock:
-                            if target in self.clients:
-                                try:
-                                    self.clients[target]['socket'].sendall(file_msg.encode())
-                                except:
-                                    pass
-                            
-                            if username in self.clients:
-                                try:
-                                    self.clients[username]['socket'].sendall(confirm_msg.encode())
-                                except:
-                                    pass
-                                    
-                elif msg_type == 'voice_status':
-                    # 语音状态通知
-                    target = message_data.get('target')
-                    status = message_data.get('status')
-                    
-                    if target and status:
-                        voice_msg = json.dumps({
-                            'type': 'voice_status',
-                            'sender': username,
-                            'status': status,
-                            'target': target
-                        })
-                        
-                        with self.lock:
-                            if target in self.clients:
-                                try:
-                                    self.clients[target]['socket'].sendall(voice_msg.encode())
-                                except:
-                                    pass
+                with self.profiler.section():
+                    self.handle_message(client_socket, username, message_data)
     
         except json.JSONDecodeError as e:
             print(f"JSON 解析错误 ({addr}): {e}")
         except Exception as e:
             print(f"客户端 {addr} 错误: {e}")
         finally:
+            handshake_timer.cancel()
             if username and added_to_clients:
                 with self.lock:
-                    if username in self.clients:
+                    # 被断线重连接管时用户仍然在线
+                    still_online = self.clients.get(username) is client
+                    if still_online:
+                        client['idle_timer'].cancel()
+                        self.bulk_tokens.pop(client['bulk_token'], None)
                         del self.clients[username]
-                self.broadcast(f"{username} 离开了聊天室", sender="系统", exclude=username, msg_type='broadcast')
+                        for channel in client['channels']:
+                            self.unsubscribe(username, channel)
+                        self.publish_presence(left=username)
+                        self.resume_tokens[client['resume_token']] = username
+                        self.timers.schedule(self.resume_grace, self.expire_resume_token, client['resume_token'], kind='chat_resume')
+                    self.connected_clients.set(len(self.clients))
+                if still_online:
+                    self.broadcast(f"{username} 离开了聊天室", sender="系统", exclude=username, msg_type='broadcast')
+            self.compressed_sockets.discard(client_socket)
+            if self.batcher is not None:
+                self.batcher.discard(client_socket)
             client_socket.close()
     
-    def broadcast(self, message, sender="系统", exclude=None, msg_type='broadcast'):
-        """广播消息给所有客户端"""
-        data = json.dumps({
+    def check_rate(self, username, category, sock=None):
+        """按用户和类别限流（聊天连接和附件连接共用），超出时计数并返回 False；
+        给出 sock 时连续丢弃的第一条在该聊天连接上提示发送者"""
+        limiter = self.rate_limiters.get(username)
+        if limiter is None or limiter.allow(category):
+            return True
+        self.throttled_total.inc(category=category)
+        if limiter.dropped[category] == 1:
+            print(f"[限流] {username} 的 {category} 消息过快，开始丢弃")
+            if sock is not None:
+                self.send_data(sock, json.dumps({
+                    'sender': '系统',
+                    'message': RATE_LIMITED_MESSAGE,
+                    'type': 'system'
+                }))
+        return False
+    
+    def can_replay(self, last_seq):
+        """客户端最后收到的序号之后的消息是否都还在补发缓冲区中（调用方需持有 self.lock）"""
+        if not isinstance(last_seq, int) or last_seq > self.seq:
+            return False
+        return not self.replay or self.replay[0][0] <= last_seq + 1
+    
+    def replay_missed(self, username, sock, last_seq):
+        """补发 last_seq 之后推送给该用户的消息（调用方需持有 self.lock）"""
+        count = 0
+        for seq, data, targets, exclude in self.replay:
+            if seq <= last_seq:
+                continue
+            if (username in targets) if targets is not None else (username != exclude):
+                self.send_data(sock, data)
+                count += 1
+        self.replayed_messages.inc(count)
+    
+    def expire_resume_token(self, token):
+        """断线后 resume_grace 秒内没有重连，令牌作废"""
+        with self.lock:
+            username = self.resume_tokens.pop(token, None)
+            if username is not None and username not in self.clients:
+                self.rate_limiters.pop(username, None)
+    
+    def handle_message(self, client_socket, username, message_data):
+        """处理一条聊天消息"""
+        msg_type = message_data.get('type')
+        self.messages_total.inc(type=str(msg_type))
+        
+        if msg_type == 'message':
+            content = message_data.get('content', '')
+            channel = message_data.get('channel') or CHAT_ROOM
+            if isinstance(content, str) and content.strip():
+                if channel != CHAT_ROOM and not (isinstance(channel, str) and CHANNEL_NAME.match(channel)):
+                    self.send_data(client_socket, json.dumps({
+                        'sender': '系统',
+                        'message': '频道名需以 # 开头，不超过 32 个字符且不含空白',
+                        'type': 'system'
+                    }))
+                    return
+                with self.lock:
+                    subscribed = username in self.channels.get(channel, ())
+                if not subscribed:
+                    self.send_data(client_socket, json.dumps({
+                        'sender': '系统',
+                        'message': f'没有加入频道 {channel}',
+                        'type': 'system'
+                    }))
+                    return
+                print(f"{username}{'' if channel == CHAT_ROOM else ' @ ' + channel}: {content}")
+                self.broadcast(
+                    content,
+                    sender=username,
+                    msg_type='message',
+                    channel=channel
+                )
+        
+        elif msg_type in ('join_channel', 'leave_channel'):
+            self.handle_channel_command(client_socket, username, msg_type, message_data.get('channel'))
+                
+        elif msg_type == 'private':
+            target = message_data.get('target')
+            content = message_data.get('content', '')
+            if isinstance(target, str) and target and isinstance(content, str) and content.strip():
+                self.send_private(
+                    target,
+                    f"{username} (私聊): {content}",
+                    sender=username,
+                    content=content
+                )
+                
+        elif msg_type == 'command':
+            if message_data.get('command') == 'users':
+                with self.lock:
+                    users_list = list(self.clients.keys())
+                    version = self.presence_version
+                response = json.dumps({
+                    'sender': '系统',
+                    'message': f'在线用户: {", ".join(users_list)}',
+                    'type': 'users',
+                    'users': users_list,
+                    'version': version
+                })
+                self.send_data(client_socket, response)
+            elif message_data.get('command') == 'history':
+                self.send_history(client_socket, username, message_data)
+        
+        elif msg_type == 'heartbeat':
+            response = json.dumps({'type': 'heartbeat_ack'})
+            self.send_data(client_socket, response)
+        
+        elif msg_type in ('file', 'private_file'):
+            # 一次性上传整个文件（旧协议）：内容只保存一份，转发给其他用户的只有文件信息和哈希
+            file_name = message_data.get('file_name')
+            file_size = message_data.get('file_size')
+            file_content = message_data.get('file_content')
+            target = message_data.get('target') if msg_type == 'private_file' else None
+            valid = file_name and file_size and file_content and (target or msg_type == 'file')
+            stored = self.store_attachment(file_content) if valid else None
+            if stored:
+                self.announce_attachment(username, 'file', file_name, stored[0], stored[1], target)
+        
+        elif msg_type in ('image', 'private_image'):
+            image_name = message_data.get('image_name')
+            image_content = message_data.get('image_content')
+            target = message_data.get('target') if msg_type == 'private_image' else None
+            valid = image_name and image_content and (target or msg_type == 'image')
+            stored = self.store_attachment(image_content) if valid else None
+            if stored:
+                self.announce_attachment(username, 'image', image_name, stored[0], stored[1], target)
+        
+        elif msg_type == 'attachment_get':
+            # 客户端点击下载或需要显示图片时才按哈希取附件内容（未开启附件端口时）；
+            # 内容要整个读进内存并做 base64，只允许取小附件，以免占住这个连接的处理线程
+            digest = message_data.get('hash')
+            try:
+                content = self.attachments.get(digest, INLINE_ATTACHMENT_MAX)
+                error = None if content is not None else '附件不存在'
+            except ValueError:
+                error = '附件太大，服务器未开启附件端口，无法下载'
+            if error:
+                response = json.dumps({'type': 'attachment_data', 'hash': digest, 'error': error})
+            else:
+                response = json.dumps({
+                    'type': 'attachment_data',
+                    'hash': digest,
+                    'content': base64.b64encode(content).decode()
+                })
+            self.send_data(client_socket, response)
+                            
+        elif msg_type == 'voice_status':
+            # 语音状态通知
+            target = message_data.get('target')
+            status = message_data.get('status')
+            
+            if target and status:
+                voice_msg = {
+                    'type': 'voice_status',
+                    'sender': username,
+                    'status': status,
+                    'target': target
+                }
+                
+                with self.lock:
+                    self.deliver(voice_msg, targets=(target,))
+    
+    def broadcast(self, message, sender="系统", exclude=None, msg_type='broadcast', channel=CHAT_ROOM):
+        """广播消息给频道的订阅者（默认聊天室即所有客户端），用户聊天消息同时写入聊天记录"""
+        payload = {
             'sender': sender,
             'message': message,
             'type': msg_type
-        })
+        }
+        if channel != CHAT_ROOM:
+            payload['channel'] = channel
+        if msg_type == 'message':
+            entry = self.history.append(channel_conversation(channel), sender, message, msg_type)
+            payload['id'] = entry['id']
+            payload['timestamp'] = entry['timestamp']
         
         with self.lock:
-            for user, info in list(self.clients.items()):
-                if user != exclude:
-                    try:
-                        info['socket'].sendall(data.encode())
-                    except:
-                        try:
-                            info['socket'].close()
-                        except:
-                            pass
-                        del self.clients[user]
+            if channel == CHAT_ROOM:
+                self.channel_fanout.observe(len(self.clients))
+                self.deliver(payload, exclude=exclude)
+            else:
+                # 只发给订阅者，开销与频道人数成正比，与在线总人数无关
+                subscribers = frozenset(self.channels.get(channel, ()))
+                self.channel_fanout.observe(len(subscribers))
+                self.deliver(payload, targets=subscribers, exclude=exclude, batch=True)
+    
+    def handle_channel_command(self, client_socket, username, command, channel):
+        """加入或离开文字频道，应答 channel_joined / channel_left，不能离开默认聊天室"""
+        if command == 'leave_channel' and channel == CHAT_ROOM:
+            error = '不能离开聊天室'
+        elif not isinstance(channel, str) or not CHANNEL_NAME.match(channel):
+            error = '频道名需以 # 开头，不超过 32 个字符且不含空白'
+        else:
+            error = None
+        if error:
+            self.send_data(client_socket, json.dumps({'sender': '系统', 'message': error, 'type': 'system'}))
+            return
+        
+        with self.lock:
+            channels = self.clients[username]['channels']
+            if command == 'join_channel':
+                channels.add(channel)
+                self.channels.setdefault(channel, set()).add(username)
+                members = len(self.channels[channel])
+            else:
+                channels.discard(channel)
+                self.unsubscribe(username, channel)
+                members = len(self.channels.get(channel, ()))
+            self.channel_count.set(len(self.channels))
+        self.send_data(client_socket, json.dumps({
+            'type': 'channel_joined' if command == 'join_channel' else 'channel_left',
+            'channel': channel,
+            'members': members
+        }))
+    
+    def unsubscribe(self, username, channel):
+        """从频道的订阅者中移除用户，没有订阅者的频道随之删除（调用方需持有 self.lock）"""
+        subscribers = self.channels.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(username)
+        if not subscribers and channel != CHAT_ROOM:
+            del self.channels[channel]
+        self.channel_count.set(len(self.channels))
     
-    def broadcast_raw(self, data):
-        """广播原始数据给所有客户端"""
+    def broadcast_raw(self, payload):
+        """原样广播一条消息给所有客户端"""
         with self.lock:
-            for user, info in list(self.clients.items()):
+            self.deliver(payload)
+    
+    def deliver(self, payload, targets=None, exclude=None, batch=False):
+        """推送一条消息：分配序号并放进补发缓冲区，发给 targets 中在线的用户，targets 为空时发给所有在线用户（调用方需持有 self.lock）
+
+        batch 为 True 时（频道消息）与广播一样合并发送。
+        """
+        self.seq += 1
+        payload['seq'] = self.seq
+        data = json.dumps(payload)
+        self.replay.append((self.seq, data, targets, exclude))
+        if targets is None or batch:
+            self.send_to_all(data, exclude, targets)
+            return
+        for user in targets:
+            if user in self.clients:
                 try:
-                    info['socket'].sendall(data.encode())
+                    self.send_data(self.clients[user]['socket'], data)
                 except:
-                    try:
-                        info['socket'].close()
-                    except:
-                        pass
-                    del self.clients[user]
-    
-    def send_private(self, target, message, sender):
-        """发送私聊消息"""
-        receiver_data = json.dumps({
+                    pass
+    
+    def send_to_all(self, data, exclude=None, users=None):
+        """把一条消息发给 users 中（缺省为所有）在线用户（调用方需持有 self.lock）；发送失败的连接由它的处理线程清理"""
+        cache = {}
+        for user in list(self.clients) if users is None else users:
+            info = self.clients.get(user)
+            if info is not None and user != exclude:
+                try:
+                    self.send_data(info['socket'], data, cache, batch=True)
+                except:
+                    self.drop_connection(info['socket'])
+    
+    def publish_presence(self, joined=None, left=None):
+        """在线用户变化时递增版本号并向所有人推送增量（调用方需持有 self.lock）"""
+        self.presence_version += 1
+        delta = {'type': 'presence', 'version': self.presence_version}
+        if joined:
+            delta['joined'] = [joined]
+        if left:
+            delta['left'] = [left]
+        self.presence_updates.inc(kind='delta')
+        self.deliver(delta, exclude=joined)
+    
+    def store_attachment(self, encoded):
+        """解码并保存上传的附件，返回 (哈希, 大小)，内容无效时返回 None"""
+        try:
+            return self.attachments.put(base64.b64decode(encoded, validate=True))
+        except (TypeError, ValueError) as e:
+            print(f"[错误] 附件内容无效: {e}")
+            return None
+    
+    def announce_attachment(self, sender, kind, name, digest, size, target=None):
+        """通知其他用户有新文件或图片，只带文件信息和哈希；target 不为空时为私发"""
+        if kind == 'image':
+            data = {'type': 'image_receive', 'sender': sender, 'image_name': name,
+                    'image_size': size, 'image_hash': digest}
+        else:
+            data = {'type': 'file_receive', 'sender': sender, 'file_name': name,
+                    'file_size': size, 'file_hash': digest}
+        
+        if not target:
+            print(f"{sender} {'发送了图片' if kind == 'image' else '上传了文件'}: {name} ({size} 字节)")
+            self.broadcast_raw(data)
+            return
+        
+        if not isinstance(target, str):
+            return
+        label = '图片' if kind == 'image' else '文件'
+        print(f"{sender} 私发{label}给 {target}: {name} ({size} 字节)")
+        # 私发的附件也记入双方的私聊记录，客户端按 id 与实时收到的那条去重
+        entry = self.history.append(private_conversation(sender, target), sender, f"发送了{label}: {name}",
+                                    'private', target=target)
+        data.update(private=True, target=target, id=entry['id'], timestamp=entry['timestamp'])
+        self.send_attachment_private(sender, target, data, f"[私聊给 {target}] 发送{label}: {name}", entry, digest)
+    
+    def send_attachment_private(self, sender, target, data, confirm, entry, digest):
+        """私发附件信息给目标用户，并给发送者回执（带记录 id 和附件哈希）"""
+        confirm_msg = {
+            'type': 'private_sent',
+            'sender': '系统',
+            'message': confirm,
+            'target': target,
+            'content': entry['message'],
+            'hash': digest,
+            'id': entry['id'],
+            'timestamp': entry['timestamp']
+        }
+        
+        with self.lock:
+            self.deliver(data, targets=(target,))
+            self.deliver(confirm_msg, targets=(sender,))
+    
+    def send_private(self, target, message, sender, content=None):
+        """发送私聊消息并写入聊天记录（content 为原始内容，缺省时记录 message）"""
+        entry = self.history.append(private_conversation(sender, target), sender,
+                                    content if content is not None else message, 'private', target=target)
+        receiver_data = {
             'sender': sender,
             'message': message,
-            'type': 'private'
-        })
+            'type': 'private',
+            'id': entry['id'],
+            'timestamp': entry['timestamp']
+        }
         
-        sender_data = json.dumps({
+        sender_data = {
             'sender': '系统',
             'message': f'[私聊给 {target}] {message.split(": ")[1] if ": " in message else message}',
-            'type': 'private_sent'
-        })
+            'type': 'private_sent',
+            'target': target,
+            'content': entry['message'],
+            'id': entry['id'],
+            'timestamp': entry['timestamp']
+        }
         
         with self.lock:
-            if target in self.clients:
-                try:
-                    self.clients[target]['socket'].sendall(receiver_data.encode())
-                except:
-                    pass
-            
-            if sender in self.clients:
-                try:
-                    self.clients[sender]['socket'].sendall(sender_data.encode())
-                except:
-                    pass
+            self.deliver(receiver_data, targets=(target,))
+            self.deliver(sender_data, targets=(sender,))
+    
+    def send_history(self, client_socket, username, request):
+        """应答 history 命令：按 id 向前分页返回聊天室、已加入的频道或与某人的私聊记录"""
+        conversation = request.get('conversation') or CHAT_ROOM
+        if not isinstance(conversation, str):
+            return
+        try:
+            before = int(request['before']) if request.get('before') is not None else None
+            limit = max(1, min(int(request.get('limit') or 50), 200))
+        except (TypeError, ValueError, OverflowError):
+            return
+        
+        # 私聊只能读取自己参与的会话
+        if conversation == CHAT_ROOM:
+            key = CHAT_ROOM
+        elif conversation.startswith('#'):
+            # 频道只能读取已加入的
+            with self.lock:
+                if username not in self.channels.get(conversation, ()):
+                    return
+            key = channel_conversation(conversation)
+        else:
+            key = private_conversation(username, conversation)
+        messages, has_more = self.history.page(key, before, limit)
+        response = json.dumps({
+            'type': 'history',
+            'conversation': conversation,
+            'before': before,
+            'messages': [{k: v for k, v in e.items() if k != 'conversation'} for e in messages],
+            'has_more': has_more
+        })
+        self.send_data(client_socket, response)
+    
+    def bulk_user(self, token):
+        """附件传输连接的令牌对应的在线用户，无效时返回 None"""
+        with self.lock:
+            return self.bulk_tokens.get(token) if isinstance(token, str) else None
     
     def get_online_users(self):
         """获取在线用户列表"""
@@ -655,9 +1343,14 @@ if __name__ == "__main__":
     host = sys.argv[1] if len(sys.argv) > 1 else '0.0.0.0'
     port = int(sys.argv[2]) if len(sys.argv) > 2 else 8888
     voice_port = int(sys.argv[3]) if len(sys.argv) > 3 else 8889
+    admin_port = int(sys.argv[4]) if len(sys.argv) > 4 else 8890
+    bulk_port = int(sys.argv[5]) if len(sys.argv) > 5 else 8891
+    batch_window = float(sys.argv[6]) if len(sys.argv) > 6 else 0.005
     
-    server = ChatServer(host, port, voice_port)
+    server = ChatServer(host, port, voice_port, admin_port, bulk_port=bulk_port, batch_window=batch_window)
     try:
         server.start()
     except KeyboardInterrupt:
-        print("服务器关闭")
\ No newline at end of file
+        print("服务器关闭")
+    finally:
+        server.history.close()
\ No newline at end of file
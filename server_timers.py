@@ -0,0 +1,128 @@
+# server_timers.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from server_metrics import MetricsRegistry
+
+
+class Timer:
+    """时间轮上的一个定时器，cancel() 后不会再触发"""
+
+    __slots__ = ('wheel', 'expires', 'callback', 'args', 'kind', 'slot')
+
+    def __init__(self, wheel, expires, callback, args, kind):
+        self.wheel = wheel
+        self.expires = expires    # 到期的 tick
+        self.callback = callback
+        self.args = args
+        self.kind = kind
+        self.slot = None          # 所在的槽（集合），已触发或已取消时为 None
+
+    def cancel(self):
+        with self.wheel.lock:
+            if self.slot is not None:
+                self.slot.discard(self)
+                self.slot = None
+                self.wheel.armed -= 1
+
+    @property
+    def armed(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    """分层时间轮：添加、取消定时器都是 O(1)，所有定时器由一个线程驱动
+
+    第 0 层每个槽是一个 tick，第 i 层每个槽覆盖 slots ** i 个 tick；高层的槽转到时把其中的定时器
+    重新放到低层。默认 0.1 秒一个 tick、每层 256 个槽、4 层，可以定时约 136 年，远超实际需要。
+    回调在时间轮线程中执行，应当很快返回（例如关闭连接、发一条短消息）。
+    """
+
+    def __init__(self, tick=0.1, slots=256, levels=4, metrics=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.lock = threading.Lock()
+        self.ticks = 0                  # 已经处理到的 tick
+        self.started = time.monotonic()
+
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.armed_timers = self.metrics.gauge('timer_wheel_armed', '时间轮上等待触发的定时器数')
+        self.fired_total = self.metrics.counter('timer_wheel_fired_total', '按用途统计的已触发定时器数', ['kind'])
+        self.errors_total = self.metrics.counter('timer_wheel_callback_errors_total', '定时器回调抛出异常的次数')
+        self.lag_seconds = self.metrics.gauge('timer_wheel_lag_seconds', '时间轮线程落后于实际时间的秒数')
+        self.armed = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, delay, callback, *args, kind='timer'):
+        """delay 秒后在时间轮线程中调用 callback(*args)，返回可以 cancel() 的 Timer"""
+        with self.lock:
+            expires = self.ticks + max(1, int(delay / self.tick + 0.5))
+            timer = Timer(self, expires, callback, args, kind)
+            self._place(timer)
+            self.armed += 1
+            self.armed_timers.set(self.armed)
+        return timer
+
+    def _place(self, timer):
+        """按剩余 tick 数把定时器放进对应层的槽（调用方需持有 self.lock）"""
+        delta = timer.expires - self.ticks
+        span = 1
+        for level in self.levels:
+            if delta < span * self.slots or level is self.levels[-1]:
+                index = (min(timer.expires, self.ticks + span * (self.slots - 1)) // span) % self.slots
+                slot = level[index]
+                slot.add(timer)
+                timer.slot = slot
+                return
+            span *= self.slots
+
+    def _cascade(self, level_index):
+        """把第 level_index 层当前槽里的定时器重新放到低层（调用方需持有 self.lock）"""
+        span = self.slots ** level_index
+        slot = self.levels[level_index][(self.ticks // span) % self.slots]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._place(timer)
+
+    def advance(self):
+        """前进一个 tick，返回到期的定时器"""
+        with self.lock:
+            self.ticks += 1
+            # 低层转完一圈时，先把上一层对应槽里的定时器放下来
+            span = self.slots
+            for level_index in range(1, len(self.levels)):
+                if self.ticks % span:
+                    break
+                self._cascade(level_index)
+                span *= self.slots
+            slot = self.levels[0][self.ticks % self.slots]
+            due = [timer for timer in slot if timer.expires <= self.ticks]
+            for timer in due:
+                slot.discard(timer)
+                timer.slot = None
+            self.armed -= len(due)
+            self.armed_timers.set(self.armed)
+        return due
+
+    def run(self):
+        while True:
+            # 按 tick 对齐，处理慢了的话连续补上落下的 tick
+            next_at = self.started + (self.ticks + 1) * self.tick
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.lag_seconds.set(max(0.0, -delay))
+            for timer in self.advance():
+                self.fired_total.inc(kind=timer.kind)
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self.errors_total.inc()
+                    print(f"[定时器] {timer.kind} 回调出错: {e}")
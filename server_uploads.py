@@ -0,0 +1,157 @@
+# server_uploads.py
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
+
+from server_metrics import MetricsRegistry
+
+_FILE_ID_RE = re.compile(r'^[\w-]{1,64}$')
+
+
+class UploadManager:
+    """分块上传：每个上传按偏移顺序写入临时文件，断线重连后从已确认的位置续传"""
+
+    def __init__(self, store, metrics=None, max_size=4 * 1024 ** 3, expire=3600):
+        self.store = store
+        self.max_size = max_size
+        self.expire = expire
+        self.lock = threading.Lock()
+        self.uploads = {}  # (用户名, file_id) -> 上传状态
+        self.dir = os.path.join(store.root, 'uploads')
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.uploads_total = self.metrics.counter('uploads_total', '按结果统计的分块上传数', ['result'])
+        self.chunks_total = self.metrics.counter('upload_chunks_total', '按结果统计的上传块数', ['result'])
+        self.chunk_bytes = self.metrics.counter('upload_chunk_bytes_total', '上传块写入的字节数')
+        self.active_uploads = self.metrics.gauge('uploads_active', '进行中（含等待续传）的上传数')
+
+    def start(self, username, request):
+        """处理 file_upload_request，返回 file_upload_ready 应答；请求无效时抛出 ValueError"""
+        file_id = str(request.get('file_id', ''))
+        file_name = request.get('file_name')
+        file_size = request.get('file_size')
+        digest = request.get('file_hash')
+        kind = request.get('kind', 'file')
+        if not _FILE_ID_RE.match(file_id) or not file_name or kind not in ('file', 'image'):
+            raise ValueError('上传请求无效')
+        if not isinstance(file_size, int) or not 0 <= file_size <= self.max_size:
+            raise ValueError('文件大小无效')
+        if self.store.path(digest) is None:
+            raise ValueError('文件哈希无效')
+
+        self.expire_stale()
+        key = (username, file_id)
+        with self.lock:
+            upload = self.uploads.get(key)
+            if upload is None or upload['hash'] != digest or upload['size'] != file_size:
+                if upload is not None:
+                    self.discard(upload)
+                upload = {
+                    'file_id': file_id,
+                    'name': file_name,
+                    'size': file_size,
+                    'hash': digest,
+                    'kind': kind,
+                    'target': request.get('target'),
+                    'path': os.path.join(
+                        self.dir, hashlib.sha256(f"{username}\0{file_id}".encode()).hexdigest() + '.part'),
+                    'received': 0
+                }
+                # 服务器上已有相同内容时也要完整上传一遍：只知道哈希不能证明持有内容，
+                # 否则任何人都能以任意文件名和大小转发别人上传过的附件
+                open(upload['path'], 'wb').close()
+                self.uploads[key] = upload
+                self.active_uploads.set(len(self.uploads))
+            else:
+                self.uploads_total.inc(result='resumed')
+            upload['updated'] = time.monotonic()
+            return {'type': 'file_upload_ready', 'file_id': file_id, 'received_bytes': upload['received']}
+
+    def chunk(self, username, header, payload):
+        """写入一块数据，返回 file_upload_ack；偏移不是下一块时（续传前发出的块）丢弃并返回 None
+
+        续传后同一个上传的块可能来自不同连接的线程：在锁内检查偏移并标记正在写入，写文件在锁外进行，
+        写完再回到锁内推进已确认的偏移。
+        """
+        file_id = header.get('file_id')
+        checksum_ok = zlib.crc32(payload) == header.get('checksum')
+        key = (username, file_id)
+        with self.lock:
+            upload = self.uploads.get(key)
+            if upload is None:
+                self.chunks_total.inc(result='unknown')
+                return {'type': 'file_upload_error', 'file_id': file_id, 'error': '没有这个上传'}
+            if header.get('offset') != upload['received'] or upload.get('writing'):
+                self.chunks_total.inc(result='out_of_order')
+                return None
+            if not checksum_ok:
+                # 让客户端从已确认的位置重发
+                self.chunks_total.inc(result='checksum')
+                return {'type': 'file_upload_ack', 'file_id': file_id, 'offset': upload['received'], 'error': 'checksum'}
+            if upload['received'] + len(payload) > upload['size']:
+                self.chunks_total.inc(result='overflow')
+                return {'type': 'file_upload_error', 'file_id': file_id, 'error': '数据超过文件大小'}
+            upload['writing'] = True
+
+        written = False
+        try:
+            with open(upload['path'], 'ab') as f:
+                f.write(payload)
+            written = True
+        finally:
+            with self.lock:
+                upload['writing'] = False
+                current = self.uploads.get(key) is upload
+                if current and written:
+                    upload['received'] += len(payload)
+                    upload['updated'] = time.monotonic()
+                received = upload['received']
+        if not current:
+            # 写入期间上传被重新开始或过期清理
+            self.chunks_total.inc(result='unknown')
+            return {'type': 'file_upload_error', 'file_id': file_id, 'error': '没有这个上传'}
+        self.chunks_total.inc(result='ok')
+        self.chunk_bytes.inc(len(payload))
+        return {'type': 'file_upload_ack', 'file_id': file_id, 'offset': received}
+
+    def complete(self, username, file_id):
+        """处理 file_upload_complete：校验并放入附件存储，返回上传信息（含 'hash' 和 'size'）；失败时抛出 ValueError"""
+        key = (username, file_id)
+        with self.lock:
+            upload = self.uploads.get(key)
+            if upload is None:
+                raise ValueError('没有这个上传')
+            if upload['received'] != upload['size']:
+                raise ValueError('文件还没有传完')
+            del self.uploads[key]
+            self.active_uploads.set(len(self.uploads))
+        try:
+            self.store.put_file(upload['path'], upload['hash'])
+        except ValueError:
+            self.uploads_total.inc(result='corrupt')
+            raise
+        self.uploads_total.inc(result='ok')
+        return upload
+
+    def discard(self, upload):
+        """删除上传的临时文件（调用方需持有 self.lock 并负责从字典中移除）"""
+        try:
+            os.remove(upload['path'])
+        except OSError:
+            pass
+
+    def expire_stale(self):
+        """清理长时间没有续传的上传"""
+        now = time.monotonic()
+        with self.lock:
+            for key, upload in list(self.uploads.items()):
+                if now - upload['updated'] > self.expire:
+                    self.discard(upload)
+                    del self.uploads[key]
+                    self.uploads_total.inc(result='expired')
+            self.active_uploads.set(len(self.uploads))